@@ -26,9 +26,10 @@ from PyQt5.QtGui import QFont
 from data import BackupProfile, BackupMapping
 from globaldata import PDATA, CONFIG
 from errors import BackupProfileNotFoundError
-from threads import BackupThread, ThreadManager, PruneBackupThread
+from threads import BackupThread, ThreadManager, PruneBackupThread, VerifyThread
 from iterator import recursivecopy
-from algorithms import ProcessStatus
+from algorithms import ProcessStatus, VerifyReport
+from compression import codec
 
 logger = logging.getLogger("UI.MainWindowWidgets")
 
@@ -87,6 +88,22 @@ class EditBackupProfileWidget(QWidget):
         listeditlayout.addWidget(EditPathListWidget(self._profile.destinations, "Destination Folders", self))
         mainlayout.addLayout(listeditlayout)
 
+        # The format copies are compressed in:
+        temp_hbox = QHBoxLayout()
+        self.compression_cbox = QComboBox()
+        self.compression_cbox.addItems(["none"] + codec.available())
+        temp_hbox.addWidget(QLabel("Compression:  "))
+        temp_hbox.addWidget(self.compression_cbox)
+        mainlayout.addLayout(temp_hbox)
+
+        # When copies are synced to disk:
+        temp_hbox = QHBoxLayout()
+        self.sync_cbox = QComboBox()
+        self.sync_cbox.addItems(["default"] + list(recursivecopy.SYNC_POLICIES))
+        temp_hbox.addWidget(QLabel("Sync:  "))
+        temp_hbox.addWidget(self.sync_cbox)
+        mainlayout.addLayout(temp_hbox)
+
         # Buttons to save, delete, and cancel the backup profile
         finalbuttons_layout = QHBoxLayout()
         self.finish_editing_button = QPushButton()
@@ -103,9 +120,14 @@ class EditBackupProfileWidget(QWidget):
     
     def _apply_profile_to_fields(self):
         self.name_tbox.setText(self._profile.name)
+        index = self.compression_cbox.findText(self._profile.compression.partition(":")[0])
+        self.compression_cbox.setCurrentIndex(max(0, index))
+        self.sync_cbox.setCurrentIndex(max(0, self.sync_cbox.findText(self._profile.sync)))
 
     def _connect_handlers(self):
         self.name_tbox.textChanged.connect(self._set_profile_name)
+        self.compression_cbox.currentTextChanged.connect(self._set_profile_compression)
+        self.sync_cbox.currentTextChanged.connect(self._set_profile_sync)
         self.finish_editing_button.clicked.connect(self._finish_editing_profile)
         self.cancel_edit_button.clicked.connect(self._cancel_edit)
         self.delete_profile_button.clicked.connect(self._delete_backup_profile)
@@ -114,6 +136,14 @@ class EditBackupProfileWidget(QWidget):
     def _set_profile_name(self):
         self._profile.name = self.name_tbox.text()
 
+    @pyqtSlot(str)
+    def _set_profile_compression(self, text: str=""):
+        self._profile.compression = "" if text == "none" else text
+
+    @pyqtSlot(str)
+    def _set_profile_sync(self, text: str=""):
+        self._profile.sync = "" if text == "default" else text
+
     @pyqtSlot()
     def _delete_backup_profile(self):
         logger.warning("delete button clicked")
@@ -444,16 +474,21 @@ class ManageBackupsWidget(QWidget):
         self.executebackup_button = QPushButton("Execute Selected Backup")
         mainlayout.addWidget(self.executebackup_button)
 
+        self.verifybackup_button = QPushButton("Verify Selected Backup")
+        mainlayout.addWidget(self.verifybackup_button)
+
         self.setLayout(mainlayout)
 
     def _set_enabled_buttons(self):
         self.editbackup_button.setEnabled(len(self._profiles) > 0)
         self.executebackup_button.setEnabled((self.backup_combobox.currentIndex() >= 0) and (self.backup_combobox.currentIndex() < len(self._profiles)))
+        self.verifybackup_button.setEnabled(self.executebackup_button.isEnabled())
 
     def _connect_handlers(self):
         self.newbackup_button.clicked.connect(self._new_backup)
         self.editbackup_button.clicked.connect(self._edit_selected_backup)
         self.executebackup_button.clicked.connect(self._execute_backup)
+        self.verifybackup_button.clicked.connect(self._verify_backup)
     
     @pyqtSlot()
     def _new_backup(self):
@@ -467,6 +502,14 @@ class ManageBackupsWidget(QWidget):
         if i < len(self._profiles):
             self.parent().setCentralWidget(ExecuteBackupWidget(self.parent(), self._profiles[i]))
 
+    @pyqtSlot()
+    def _verify_backup(self):
+        i = self.backup_combobox.currentIndex()
+        if i < 0:
+            return
+        if i < len(self._profiles):
+            self.parent().setCentralWidget(VerifyBackupWidget(self.parent(), self._profiles[i]))
+
     @pyqtSlot()
     def _edit_selected_backup(self):
         i = self.backup_combobox.currentIndex()
@@ -484,7 +527,6 @@ class ExecuteBackupWidget(QWidget):
         self.executions = []
         
         self.threadmanager = ThreadManager(int(CONFIG["BackupBehavior"]["threadcount"]))
-        self.threadmanager.throttle = 20
         self.threadmanager.start()
 
         self._init_layout()
@@ -580,7 +622,8 @@ class ExecuteBackupWidget(QWidget):
             gblayout.addWidget(self._label_list("Destinations: ", valid_destinations))
             for entry in valid_sources:
                 self.executions.append(QBackupExecution(self, 
-                    {"source": entry, "destinations": valid_destinations, "newdest": self.backupmapping[entry]}, 
+                    {"source": entry, "destinations": valid_destinations, "newdest": self.backupmapping[entry], 
+                    "mapping": self.backupmapping, "compression": backup.compression, "sync": backup.sync}, 
                     self.threadmanager))
                 
                 gblayout.addWidget(self.executions[(len(self.executions) - 1)])
@@ -653,10 +696,12 @@ class QBackupExecution(QWidget):
         
         self.progressbar = QProgressBar()
         self.currentop_label = QLabel()
+        self.details_label = QLabel()
         self.groupbox = QGroupBox(self.backupthread.backup["source"])
         t = QVBoxLayout()
         t.addWidget(self.progressbar)
         t.addWidget(self.currentop_label)
+        t.addWidget(self.details_label)
         self.groupbox.setLayout(t)
         
         mainlayout.addWidget(self.groupbox)
@@ -670,18 +715,20 @@ class QBackupExecution(QWidget):
         self.backupthread.qcom.exec_finished.connect(self._backup_finished)
 
     def startExecution(self):
-        self.threadmanager.addThread(self.backupthread)
+        backup = self.backupthread.backup
+        self.threadmanager.addThread(self.backupthread, [backup["source"]] + backup["destinations"])
 
     def stopExecution(self):
-        if self.backupthread.isAlive(): logger.warning("Aborting backup in progress: " + str(self.backupthread.backup))
+        if not self.complete: logger.warning("Aborting backup in progress: " + str(self.backupthread.backup))
         self.backupthread.cancelExec()
         #the thread should pass-through its run() method and die, then be picked
         #up by the thread manager.
 
     @pyqtSlot(ProcessStatus)
     def _update_progress(self, status):
-        self.progressbar.setValue(status.percent)
+        self.progressbar.setValue(int(status.percent))
         self.currentop_label.setText(status.message)
+        self.details_label.setText(status.summary())
     
     @pyqtSlot()
     def _backup_finished(self):
@@ -700,7 +747,7 @@ class QPruneBackupExecution(QWidget):
     
     def __del__(self):
         if self.prunethread is not None:
-            if self.prunethread.isAlive():
+            if self.prunethread.is_alive():
                 self.prunethread.join()
             self.prunethread = None
 
@@ -739,3 +786,84 @@ class QPruneBackupExecution(QWidget):
         logger.debug(f"{QPruneBackupExecution.completeOperation.__qualname__}: called -> raisining the pruneCompleted signal!")
         self.pruneCompleted.emit()
     
+
+class VerifyBackupWidget(QWidget):
+    '''
+    CentralWidget:
+        Reads back the copies of a backup and lists the ones that are missing or damaged.
+    '''
+    def __init__(self, parent, backup: BackupProfile):
+        super(VerifyBackupWidget, self).__init__(parent)
+        self.parent().statusBar().showMessage("Verify: " + backup.name, 3000)
+        self.backup = backup
+        self.verifythread = VerifyThread(backup, backup.find_mapping(CONFIG))
+
+        self._init_layout()
+        self._connect_handlers()
+        self.verifythread.start()
+
+    def __del__(self) -> None:
+        if self.verifythread is not None:
+            self.verifythread.cancelExec()
+            self.verifythread = None
+
+    def _init_layout(self):
+        self.parent().setWindowTitle("Verify Backup")
+        mainlayout = QVBoxLayout()
+
+        groupbox = QGroupBox(f"Verifying \"{self.backup.name}\"")
+        gblayout = QVBoxLayout()
+        self.progressbar = QProgressBar()
+        self.currentop_label = QLabel("Preparing...")
+        self.details_label = QLabel()
+        gblayout.addWidget(self.progressbar)
+        gblayout.addWidget(self.currentop_label)
+        gblayout.addWidget(self.details_label)
+        groupbox.setLayout(gblayout)
+        mainlayout.addWidget(groupbox)
+
+        #problems textbox
+        gbox = QGroupBox("Problems:")
+        gbox_layout = QVBoxLayout()
+        self.errors_textedit = QPlainTextEdit()
+        self.errors_textedit.setReadOnly(True)
+        gbox_layout.addWidget(self.errors_textedit)
+        gbox.setLayout(gbox_layout)
+        mainlayout.addWidget(gbox)
+
+        self.cancel_button = QPushButton("Cancel")
+        mainlayout.addWidget(self.cancel_button)
+
+        self.setLayout(mainlayout)
+
+    def _connect_handlers(self):
+        self.verifythread.statusUpdated.connect(self._update_progress)
+        self.verifythread.showError.connect(self._show_error)
+        self.verifythread.finished.connect(self._verify_finished)
+        self.cancel_button.clicked.connect(self._cancel_verify)
+
+    @pyqtSlot(ProcessStatus)
+    def _update_progress(self, status):
+        self.progressbar.setValue(int(status.percent))
+        self.currentop_label.setText(status.message)
+        self.details_label.setText(status.summary())
+
+    @pyqtSlot(recursivecopy.UnexpectedError)
+    def _show_error(self, error):
+        self.errors_textedit.appendPlainText(error.message)
+
+    @pyqtSlot(VerifyReport)
+    def _verify_finished(self, report):
+        self.cancel_button.setText("Back")
+        self.currentop_label.setText(report.lines()[0])
+        if report.ok():
+            QMessageBox.information(self, "Complete!", "Every copy checked out.")
+        else:
+            QMessageBox.warning(self, "Problems Found", report.lines()[0])
+
+    @pyqtSlot()
+    def _cancel_verify(self):
+        if self.cancel_button.text() == "Cancel":
+            logger.warning("Verify cancelled.")
+            self.verifythread.cancelExec()
+        self.parent().setCentralWidget(ManageBackupsWidget(self.parent()))
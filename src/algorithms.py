@@ -1,8 +1,12 @@
-import logging, os, shutil, dataclasses
+import logging, os, dataclasses, threading, typing, time, datetime, queue
+import concurrent.futures
 
-from iterator import recursivecopy, recursiveprune, copypredicate
-from data import BackupProfile, BackupMapping
+from iterator import recursivecopy, copyoptions, recursiveprune, copypredicate, recursivescan, split_path, file_digest, blockmap, new_checksum
+from data import BackupProfile, BackupMapping, BackupManifest, HashCache, RunJournal
 from globaldata import CONFIG
+from scheduler import device_of, device_limit
+from chunkstore import ChunkStore, RecipeBook, chunker
+from compression import codec
 
 
 logger = logging.getLogger(__name__)
@@ -12,6 +16,378 @@ logger = logging.getLogger(__name__)
 class ProcessStatus:
     percent: float = 0.0
     message: str = str()
+    bytes_done: int = 0
+    bytes_total: int = 0
+    files_done: int = 0
+    files_total: int = 0
+    rates: typing.Dict[str, float] = dataclasses.field(default_factory=dict) #destination -> MB/s
+    eta: float = -1.0 #seconds left, -1 when it can't be estimated yet.
+
+    def summary(self) -> str:
+        '''
+        Returns a single line describing how far along the process is:  files, bytes, the
+        throughput of each destination and the estimated time left.  Parts that are not known
+        are left out.
+        '''
+        parts = []
+        if self.files_total > 0: parts.append(f"{self.files_done}/{self.files_total} files")
+        if self.bytes_total > 0: parts.append(f"{_megabytes(self.bytes_done):.1f}/{_megabytes(self.bytes_total):.1f} MB")
+        for dest, rate in self.rates.items(): parts.append(f"{dest}: {rate:.1f} MB/s")
+        if self.eta >= 0: parts.append(f"ETA {datetime.timedelta(seconds=int(self.eta))}")
+        return ", ".join(parts)
+
+def _megabytes(byte_count: int=0) -> float:
+    return (byte_count / (2**20))
+
+class StatusLimiter:
+    '''
+    Passes status updates on to a callback no more than rate times a second, so a process that
+    updates its status for every file doesn't flood whoever is displaying it.  The latest update
+    that was held back is kept, and flush passes it on.  Pass force to send an update regardless,
+    at the start or end of a step for instance.
+    '''
+    def __init__(self, callback=None, rate: float=10.0):
+        '''
+        :param callback: callback(ProcessStatus)
+        :param rate:     the most updates passed on per second.  0 or less passes all of them.
+        '''
+        self.callback = callback
+        self.interval = ((1 / rate) if rate > 0 else 0.0)
+        self._last = None
+        self._pending = None
+
+    def due(self) -> bool:
+        '''
+        Returns True if the next update would be passed on.  Lets a caller skip putting together
+        an update that would be thrown away.
+        '''
+        return (self._last is None) or ((time.monotonic() - self._last) >= self.interval)
+
+    def __call__(self, status: ProcessStatus=None, force: bool=False) -> None:
+        if self.callback is None: return
+        if not force and not self.due():
+            self._pending = status
+            return
+        self._pending = None
+        self._last = time.monotonic()
+        self.callback(status)
+
+    def flush(self) -> None:
+        if self._pending is not None: self(self._pending, force=True)
+
+def status_rate() -> float:
+    '''
+    The number of status updates a second processes should limit themselves to.
+    '''
+    return float(CONFIG["BackupBehavior"]["progressrate"])
+
+class ParallelDeleter:
+    '''
+    Deletes paths on worker threads.  Each device gets its own pool of workers, so deletes on
+    separate disks don't wait on each other.  The contents of a folder are deleted in parallel
+    too:  the files of each folder under it are removed as separate tasks, then the folders
+    themselves, deepest first.
+    '''
+    def __init__(self, workers: int=4):
+        '''
+        :param workers: the number of threads deleting on each device, and deleting files within folders.
+        '''
+        self.workers = max(1, workers)
+        self._pools = {} #device -> executor
+        self._files = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self._lock = threading.Lock()
+
+    def delete(self, path: str="") -> concurrent.futures.Future:
+        '''
+        Starts deleting path.  Returns a future holding a list of error messages, which is empty when
+        path is gone.
+        '''
+        key, _ = device_of(os.path.dirname(path))
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+                self._pools[key] = pool
+        return pool.submit(self.remove, path)
+
+    def shutdown(self) -> None:
+        '''
+        Waits for every delete to finish, and stops the workers.
+        '''
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools: pool.shutdown(wait=True)
+        self._files.shutdown(wait=True)
+
+    def remove(self, path: str="") -> list:
+        '''
+        Deletes path on the calling thread, with the files in its folders still deleted in parallel.  Returns
+        a list of error messages, which is empty when path is gone.
+        '''
+        try:
+            if os.path.isdir(path) and not os.path.islink(path): return self._delete_tree(path)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            return [f"Could not delete \"{path}\": {str(e)}"]
+        return []
+
+    def _delete_tree(self, root: str="") -> list:
+        folders = []
+        tasks = []
+        errors = []
+        stack = [root]
+        while len(stack) > 0:
+            folder = stack.pop()
+            folders.append(folder)
+            files = []
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False): stack.append(entry.path)
+                        else: files.append(entry.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                errors.append(f"Could not list \"{folder}\": {str(e)}")
+            if len(files) > 0: tasks.append(self._files.submit(ParallelDeleter._remove_files, files))
+        for task in tasks: errors += task.result()
+        #a folder is always listed before the folders in it.
+        for folder in reversed(folders):
+            try:
+                os.rmdir(folder)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                errors.append(f"Could not delete \"{folder}\": {str(e)}")
+        return errors
+
+    @staticmethod
+    def _remove_files(paths: list=[]) -> list:
+        errors = []
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                errors.append(f"Could not delete \"{path}\": {str(e)}")
+        return errors
+
+_mapping_lock = threading.Lock() #the backups of a profile's sources share its mapping.
+_hashes = None
+_hashes_lock = threading.Lock()
+
+def hash_cache() -> HashCache:
+    '''
+    Returns the hash cache shared by every backup, loading it the first time it's needed.
+    '''
+    global _hashes
+    with _hashes_lock:
+        if _hashes is None:
+            _hashes = HashCache(limit=int(CONFIG["BackupBehavior"]["hashcachesize"]))
+            _hashes.load(CONFIG["BackupBehavior"]["hashcache"])
+        return _hashes
+
+def save_hash_cache() -> None:
+    with _hashes_lock:
+        if _hashes is not None: _hashes.save(CONFIG["BackupBehavior"]["hashcache"])
+
+class Trash:
+    '''
+    A folder at the top of a destination that pruned paths are moved into instead of being deleted.
+    Moving a path is a single rename however large it is, so pruning doesn't hold up a backup.  Each
+    run moves what it prunes into a batch of its own, named after the time it was made, keeping the
+    layout of the destination so a batch can be put back with restore.  A TrashReaper deletes the
+    batches once they are older than the grace period.
+    '''
+    FOLDER = ".backup-trash"
+
+    def __init__(self, destination: str=""):
+        '''
+        :param destination: the destination folder, the one the backups of a profile's sources are in.
+        '''
+        self.destination = destination
+        self.folder = os.path.join(destination, Trash.FOLDER)
+        self._batch = None
+
+    def put(self, path: str="") -> bool:
+        '''
+        Moves path, which has to be under the destination, into this run's batch.  Returns False if it
+        could not be moved, for example when the trash is on another filesystem.
+        '''
+        relative = split_path(self.destination, path)[1]
+        if len(relative) == 0: return False
+        try:
+            if self._batch is None: self._batch = self._new_batch()
+            moved = os.path.join(self._batch, relative)
+            os.makedirs(os.path.dirname(moved), exist_ok=True)
+            os.rename(path, moved)
+            return True
+        except OSError as e:
+            logger.warning(f"{Trash.put.__qualname__}: could not move \"{path}\" to the trash: {str(e)}")
+            return False
+
+    def batches(self) -> list:
+        '''
+        Returns (path, time made) of every batch in the trash, oldest first.
+        '''
+        try:
+            with os.scandir(self.folder) as it:
+                names = [entry.name for entry in it if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            return []
+        batches = []
+        for name in names:
+            try:
+                batches.append((os.path.join(self.folder, name), int(name.split("-")[0])))
+            except ValueError:
+                batches.append((os.path.join(self.folder, name), 0))
+        return sorted(batches, key=lambda b: b[1])
+
+    def restore(self, batch: str="") -> list:
+        '''
+        Moves everything in a batch back where it was pruned from.  Paths that have since been replaced
+        are left in the batch.  Returns the paths that were put back.
+        '''
+        restored = []
+        stack = [""]
+        while len(stack) > 0:
+            relative = stack.pop()
+            try:
+                with os.scandir(os.path.join(batch, relative)) as it:
+                    entries = [entry.name for entry in it]
+            except OSError:
+                continue
+            for name in entries:
+                moved = os.path.join(batch, relative, name)
+                original = os.path.join(self.destination, relative, name)
+                if not os.path.lexists(original):
+                    try:
+                        os.rename(moved, original)
+                        restored.append(original)
+                    except OSError as e:
+                        logger.error(f"{Trash.restore.__qualname__}: could not restore \"{original}\": {str(e)}")
+                elif os.path.isdir(original) and os.path.isdir(moved) and not os.path.islink(moved):
+                    stack.append(os.path.join(relative, name))
+        return restored
+
+    def _new_batch(self) -> str:
+        stamp = str(int(time.time()))
+        batch = os.path.join(self.folder, stamp)
+        x = 0
+        while os.path.lexists(batch):
+            x += 1
+            batch = os.path.join(self.folder, f"{stamp}-{x}")
+        os.makedirs(batch)
+        return batch
+
+class TrashReaper(threading.Thread):
+    '''
+    Deletes the batches of a destination's trash that are older than the grace period
+    (BackupBehavior/trashgracedays), at a low priority so it stays out of the way of any backup.
+    Batches still in their grace period are left for a later reaper.  Since a reaper is started for
+    a destination every time it is backed up or pruned, a delete that was cut short is picked up
+    again next time.  There is only ever one reaper running for each trash.
+    '''
+    _running = {} #trash folder -> reaper
+    _lock = threading.Lock()
+
+    def __init__(self, trash: Trash=None, grace: float=0.0):
+        '''
+        :param trash: the trash to empty.
+        :param grace: the age in seconds a batch has to reach before it is deleted.
+        '''
+        super(TrashReaper, self).__init__(daemon=True)
+        self.trash = trash
+        self.grace = grace
+
+    @staticmethod
+    def start_for(destination: str="") -> None:
+        '''
+        Starts a reaper on the destination's trash, unless one is already running or there's no trash.
+        '''
+        trash = Trash(destination)
+        if not os.path.isdir(trash.folder): return
+        with TrashReaper._lock:
+            reaper = TrashReaper._running.get(trash.folder)
+            if reaper is not None and reaper.is_alive(): return
+            reaper = TrashReaper(trash, float(CONFIG["BackupBehavior"]["trashgracedays"]) * 86400)
+            TrashReaper._running[trash.folder] = reaper
+            reaper.start()
+
+    @staticmethod
+    def wait_all() -> None:
+        '''
+        Waits for every running reaper to finish.
+        '''
+        with TrashReaper._lock:
+            reapers = list(TrashReaper._running.values())
+        for reaper in reapers: reaper.join()
+
+    def run(self):
+        #lowering the thread's CPU priority on Linux lowers its I/O priority as well.
+        if hasattr(os, "setpriority") and hasattr(threading, "get_native_id"):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+            except OSError:
+                pass
+        deleter = ParallelDeleter(1)
+        try:
+            for batch, made in self.trash.batches():
+                if (time.time() - made) < self.grace: break
+                logger.info(f"Emptying trash: \"{batch}\"")
+                for error in deleter.remove(batch): logger.error(f"{TrashReaper.run.__qualname__}: {error}")
+        finally:
+            deleter.shutdown()
+
+RESERVED_FOLDERS = [Trash.FOLDER, blockmap.FOLDER, BackupMapping.SNAPSHOTS, ChunkStore.FOLDER, RunJournal.FOLDER] #folders at the top of a destination that are not backups.
+
+class SourceScanner(threading.Thread):
+    '''
+    Counts the entries under a source in the background, so a backup can start copying
+    straight away while the total it measures its progress against is still being worked out.
+    The number of files and the bytes they hold are counted as well.
+    '''
+    def __init__(self, source: str=""):
+        super(SourceScanner, self).__init__(daemon=True)
+        self.source = source
+        self.count = 0
+        self.files = 0
+        self.size = 0
+        self.complete = False
+        self._halt = False
+
+    def run(self):
+        for entry in recursivescan(self.source):
+            if self._halt: return
+            self.count += 1
+            try:
+                if not entry.is_dir():
+                    self.size += entry.stat(follow_symlinks=False).st_size
+                    self.files += 1
+            except OSError:
+                pass
+        self.complete = True
+
+    def stop(self) -> None:
+        self._halt = True
+
+    def total(self, done: int=0) -> int:
+        '''
+        Returns the best estimate of the total number of entries.  It is exact once the scan
+        is complete.  Until then it is never less than what has already been processed.
+        '''
+        if self.complete: return self.count
+        return max(self.count, (done + 1))
+
+    def total_bytes(self, done: int=0) -> int:
+        '''
+        Same as total, for the bytes held by the files under the source.
+        '''
+        if self.complete: return self.size
+        return max(self.size, (done + 1))
 
 class Backup:
     '''
@@ -29,6 +405,9 @@ class Backup:
             source: str()
             destinations: [str]
             newdestname: str
+            mapping: BackupMapping, optional.  Keeps the snapshots in snapshot mode, and the recipes in a chunk store.
+            compression: str, optional.  The profile's compression setting (see compression.codec.parse).
+            sync: str, optional.  The profile's sync policy (see recursivecopy.SYNC_POLICIES).  The configuration's if it's empty.
 
         com: callbacks that can be passed in order to recieve updates as the process progresses.
             progressupdate(ProcessStatus)
@@ -39,11 +418,38 @@ class Backup:
         self.source = data["source"]
         self.destinations = data["destinations"]
         self.newdestname = data["newdest"]
+        self.destname = os.path.basename(self.source) if self.newdestname is None else self.newdestname
+        self.mapping = data.get("mapping")
+        self.snapshot = None #the name of the snapshot being written, in snapshot mode.
+        self.manifests = {}
         self.update_progress = com["progressupdate"]
         self.report_error = com["reporterror"]
         self.finishedcallback = com["finished"]
         self.abort = False
         self.status = ProcessStatus(0.0, "Nothing is happening yet...")
+        self._file_start = 0 #bytes_done before the file being copied.
+        self._started = 0.0
+        self._sample = (0.0, {})
+        self._iterator = None
+        self._limiter = StatusLimiter(self._emit_status, status_rate())
+        self._deleter = None
+        self._predicate = None
+        self._trashes = {} #destination -> Trash
+        self._deletions = {} #future -> path being deleted
+        self._deleted = queue.Queue() #deletes that finished
+        self._previous = {} #snapshot being written -> the manifest of the snapshot before it
+        self._linkfrom = {} #snapshot being written -> the path of the snapshot before it
+        self._books = {} #destination -> RecipeBook, when the destinations are chunk stores
+        self._journals = {} #destination -> RunJournal, while a run can be resumed
+        try:
+            self._codec = codec.parse(data.get("compression", ""), int(CONFIG["BackupBehavior"]["compressthreads"]))
+        except ValueError:
+            logger.exception(f"Copies of \"{self.source}\" will not be compressed.")
+            self._codec = None
+        self._sync = data.get("sync") or CONFIG["BackupBehavior"]["sync"]
+        if self._sync not in recursivecopy.SYNC_POLICIES:
+            logger.error(f"Unknown sync policy \"{self._sync}\", copies of \"{self.source}\" are left to the system to sync.")
+            self._sync = "none"
         
         self.ignored_errors = [recursivecopy.ERROR_TYPES[key] for key in recursivecopy.ERROR_TYPES.keys() if key in CONFIG["DEFAULT"]["ignorederrors"]]
         if len(self.ignored_errors) > 0: logger.info(f"Ignoring error types: {repr(self.ignored_errors)}")
@@ -51,6 +457,7 @@ class Backup:
     
     def execute(self):
         logger.debug("BackupThread starting to run.")
+        scanner = None
         try:
             self.abort = False
             if len(self.destinations) == 0:
@@ -58,93 +465,495 @@ class Backup:
                 logger.warning("No destination folders, doing nothing.  Backup aborting.")
                 return
             sources_copied = 0
+            self._deleter = ParallelDeleter(int(CONFIG["BackupBehavior"]["prunethreads"]))
+            self._trashes = dict([(dest, Trash(dest)) for dest in self.destinations]) if CONFIG["BackupBehavior"].getboolean("usetrash") else {}
+            chunks = (CONFIG["BackupBehavior"]["destinationformat"] == "chunks")
+            snapshots = CONFIG["BackupBehavior"].getboolean("snapshots") and not chunks
+            if snapshots or chunks: self._trashes = {}
 
             self.status = ProcessStatus(0.0, "Perparing...")
-            self.updateStatus(self.status)
-            sources_count = sum((len(files) + len(dirs)) for _, dirs, files in os.walk(self.source))
+            self.updateStatus(self.status, force=True)
             
+            # The total comes from what was recorded last time.  Without a record, the source is counted
+            # alongside the copy instead of before it, so the first file gets copied right away.
+            if chunks: self._books = self._load_books()
+            elif snapshots: self.manifests = self._start_snapshot()
+            else: self.manifests = self._load_manifests()
+            sources_count = self._recorded_count()
+            self.status.files_total, self.status.bytes_total = self._recorded_size()
+            if sources_count == 0:
+                scanner = SourceScanner(self.source)
+                scanner.start()
+            predicate = copypredicate.if_source_was_modified_more_recently
+            if len(self.manifests) > 0: predicate = copypredicate.if_source_differs_from_manifest(self.manifests)
+            if snapshots: predicate = copypredicate.if_source_differs_from_manifest(self._previous)
+            #a snapshot's files may be links shared with the ones before it, so they are never changed in place.
+            if CONFIG["BackupBehavior"].getboolean("comparecontent") and not snapshots:
+                #files are still compared without a checksum for the copies, blake2b is then as good as any.
+                checksum = CONFIG["BackupBehavior"]["checksum"]
+                if checksum.lower() == "none": checksum = "blake2b"
+                predicate = copypredicate.if_content_differs(predicate, hash_cache(), onunchanged=self._record_copy,
+                    deltasize=int(CONFIG["BackupBehavior"]["deltasize"]), checksum=checksum)
+            if chunks: predicate = None
+            self._predicate = predicate
+            #a snapshot or chunk store is only ever written whole, there is nothing to carry on with.
+            if CONFIG["BackupBehavior"].getboolean("resume") and not snapshots and not chunks: self._journals = self._load_journals()
+
             self.status.message = "Copying..."
             self.status.percent = 0.0
+            self.updateStatus(self.status, force=True)
             logger.info(f"Executing copy on \"{self.source}\"")
 
-            #initialize the iterator.
-            iterator = None
-            if self.newdestname is None:
-                iterator = iter(recursivecopy(self.source, self.destinations, predicate=copypredicate.if_source_was_modified_more_recently))
-            else:
-                iterator = iter(recursivecopy(self.source, self.destinations, 
-                    predicate=copypredicate.if_source_was_modified_more_recently,
-                    newdestname=self.newdestname))
+            #initialize the iterator.  The destinations are either pruned along the way, or walked
+            #again once the copy is done.
+            fused = CONFIG["BackupBehavior"].getboolean("fusedprune") and not snapshots and not chunks
+            roots = self.destinations
+            if snapshots:
+                roots = [BackupMapping.snapshot_folder(d, self.destname) for d in self.destinations]
+                roots = [r for r in roots if os.path.isdir(r)]
+            iterator = iter(recursivecopy(self.source, roots, 
+                predicate=predicate,
+                newdestname=(self.snapshot if snapshots else self.destname),
+                oncopied=self._record_copy,
+                onprogress=self._count_progress,
+                onstale=(self._prune if fused else None),
+                recorded=self._recorded_digest,
+                linkfrom=([self._linkfrom.get(os.path.join(r, self.snapshot)) for r in roots] if snapshots else None),
+                recipes=([self._books[d] for d in roots] if chunks else None),
+                journals=([self._journals[d] for d in roots] if len(self._journals) > 0 else None),
+                options=self._copy_options(snapshots),
+                stopped=(lambda: self.abort)))
+            self._iterator = iterator
+            self._started = time.monotonic()
+            self._sample = (self._started, dict(iterator.bytes_written))
             
             while not self.abort:
+                self._file_start = self.status.bytes_done
                 try:
                     errors = next(iterator)
                 except StopIteration:
                     break
                 if errors is not None:
                     for error in errors:
-                        if type(error) not in self.ignored_errors: 
+                        #a file the backup was stopped in the middle of isn't an error.
+                        if type(error) not in self.ignored_errors and not isinstance(error, recursivecopy.StoppedError): 
                             self.reportError(error)
                 sources_copied += 1
+                self._count_entry(iterator.current_entry)
+                if not self._limiter.due(): continue
                 self.status.message = self._display_string(iterator.current)
-                if sources_count > 0: self.status.percent = ((sources_copied * 100) / sources_count)
+                if scanner is not None: 
+                    sources_count = scanner.total(sources_copied)
+                    self.status.files_total = scanner.files if scanner.complete else max(scanner.files, self.status.files_done)
+                    self.status.bytes_total = scanner.total_bytes(self.status.bytes_done)
+                self._measure(sources_copied, sources_count)
                 self.updateStatus(self.status)
+            if scanner is not None: scanner.stop()
+            iterator.sync()
             
+            if scanner is not None and scanner.complete:
+                self.status.files_total, self.status.bytes_total = (scanner.files, scanner.size)
             self.status.percent = 100
-            self.updateStatus(self.status)
+            self.status.eta = -1.0
+            self.updateStatus(self.status, force=True)
 
             logger.info(f"Executing pruneing algorithm.")
-            if not self.abort:
+            if not self.abort and not fused and not snapshots and not chunks:
+                #the deletes of one destination go on while the next is walked.
                 for dest in self.destinations:
                     self.status.message = f"Pruning \"{dest}\""
                     logger.info(f"Pruning \"{dest}\"")
-                    self.updateStatus(self.status)
+                    self.updateStatus(self.status, force=True)
                     self._pruneDestination(self.source, dest)
+            self._finish_deletes()
+            self._limiter.flush()
+            for dest in self._trashes: TrashReaper.start_for(dest)
             
             logger.info(f"Pruning finished.")
+            if snapshots and self.abort: self._discard_snapshot()
+            self._save_manifests()
+            if snapshots and not self.abort: self._finish_snapshot()
+            self._save_books(sweep=(not self.abort))
+            self._finish_journals(done=(not self.abort))
+            self._close_predicate()
+            if self._codec is not None: self._codec.close()
             self.raiseFinished()
         except: # noqa E722
             logger.critical("Uncaught exception in a backup algorithm!")
             logger.exception("CRITICAL EXCEPTION; " + str({"source": self.source, "destinations": self.destinations}))
+            if scanner is not None: scanner.stop()
+            if self._iterator is not None: self._iterator.sync()
+            self._finish_deletes()
+            self._discard_snapshot()
+            self._save_manifests()
+            self._save_books(sweep=False)
+            self._finish_journals(done=False)
+            self._close_predicate()
+            if self._codec is not None: self._codec.close()
             self.raiseFinished()
     
+    def _copy_options(self, snapshots: bool=False) -> copyoptions:
+        '''
+        Returns the options the files of this backup are copied with, from the configuration.  The copies of a
+        snapshot may be links shared with the ones before it, so they are never changed in place.
+        '''
+        behavior = CONFIG["BackupBehavior"]
+        return copyoptions(
+            fanoutdepth=int(behavior["fanoutdepth"]),
+            checksum=behavior["checksum"],
+            deltasize=(0 if snapshots else int(behavior["deltasize"])),
+            deltablock=int(behavior["deltablocksize"]),
+            tailcopy=(behavior.getboolean("tailcopy") and not snapshots),
+            chunksize=int(behavior["chunksize"]),
+            compression=self._codec,
+            checkpoint=int(behavior["checkpointsize"]),
+            sync=self._sync)
+
     def _pruneDestination(self, source: str="", destination: str="") -> int:
         '''
-        Prunes the destination.
-        Returns the number of file objects a delete was executed on successfully.
-        Folders count as 1.  rmtree is used on those.
+        Prunes the destination.  The deletes are started, not waited on.
+        Returns the number of file objects a delete was started on.
+        Folders count as 1.
         '''
         logger.debug(f"{Backup._pruneDestination.__qualname__}: called")
         deletecount = 0
         if self.abort:
             return 0
-        for element in recursiveprune(source, destination, self.newdestname):
+        for element in recursiveprune(source, destination, self.newdestname, self._codec):
             if self.abort: break
-            if not self._deletePath(element):
-                logger.error(f"Prune: could not delete \"{element}\"")
-            else:
-                self.updateStatus(ProcessStatus(percent=100, message=f"Deleted \"{element}\""))
-                logger.warning(f"Deleted while pruning: \"{element}\"")
-                deletecount += 1
+            if self._prune(element): deletecount += 1
             if self.abort: break
         return deletecount
-    
-    def _deletePath(self, path: str="") -> bool:
-        if not os.path.exists(path):
+
+    def _prune(self, element: str="") -> bool:
+        '''
+        Moves a path that is no longer in the source from a destination to the destination's trash, or starts
+        deleting it if there is no trash or it can't be moved there.  Also the onstale callback for recursivecopy
+        when pruning during the copy, in which case a delete of a path that is about to be replaced by something
+        of a different type is waited on.
+        Returns True once the path was moved or the delete was started.
+        '''
+        trash = self._trash_of(element)
+        if trash is not None and trash.put(element):
+            self._pruned(element)
             return True
-        if os.path.islink(path) or os.path.isfile(path):
-            os.remove(path)
-        elif os.path.isdir(path):
-            shutil.rmtree(path, onerror=self.rmtree_onError)
-        return not os.path.exists(path)
-    
-    def rmtree_onError(self, function, path, excinfo) -> None:
-        errormessage = ("rmtree: I don't know what heppened... Here's some data:" + os.linesep + 
-            f"function: {str(function)}" + os.linesep + 
-            f"path: \"{path}\"" + os.linesep + 
-            f"excinfo: {str(excinfo)}")
-        self.reportError(recursivecopy.UnexpectedError(message=errormessage))
-        logger.error(errormessage)
+        future = self._deleter.delete(element)
+        self._deletions[future] = element
+        future.add_done_callback(self._deleted.put)
+        source = self._source_of(element)
+        if source is not None and os.path.lexists(source): future.result()
+        self._reap()
+        return True
+
+    def _reap(self, wait: bool=False) -> None:
+        '''
+        Handles the deletes that have finished:  they are taken out of the manifests, and their errors reported.
+        When wait is set, it waits until every delete that was started has finished.
+        '''
+        while len(self._deletions) > 0:
+            try:
+                future = self._deleted.get(block=wait)
+            except queue.Empty:
+                return
+            element = self._deletions.pop(future)
+            errors = future.result()
+            if len(errors) > 0:
+                for error in errors:
+                    logger.error(f"Prune: {error}")
+                    self.reportError(recursivecopy.UnexpectedError(message=error))
+                continue
+            self._pruned(element)
+
+    def _pruned(self, element: str="") -> None:
+        manifest = self._manifest_of(element)
+        if manifest is not None: manifest.forget(manifest.relative(element))
+        for dest in self.destinations:
+            root = os.path.join(dest, self.destname)
+            if element.startswith(root + os.path.sep): blockmap.forget(root, split_path(root, element)[1])
+        if self._limiter.due(): 
+            self.status.message = f"Deleted \"{element}\""
+            self.updateStatus(self.status)
+        logger.warning(f"Deleted while pruning: \"{element}\"")
+
+    def _finish_deletes(self) -> None:
+        if self._deleter is None: return
+        self._reap(wait=True)
+        self._deleter.shutdown()
+        self._deleter = None
+
+    def _trash_of(self, path: str="") -> Trash:
+        '''
+        Returns the trash of the destination path is in, or None.
+        '''
+        for dest, trash in self._trashes.items():
+            if path.startswith(os.path.join(dest, self.destname) + os.path.sep): return trash
+        return None
+
+    def _source_of(self, path: str="") -> str:
+        '''
+        Returns the path in the source that a destination path is a copy of, or None.
+        '''
+        for dest in self.destinations:
+            root = os.path.join(dest, self.destname)
+            if path.startswith(root + os.path.sep): return os.path.join(self.source, split_path(root, path)[1])
+        return None
+
+    def _load_manifests(self) -> dict:
+        '''
+        Loads the manifest of every destination, rebuilding those that can't be loaded.
+        Returns a dict mapping the folder the source is copied into to its manifest, which
+        will be empty if manifests are turned off.
+        '''
+        manifests = {}
+        for dest in self.destinations:
+            manifest = BackupManifest.for_destination(dest, self.destname, CONFIG)
+            if manifest is not None: manifests[manifest.root] = manifest
+        return manifests
+
+    def _load_books(self) -> dict:
+        '''
+        Loads the recipes of this source from the chunk store of every destination.  Returns a dict mapping
+        each destination to its RecipeBook, which is empty if the source wasn't stored there before.
+        '''
+        books = {}
+        if not chunker.fast(): logger.warning("The numpy module isn't installed, splitting files into chunks will be slow.")
+        for dest in self.destinations:
+            #with the "destination" policy the whole destination is synced before the books are saved.
+            book = RecipeBook(ChunkStore(dest, sync=(self._sync != "destination")), self.destname)
+            #held until the book is saved, so chunks aren't collected before it records them.
+            if not book.store.lock(): logger.warning(f"Could not lock the chunk store in \"{dest}\".")
+            book.load()
+            books[dest] = book
+        return books
+
+    def _load_journals(self) -> dict:
+        '''
+        Loads the journal of a run that was cut short from every destination.  Returns a dict mapping each
+        destination to its RunJournal, which is empty if the last run finished.
+        '''
+        journals = {}
+        for dest in self.destinations:
+            journal = RunJournal(filename=RunJournal.path(dest, self.destname))
+            if journal.load(): logger.info(f"Carrying on with the backup of \"{self.source}\" to \"{dest}\" where it stopped.")
+            journals[dest] = journal
+        return journals
+
+    def _finish_journals(self, done: bool=False) -> None:
+        '''
+        Deletes the journals once the whole source was walked, otherwise saves them for the next run.
+        '''
+        for dest, journal in self._journals.items():
+            if done: journal.remove()
+            elif os.path.isdir(dest): journal.save()
+        self._journals = {}
+
+    def _save_books(self, sweep: bool=False) -> None:
+        '''
+        Saves the recipe books, and records where they are in the mapping.  With sweep, the recipes of
+        what is no longer in the source are dropped first, which is only right once the whole source was walked.
+        The chunk stores are unlocked once their books are saved.
+        '''
+        if len(self._books) == 0: return
+        saved = []
+        for dest, book in self._books.items():
+            if sweep: book.sweep()
+            if os.path.isdir(dest) and book.save(): saved.append(dest)
+            book.store.unlock()
+        self._books = {}
+        if self.mapping is None or len(saved) == 0: return
+        with _mapping_lock:
+            self.mapping.recipes[self.destname] = ChunkStore("").recipe_file(self.destname)
+            self.mapping.try_save(saved, config=CONFIG)
+
+    def _recorded_count(self) -> int:
+        '''
+        Returns the number of entries the previous run recorded for this source, or 0 if
+        nothing was recorded.
+        '''
+        if len(self._books) > 0:
+            return max(((len(b.files) + len(b.folders) + 1) if len(b.files) + len(b.folders) > 0 else 0) 
+                for b in self._books.values())
+        manifests = self._previous if len(self._previous) > 0 else self.manifests
+        counts = [(len(m.files) + len(m.folders) + 1) for m in manifests.values() if len(m.files) + len(m.folders) > 0]
+        return max(counts) if len(counts) > 0 else 0
+
+    def _recorded_size(self) -> tuple:
+        '''
+        Returns (file count, byte count) of the source as the previous run recorded it, or
+        (0, 0) if nothing was recorded.
+        '''
+        if len(self._books) > 0:
+            return max((len(b.files), sum(recipe[0] for recipe in b.files.values())) for b in self._books.values())
+        manifests = self._previous if len(self._previous) > 0 else self.manifests
+        sizes = [(len(m.files), sum(record[0] for record in m.files.values())) for m in manifests.values()]
+        return max(sizes, default=(0, 0))
+
+    def _count_progress(self, byte_count: int=0) -> None:
+        '''
+        onprogress callback for recursivecopy.  Counts the bytes of the file being copied as they
+        are read, so progress keeps moving while large files are copied.
+        '''
+        self.status.bytes_done += byte_count
+        if self._limiter.due():
+            self._measure()
+            self.updateStatus(self.status)
+
+    def _count_entry(self, entry) -> None:
+        '''
+        Counts a file the copy iterator is done with.  A file counts for its full size whether it was
+        copied or found to be unchanged.
+        '''
+        if entry is None or entry.is_dir(): return
+        self.status.files_done += 1
+        try:
+            size = entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            size = (self.status.bytes_done - self._file_start)
+        self.status.bytes_done = (self._file_start + size)
+
+    def _measure(self, done: int=0, count: int=0) -> None:
+        '''
+        Updates the percentage, the throughput of each destination and the estimated time left.  Throughput
+        is averaged over at least a second.  The percentage is weighted by bytes once their total is known
+        and falls back on the count of entries otherwise.
+        '''
+        status = self.status
+        if status.bytes_total > 0: status.percent = min(100.0, ((status.bytes_done * 100) / status.bytes_total))
+        elif count > 0: status.percent = min(100.0, ((done * 100) / count))
+
+        now = time.monotonic()
+        then, written = self._sample
+        if (now - then) >= 1.0:
+            current = dict(self._iterator.bytes_written)
+            status.rates = dict([(os.path.dirname(root), _megabytes(current[root] - written.get(root, 0)) / (now - then)) 
+                for root in current])
+            self._sample = (now, current)
+        
+        elapsed = (now - self._started)
+        if status.bytes_total > 0 and status.bytes_done > 0 and elapsed >= 1.0:
+            status.eta = max(0.0, (status.bytes_total - status.bytes_done) / (status.bytes_done / elapsed))
+
+    def _close_predicate(self) -> None:
+        if isinstance(self._predicate, copypredicate.if_content_differs):
+            self._predicate.close()
+            save_hash_cache()
+        self._predicate = None
+
+    def _save_manifests(self) -> None:
+        for root, manifest in self.manifests.items():
+            folder = os.path.dirname(root)
+            if os.path.isdir(folder): manifest.save(BackupManifest.filename(folder, os.path.basename(root), CONFIG))
+
+    def _start_snapshot(self) -> dict:
+        '''
+        Names the snapshot this run writes and makes the folders it goes in.  The manifest of the snapshot
+        each destination holds from before is put in self._previous, keyed by the snapshot it is compared
+        with, so the files that didn't change can be linked from it.  Returns the new snapshots' manifests,
+        which are empty.
+        '''
+        if self.mapping is None: logger.warning(f"No mapping for \"{self.source}\", every file will be copied into the snapshot.")
+        self.snapshot = self._new_snapshot_name()
+        manifests = {}
+        for dest in self.destinations:
+            folder = BackupMapping.snapshot_folder(dest, self.destname)
+            try:
+                os.makedirs(folder, exist_ok=True)
+            except OSError as e:
+                logger.exception(f"{Backup._start_snapshot.__qualname__}: could not make \"{folder}\"")
+                self.reportError(recursivecopy.UnexpectedError(f"Could not make the snapshot folder \"{folder}\"", e))
+                continue
+            root = os.path.join(folder, self.snapshot)
+            previous = self.mapping.latest_snapshot(dest, self.destname) if self.mapping is not None else None
+            if previous is not None: self._linkfrom[root] = previous
+            if BackupManifest.filename(folder, self.snapshot, CONFIG) is None: continue
+            manifests[root] = BackupManifest(root=root)
+            if previous is None: continue
+            manifest = BackupManifest(root=previous)
+            if not manifest.load(BackupManifest.filename(folder, os.path.basename(previous), CONFIG)): manifest.rebuild()
+            manifest.root = root
+            self._previous[root] = manifest
+        return manifests
+
+    def _new_snapshot_name(self) -> str:
+        '''
+        Returns a name for a new snapshot:  the time, with a number after it if a snapshot was already made that second.
+        '''
+        stamp = datetime.datetime.now().strftime("%Y-%m-%dT%H%M%S")
+        taken = set(self.mapping.snapshots.get(self.destname, [])) if self.mapping is not None else set()
+        name, n = (stamp, 1)
+        while name in taken or any(os.path.lexists(os.path.join(BackupMapping.snapshot_folder(d, self.destname), name)) 
+            for d in self.destinations):
+            name = f"{stamp}-{n}"
+            n += 1
+        return name
+
+    def _finish_snapshot(self) -> None:
+        '''
+        Records the snapshot that was written in the mapping, and saves the mapfile to the destinations.
+        '''
+        if self.mapping is None: return
+        with _mapping_lock:
+            self.mapping.add_snapshot(self.destname, self.snapshot)
+            self.mapping.try_save(self.destinations, config=CONFIG)
+
+    def _discard_snapshot(self) -> None:
+        '''
+        Deletes the snapshot a run that was stopped or failed was writing, and its manifest.  It was never recorded
+        in the mapping, so nothing would resume, prune or delete it later.
+        '''
+        if self.snapshot is None: return
+        paths = []
+        for dest in self.destinations:
+            folder = BackupMapping.snapshot_folder(dest, self.destname)
+            paths += [os.path.join(folder, self.snapshot), BackupManifest.filename(folder, self.snapshot, CONFIG)]
+        deleter = ParallelDeleter(int(CONFIG["BackupBehavior"]["prunethreads"]))
+        try:
+            for future in [deleter.delete(path) for path in paths if path is not None and os.path.lexists(path)]:
+                for error in future.result(): logger.error(f"{Backup._discard_snapshot.__qualname__}: {error}")
+        finally:
+            deleter.shutdown()
+        logger.warning(f"The unfinished snapshot \"{self.snapshot}\" of \"{self.source}\" was deleted.")
+        self.manifests = {}
+        self.snapshot = None
+
+    def _manifest_of(self, path: str="") -> BackupManifest:
+        '''
+        Returns the manifest that path falls under, or None.
+        '''
+        for root, manifest in self.manifests.items():
+            if path == root or path.startswith(root + os.path.sep): return manifest
+        return None
+
+    def _recorded_digest(self, destination: str="") -> str:
+        '''
+        recorded callback for recursivecopy.  Returns the digest the manifest holds for a copy, if the copy
+        is still the one that was recorded.
+        '''
+        manifest = self._manifest_of(destination)
+        if manifest is None: return None
+        record = manifest.lookup(manifest.relative(destination))
+        if record is None or len(record) < 4: return None
+        try:
+            st = os.stat(destination)
+        except OSError:
+            return None
+        if [st.st_size, st.st_mtime_ns, st.st_ino] != record[:3]: return None
+        return record[3]
+
+    def _record_copy(self, source, destination: str="", details: dict={}) -> None:
+        '''
+        oncopied callback for recursivecopy.  Records a successful copy in the destination's manifest.
+        '''
+        manifest = self._manifest_of(destination)
+        if manifest is None: return
+        if source.is_dir():
+            manifest.record_folder(manifest.relative(destination))
+        else:
+            st = source.stat()
+            relpath = manifest.relative(destination)
+            digest = details.get("digest")
+            if details.get("linked") and manifest.root in self._previous: digest = self._previous[manifest.root].digest(relpath)
+            manifest.record(relpath, st.st_size, st.st_mtime_ns, details["inode"], digest)
 
     def raiseFinished(self) -> None:
         if self.finishedcallback is not None:
@@ -154,34 +963,296 @@ class Backup:
         if self.report_error is not None:
             self.report_error(error)
     
-    def updateStatus(self, status: ProcessStatus=ProcessStatus(0.0, "DEFAULT STATUS")) -> None:
+    def updateStatus(self, status: ProcessStatus=ProcessStatus(0.0, "DEFAULT STATUS"), force: bool=False) -> None:
+        '''
+        Passes status on to the progressupdate callback, at most progressrate times a second unless force
+        is set.
+        '''
+        self._limiter(status, force)
+
+    def _emit_status(self, status: ProcessStatus=None) -> None:
         if self.update_progress is not None:
-            self.update_progress(status)
+            #a copy, since the status keeps changing while whoever receives it reads it.
+            self.update_progress(dataclasses.replace(status, rates=dict(status.rates)))
 
     def _display_string(self, s: str="", length: int=100) -> str:
         if len(s) > length: s = (s[:int((length / 2) - 3)] + "..." + s[len(s) - int(length / 2 + 1):])
         return s
 
+@dataclasses.dataclass
+class VerifyReport:
+    '''
+    What a Verify found.  Problems are listed by the path of the copy.
+    '''
+    checked: int = 0
+    mismatched: typing.List[str] = dataclasses.field(default_factory=list)
+    missing: typing.List[str] = dataclasses.field(default_factory=list)
+    unreadable: typing.List[str] = dataclasses.field(default_factory=list)
+    skipped: int = 0 #copies there was nothing to check against:  no digest, and the source changed or is gone.
+    bytes_read: int = 0
+    seconds: float = 0.0
+
+    def ok(self) -> bool:
+        return (len(self.mismatched) + len(self.missing) + len(self.unreadable)) == 0
+
+    def throughput(self) -> float:
+        '''
+        Returns the average rate the copies were read at, in MB/s.
+        '''
+        return (_megabytes(self.bytes_read) / self.seconds) if self.seconds > 0 else 0.0
+
+    def lines(self) -> list:
+        '''
+        Returns the report as lines of text:  a summary followed by every problem found.
+        '''
+        lines = [f"Checked {self.checked} files ({_megabytes(self.bytes_read):.1f} MB at {self.throughput():.1f} MB/s).  " + 
+            f"{len(self.mismatched)} mismatched, {len(self.missing)} missing, {len(self.unreadable)} unreadable, " + 
+            f"{self.skipped} could not be checked."]
+        lines += [f"MISMATCHED: \"{p}\"" for p in self.mismatched]
+        lines += [f"MISSING: \"{p}\"" for p in self.missing]
+        lines += [f"UNREADABLE: \"{p}\"" for p in self.unreadable]
+        return lines
+
+class Verify:
+    '''
+    Reads back every copy a backup profile has on its destinations and checks it against the digest
+    recorded in the destination's manifest.  Copies without a digest are compared with their source
+    instead, as long as the source hasn't changed since it was copied.  Without a manifest, the source
+    is walked to find out which copies there should be.
+
+    In snapshot mode the latest snapshot on each destination is the one that is verified.  When the
+    destinations are chunk stores, every chunk the source's recipes use is read back and checked against
+    the digest it is stored under.  Compressed copies are read back through their codec, so it is what they
+    hold that is checked.
+
+    Each destination device gets its own workers, as many as device_limit allows for it, so disks are
+    read side by side while a single spinning disk is read one file at a time.  Use the com argument to
+    receive progress (ProcessStatus), problems (recursivecopy.UnexpectedError) and the end of the run.
+    '''
+    def __init__(self, backup: BackupProfile=None, mapping: BackupMapping=None,
+        com: dict={"progressupdate": None, "reporterror": None, "finished": None}):
+        self.backup = backup
+        self.mapping = mapping
+        self.update_progress = com["progressupdate"]
+        self.report_error = com["reporterror"]
+        self.finishedcallback = com["finished"]
+        self.abort = False
+        self.report = VerifyReport()
+        self.status = ProcessStatus(0.0, "Nothing is happening yet...")
+        self._limiter = StatusLimiter(self._emit_status, status_rate())
+        self._results = queue.Queue()
+        self._pools = {} #device -> (executor, slots)
+
+    def execute(self) -> VerifyReport:
+        '''
+        Verifies every destination, and returns the report.
+        '''
+        self.abort = False
+        self.report = VerifyReport()
+        started = time.monotonic()
+        destinations = [d for d in self.backup.destinations if os.path.isdir(d)]
+        for d in self.backup.destinations:
+            if d not in destinations: logger.error(f"{Verify.execute.__qualname__}: the destination \"{d}\" is not there.")
+        work = [(dest, source, self.mapping[source]) for dest in destinations for source in self.backup.sources]
+        self.status = ProcessStatus(0.0, "Verifying...")
+        self.status.files_total, self.status.bytes_total = self._recorded_size(work)
+        self._limiter(self.status, force=True)
+
+        for dest in destinations:
+            key, kind = device_of(dest)
+            if key not in self._pools:
+                workers = device_limit(kind)
+                self._pools[key] = (concurrent.futures.ThreadPoolExecutor(workers), threading.BoundedSemaphore(workers * 2))
+        feeders = [threading.Thread(target=self._feed, args=(dest, [w for w in work if w[0] == dest]), daemon=True) for dest in destinations]
+        for f in feeders: f.start()
+        while any(f.is_alive() for f in feeders) or not self._results.empty():
+            try:
+                result = self._results.get(timeout=0.25)
+            except queue.Empty:
+                continue
+            self._count(*result)
+            self.report.seconds = (time.monotonic() - started)
+        for pool, _ in self._pools.values(): pool.shutdown(wait=True)
+        while not self._results.empty(): self._count(*self._results.get())
+        self._pools = {}
+        self.report.seconds = (time.monotonic() - started)
+
+        self.status.percent = 100
+        self.status.message = self.report.lines()[0]
+        self._limiter(self.status, force=True)
+        for line in self.report.lines(): logger.info(line)
+        if self.finishedcallback is not None: self.finishedcallback()
+        return self.report
+
+    def _recorded_size(self, work: list=[]) -> tuple:
+        files, size = (0, 0)
+        for dest, source, destname in work:
+            chunks = Verify._chunks(dest, destname)
+            if chunks is not None:
+                files += len(chunks)
+                size += sum(chunks.values())
+                continue
+            root = self._root(dest, destname)
+            filename = BackupManifest.filename(os.path.dirname(root), os.path.basename(root), CONFIG)
+            manifest = BackupManifest(root=root)
+            if filename is not None and manifest.load(filename):
+                files += len(manifest.files)
+                size += sum(record[0] for record in manifest.files.values())
+        return files, size
+
+    def _root(self, dest: str="", destname: str="") -> str:
+        '''
+        Returns the folder in dest that a source's copies are in:  its latest snapshot in snapshot mode.
+        '''
+        if CONFIG["BackupBehavior"].getboolean("snapshots") and self.mapping is not None:
+            latest = self.mapping.latest_snapshot(dest, destname)
+            if latest is not None: return latest
+        return os.path.join(dest, destname)
+
+    @staticmethod
+    def _chunks(dest: str="", destname: str="") -> dict:
+        '''
+        Returns {digest: size} for every chunk a source's recipes use in dest, or None when the destinations
+        are not chunk stores or the source has no recipes there.
+        '''
+        if CONFIG["BackupBehavior"]["destinationformat"] != "chunks": return None
+        book = RecipeBook(ChunkStore(dest), destname)
+        if not book.load(): return None
+        return dict((digest, size) for recipe in book.files.values() for digest, size in recipe[2])
+
+    def _items(self, dest: str="", source: str="", destname: str=""):
+        '''
+        Yields (copy, source, record, compressed) for every copy that should be in dest.  record is the manifest's
+        record of the copy, or None when there is no manifest.  compressed is the codec a compressed copy is
+        read with, or None.
+        '''
+        chunks = Verify._chunks(dest, destname)
+        if chunks is not None:
+            store = ChunkStore(dest)
+            for digest, size in chunks.items(): yield (store.path(digest), "", [size, 0, 0, f"{ChunkStore.CHECKSUM}:{digest}"], None)
+            return
+        root = self._root(dest, destname)
+        filename = BackupManifest.filename(os.path.dirname(root), os.path.basename(root), CONFIG)
+        manifest = BackupManifest(root=root)
+        if filename is not None and manifest.load(filename):
+            for relpath, record in manifest.files.items():
+                original, compressed = Verify._original(os.path.join(source, relpath))
+                yield (os.path.join(root, relpath), original, record, compressed)
+        elif os.path.isdir(source):
+            for entry in recursivescan(source):
+                if not entry.is_symlink() and entry.is_file():
+                    copy = os.path.join(root, split_path(source, entry.path)[1])
+                    compressed = None
+                    if not os.path.lexists(copy):
+                        suffix = next((s for s in codec.SUFFIXES.values() if os.path.lexists(copy + s)), "")
+                        copy += suffix
+                        compressed = codec.of(copy) if len(suffix) > 0 else None
+                    yield (copy, entry.path, None, compressed)
+
+    @staticmethod
+    def _original(source: str="") -> tuple:
+        '''
+        Returns (source, codec) for the source of a copy named source:  the source without the suffix, and the codec
+        to read the copy with, when it's a compressed copy.  Otherwise (source, None).
+        '''
+        compressed = codec.of(source)
+        if compressed is None or os.path.lexists(source): return (source, None)
+        original = source[:-len(compressed.suffix)]
+        if not os.path.lexists(original): return (source, None)
+        return (original, compressed)
+
+    def _feed(self, dest: str="", work: list=[]) -> None:
+        '''
+        Hands the copies in dest to the workers of its device, no more than a few at a time.
+        '''
+        pool, slots = self._pools[device_of(dest)[0]]
+        for dest, source, destname in work:
+            for item in self._items(dest, source, destname):
+                if self.abort: return
+                slots.acquire()
+                future = pool.submit(Verify._check, *item)
+                future.add_done_callback(lambda f, item=item: (slots.release(), self._results.put((item, f))))
+
+    @staticmethod
+    def _check(copy: str="", source: str="", record: list=None, compressed: codec=None) -> tuple:
+        '''
+        Checks one copy.  Returns (result, bytes read), result being "ok", "mismatched", "missing",
+        "unreadable" or "skipped".  A compressed copy that can't be decompressed is "unreadable".
+        '''
+        try:
+            cst = os.stat(copy)
+        except FileNotFoundError:
+            return ("missing", 0)
+        except OSError:
+            return ("unreadable", 0)
+        #the size of a compressed copy says nothing about what it holds.
+        if record is not None and cst.st_size != record[0] and compressed is None: return ("mismatched", 0)
+        copy_digest = file_digest
+        if compressed is not None: copy_digest = (lambda path, checksum="blake2b": compressed.digest(path, new_checksum(checksum)))
+        expected = record[3] if (record is not None and len(record) > 3 and record[3]) else None
+        if expected is not None:
+            checksum, digest = expected.split(":", 1)
+            try:
+                return (("ok" if copy_digest(copy, checksum) == digest else "mismatched"), cst.st_size)
+            except ValueError:
+                return ("skipped", 0)
+            except OSError:
+                return ("unreadable", 0)
+
+        #without a digest, the source is what the copy is checked against.
+        try:
+            sst = os.stat(source)
+        except OSError:
+            return ("skipped", 0)
+        if record is not None and (sst.st_size != record[0] or sst.st_mtime_ns != record[1]): return ("skipped", 0)
+        if sst.st_size != cst.st_size and compressed is None: return ("mismatched", 0)
+        try:
+            digest = copy_digest(copy)
+        except OSError:
+            return ("unreadable", 0)
+        try:
+            return (("ok" if file_digest(source) == digest else "mismatched"), cst.st_size)
+        except OSError:
+            return ("skipped", cst.st_size)
+
+    def _count(self, item: tuple=(), future: concurrent.futures.Future=None) -> None:
+        copy = item[0]
+        try:
+            result, size = future.result()
+        except Exception as e: # noqa E722
+            logger.exception(f"{Verify._count.__qualname__}: checking \"{copy}\" failed.")
+            result, size = ("unreadable", 0)
+            self.reportError(recursivecopy.UnexpectedError(message=f"Could not check \"{copy}\"", exception=e))
+        self.report.checked += 1
+        self.report.bytes_read += size
+        if result == "skipped": self.report.skipped += 1
+        elif result != "ok":
+            getattr(self.report, result).append(copy)
+            logger.error(f"Verify: {result}: \"{copy}\"")
+            self.reportError(recursivecopy.UnexpectedError(message=f"{result.upper()}: \"{copy}\""))
+
+        self.status.files_done += 1
+        self.status.bytes_done += (size if size > 0 else (item[2][0] if item[2] is not None else 0))
+        if self._limiter.due():
+            if self.status.bytes_total > 0: self.status.percent = min(100.0, (self.status.bytes_done * 100) / self.status.bytes_total)
+            elif self.status.files_total > 0: self.status.percent = min(100.0, (self.status.files_done * 100) / self.status.files_total)
+            self.status.message = copy
+            self.status.rates = {"read": self.report.throughput()}
+            self._limiter(self.status)
+
+    def reportError(self, error: recursivecopy.UnexpectedError = None) -> None:
+        if self.report_error is not None:
+            self.report_error(error)
+
+    def _emit_status(self, status: ProcessStatus=None) -> None:
+        if self.update_progress is not None:
+            self.update_progress(dataclasses.replace(status, rates=dict(status.rates)))
+
 def prune_backup(backup: BackupProfile=None, mapping: BackupMapping=None, updateStatus=None, finished=None) -> None:
-    def _tdeletePath(path: str="") -> bool:
-        def rmtree_onError(function, path, excinfo) -> None:
-            errormessage = ("rmtree: I don't know what heppened... Here's some data:" + os.linesep + 
-                f"function: {str(function)}" + os.linesep + 
-                f"path: \"{path}\"" + os.linesep + 
-                f"excinfo: {str(excinfo)}")
-            logger.error(errormessage)
-
-        if not os.path.exists(path):
-            return True
-        if os.path.islink(path) or os.path.isfile(path):
-            os.remove(path)
-        elif os.path.isdir(path):
-            shutil.rmtree(path, onerror=rmtree_onError)
-        return not os.path.exists(path)
-    
+    status = StatusLimiter(updateStatus, status_rate())
     if len(backup.destinations) == 0:
         logger.info(f"{prune_backup.__qualname__}: no destinations in the backup.  Returing immediately.")
-        updateStatus(ProcessStatus(100.00, "Didn't find anything"))
+        status(ProcessStatus(100.00, "Didn't find anything"), force=True)
         return
     
     todel = []
@@ -196,22 +1267,85 @@ def prune_backup(backup: BackupProfile=None, mapping: BackupMapping=None, update
         logger.warning(f"{prune_backup.__qualname__}: did not find all the destinations.  " + 
             f"Executing on destinations: {repr(valid_dests)}    Skipping invalids: {repr(invalid_dests)}")
 
-    if updateStatus is not None: updateStatus(ProcessStatus(0.0, "Pruning Backup"))
+    status(ProcessStatus(0.0, "Pruning Backup"), force=True)
     for dest in valid_dests:
         with os.scandir(dest) as it:
-            destinations = [folder.name for folder in it if os.path.isdir(folder.path)]
+            destinations = [folder.name for folder in it if folder.is_dir()]
         sourcenames = [mapping[s] for s in backup.sources]
         for dname in destinations:
-            if dname not in sourcenames:
+            if dname not in sourcenames and dname not in RESERVED_FOLDERS:
                 todel.append(dest + os.path.sep + dname)
+                # the stale folder's manifest goes with it.
+                manifestfile = BackupManifest.filename(dest, dname, CONFIG)
+                if manifestfile is not None and os.path.isfile(manifestfile): todel.append(manifestfile)
+        # so do the snapshots and block maps of sources that aren't backed up any more.
+        for folder in [BackupMapping.SNAPSHOTS, blockmap.FOLDER]:
+            folder = os.path.join(dest, folder)
+            if not os.path.isdir(folder): continue
+            with os.scandir(folder) as it:
+                todel += [entry.path for entry in it if entry.is_dir(follow_symlinks=False) and entry.name not in sourcenames]
+        # and the journals of their runs.
+        journals = os.path.join(dest, RunJournal.FOLDER)
+        if os.path.isdir(journals):
+            with os.scandir(journals) as it:
+                todel += [entry.path for entry in it if entry.is_file(follow_symlinks=False) and entry.name[:-len(".json")] not in sourcenames]
     
     if len(todel) == 0:
-        if updateStatus is not None: updateStatus(ProcessStatus(100.00, "Nothing was pruned."))
+        status(ProcessStatus(100.00, "Nothing was pruned."), force=True)
     
+    trashes = dict([(os.path.normpath(dest), Trash(dest)) for dest in valid_dests]) if CONFIG["BackupBehavior"].getboolean("usetrash") else {}
+    deleter = ParallelDeleter(int(CONFIG["BackupBehavior"]["prunethreads"]))
+    deletes = []
     x = 0
     for d in todel:
         logger.warning(f"Pruning algorithm deleteing path: \"{d}\"")
-        _tdeletePath(d)
+        trash = next((t for root, t in trashes.items() if os.path.normpath(d).startswith(root + os.path.sep)), None)
+        if trash is not None and trash.put(d): 
+            x += 1
+            status(ProcessStatus((x / len(todel) * 100), "Pruning Backup"))
+        else: 
+            deletes.append(deleter.delete(d))
+    for done in concurrent.futures.as_completed(deletes):
+        for error in done.result(): logger.error(f"{prune_backup.__qualname__}: {error}")
         x += 1
-        if updateStatus is not None: updateStatus(ProcessStatus((x / len(todel) * 100), "Pruning Backup"))
+        status(ProcessStatus((x / len(todel) * 100), "Pruning Backup"))
+    deleter.shutdown()
+    for trash in trashes.values(): TrashReaper.start_for(trash.destination)
+    for dest in valid_dests:
+        if not os.path.isdir(os.path.join(dest, ChunkStore.FOLDER)): continue
+        status(ProcessStatus(100.0, f"Collecting unused chunks in \"{dest}\""), force=True)
+        _collect_chunks(dest, [mapping[s] for s in backup.sources])
+    status.flush()
+
+def _collect_chunks(dest: str="", sourcenames: list=[]) -> tuple:
+    '''
+    Deletes the recipes of sources that aren't backed up any more from dest's chunk store, then the chunks
+    that no recipe uses.  Nothing is collected if a book can't be read, since its chunks can't be told apart,
+    or while a backup to dest has the store locked.  Returns (count, size) of the chunks deleted.
+    '''
+    store = ChunkStore(dest)
+    if not store.lock(exclusive=True, wait=False):
+        logger.warning(f"{_collect_chunks.__qualname__}: not collecting chunks in \"{dest}\", a backup is storing chunks there.")
+        return (0, 0)
+    try:
+        referenced = set()
+        for name in store.books():
+            book = RecipeBook(store, name)
+            if name not in sourcenames:
+                logger.warning(f"Pruning algorithm deleteing path: \"{book.filename}\"")
+                try:
+                    os.remove(book.filename)
+                except OSError:
+                    logger.exception(f"{_collect_chunks.__qualname__}: could not delete \"{book.filename}\"")
+                    return (0, 0)
+                continue
+            if not book.load():
+                logger.error(f"{_collect_chunks.__qualname__}: not collecting chunks in \"{dest}\", \"{book.filename}\" could not be read.")
+                return (0, 0)
+            referenced.update(book.chunks())
+        count, size = store.collect(referenced)
+    finally:
+        store.unlock()
+    logger.info(f"Collected {count} unused chunks ({_megabytes(size):.1f} MB) in \"{dest}\"")
+    return (count, size)
 
@@ -0,0 +1,385 @@
+# Backup backs up a user's computer to one or more disk drives or block devices.
+# Copyright (C) 2019 Jonathan Whitlock
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os, stat, json, hashlib, random, logging, threading, time
+
+try:
+    import fcntl
+except ImportError: #windows
+    fcntl = None
+
+try:
+    import numpy
+except ImportError: #optional, chunking is done in python without it, which is far slower.
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# The gear table of the chunker.  It has to be the same on every run and every machine, or files would be cut
+# in different places each time and nothing would be shared, so it comes from a fixed seed.
+_GEAR = (lambda r: [r.getrandbits(64) for _ in range(0, 256)])(random.Random(0x6368756e6b73))
+_GEAR_ARRAY = numpy.array(_GEAR, dtype=numpy.uint64) if numpy is not None else None
+_SPANS = [(2**n, numpy.uint64(2**n)) for n in range(0, 6)] if numpy is not None else None
+_SCAN = (2**15) #the bytes hashed at once when looking for a cut with numpy.  Small enough to stay in the cache.
+
+
+class chunker:
+    '''
+    Splits data into content defined chunks, using a gear hash.  Where a chunk ends depends only on
+    the bytes just before the cut, so inserting or removing bytes in a file only changes the chunks
+    around the edit; the rest are cut in the same places as before and have the same digests.
+    With numpy the hashes of a block of bytes are worked out all at once, which is what keeps it near disk
+    speed.  Without it every byte goes through a python loop.
+    '''
+    def __init__(self, average: int=(2**20)):
+        '''
+        :param average: the size chunks average out to.  None are smaller than a quarter of it, or
+                        larger than four times it, except the last chunk of a file which can be smaller.
+        '''
+        self.minimum = max(64, average // 4)
+        self.maximum = max(self.minimum + 1, average * 4)
+        bits = max(1, (average - self.minimum).bit_length() - 1)
+        # the high bits of a gear hash depend on the most bytes, so those are the ones tested.
+        self.mask = ((1 << bits) - 1) << (64 - bits)
+
+    @staticmethod
+    def fast() -> bool:
+        '''
+        Returns True if numpy is installed, so cuts are found at close to disk speed.
+        '''
+        return numpy is not None
+
+    def cut(self, data) -> int:
+        '''
+        ### cut(self, data) -> int
+        Returns the length of the chunk data starts with.  data has to hold at least self.maximum
+        bytes unless it's the end of the file.
+        '''
+        size = len(data)
+        if size <= self.minimum: return size
+        end = min(size, self.maximum)
+        # the hash forgets a byte after 64 more, so starting 64 bytes before the minimum is the same as starting at 0.
+        start = self.minimum - 64
+        if numpy is None: return self._cut_slowly(data, start, end)
+        mask = numpy.uint64(self.mask)
+        shifted = numpy.empty(_SCAN, dtype=numpy.uint64)
+        first = 64 #the first offset of a block that can be a cut
+        while True:
+            stop = min(end, start + _SCAN)
+            h = _GEAR_ARRAY.take(numpy.frombuffer(data, dtype=numpy.uint8, count=(stop - start), offset=start))
+            # the hash at each byte is the sum of the gear values of the 64 bytes up to it, each shifted by its
+            # distance.  Doubling the span summed 6 times gets every one of them at once.
+            for span, shift in _SPANS:
+                count = len(h) - span
+                if count <= 0: break
+                numpy.left_shift(h[:count], shift, out=shifted[:count])
+                numpy.add(h[span:], shifted[:count], out=h[span:])
+            hits = numpy.flatnonzero((h[first:] & mask) == 0)
+            if hits.size > 0: return (start + first + int(hits[0]) + 1)
+            if stop == end: return end
+            # the next block starts far enough back that its hashes are whole from the first byte not tested yet.
+            start, first = ((stop - 63), 63)
+
+    def _cut_slowly(self, data, start: int=0, end: int=0) -> int:
+        h = 0
+        gear = _GEAR
+        mask = self.mask
+        for i, b in enumerate(data[start:end], start):
+            h = ((h << 1) + gear[b]) & 0xFFFFFFFFFFFFFFFF
+            if (h & mask) == 0 and i >= self.minimum: return (i + 1)
+        return end
+
+    def chunks(self, read):
+        '''
+        ### chunks(self, read)
+        Yields the chunks of a stream as bytes objects.
+            :param read: read(count) -> bytes, returning b'' at the end of the stream.
+        '''
+        pending = bytearray()
+        ateof = False
+        while True:
+            while not ateof and len(pending) < self.maximum:
+                data = read(self.maximum * 2)
+                if len(data) == 0: ateof = True
+                else: pending += data
+            if len(pending) == 0: return
+            with memoryview(pending) as view:
+                length = self.cut(view)
+                chunk = bytes(view[:length])
+            del pending[:length]
+            yield chunk
+
+
+class ChunkStore:
+    '''
+    A folder at the top of a destination holding chunks of files, each stored once under its digest.
+    Chunks are kept in "objects", spread over folders named after the first two characters of their
+    digest.  The recipes that put files back together from chunks are kept in "recipes", one RecipeBook
+    for each source backed up to the destination.  A chunk is written to a temporary file and renamed
+    into place, so a chunk that is there is always whole, and backups running side by side can share the store.
+    Unless the filesystem is synced before the recipes are saved, each chunk is synced before it is renamed,
+    so a recipe never outlives the chunks it uses in a crash.  A chunk that isn't the size it should be is
+    written again.
+
+    A backup holds a shared lock on the store until its recipes are saved, and chunks are only collected under
+    an exclusive one, so the chunks a running backup stored but hasn't recorded yet are never collected.  Where
+    files can't be locked, collecting spares whatever was written in the last GRACE seconds instead.
+    '''
+    FOLDER = ".chunks"
+    CHECKSUM = "sha256"
+    GRACE = (24 * 60 * 60)
+
+    def __init__(self, destination: str="", sync: bool=True):
+        '''
+        :param sync: sync each chunk as it's stored.  Only turn it off when the destination is synced as a whole
+                     before the recipes are saved.
+        '''
+        self.destination = destination
+        self.sync = sync
+        self.folder = os.path.join(destination, ChunkStore.FOLDER)
+        self.objects = os.path.join(self.folder, "objects")
+        self.recipes = os.path.join(self.folder, "recipes")
+        self._known = set() #digests known to be stored, saves a stat for chunks seen before.
+        self._made = set()
+        self._lock = None #the open lock file, while the store is locked.
+
+    def lock(self, exclusive: bool=False, wait: bool=True) -> bool:
+        '''
+        ### lock(self, exclusive: bool=False, wait: bool=True) -> bool
+        Locks the store, shared unless exclusive is True, until unlock is called.  Returns False if the lock
+        couldn't be had, which without wait includes when another store holds a lock that conflicts with it.
+        Where files can't be locked it returns True without doing anything.
+        '''
+        if fcntl is None: return True
+        try:
+            if self._lock is None:
+                os.makedirs(self.folder, exist_ok=True)
+                self._lock = open(os.path.join(self.folder, "lock"), 'ab')
+            fcntl.flock(self._lock.fileno(), (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+        except OSError:
+            logger.exception(f"Failed to lock the chunk store in \"{self.destination}\"")
+            return False
+        return True
+
+    def unlock(self) -> None:
+        if self._lock is None: return
+        self._lock.close()
+        self._lock = None
+
+    @staticmethod
+    def digest(data) -> str:
+        return hashlib.new(ChunkStore.CHECKSUM, data).hexdigest()
+
+    def path(self, digest: str="") -> str:
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def has(self, digest: str="", size: int=None) -> bool:
+        '''
+        Returns True if the chunk is stored, and has size bytes when size isn't None.
+        '''
+        if digest in self._known: return True
+        try:
+            st = os.stat(self.path(digest))
+        except OSError:
+            return False
+        if not stat.S_ISREG(st.st_mode) or (size is not None and st.st_size != size): return False
+        self._known.add(digest)
+        return True
+
+    def put(self, digest: str="", data: bytes=b'') -> int:
+        '''
+        ### put(self, digest: str, data: bytes) -> int
+        Stores a chunk, unless it's stored already.
+            :returns int: the number of bytes written, which is 0 if the chunk was already there.
+            :raises OSError: when the chunk can't be written.
+        '''
+        if self.has(digest, len(data)): return 0
+        path = self.path(digest)
+        folder = os.path.dirname(path)
+        if folder not in self._made:
+            os.makedirs(folder, exist_ok=True)
+            self._made.add(folder)
+        temp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp, 'wb') as file:
+                file.write(data)
+                if self.sync:
+                    file.flush()
+                    os.fsync(file.fileno())
+            os.replace(temp, path)
+        except OSError:
+            if os.path.lexists(temp): os.remove(temp)
+            raise
+        self._known.add(digest)
+        return len(data)
+
+    def read(self, digest: str="") -> bytes:
+        with open(self.path(digest), 'rb') as file:
+            return file.read()
+
+    def restore(self, chunks: list=[], path: str="") -> None:
+        '''
+        Puts a file back together from its chunks, [[digest, size]] as a recipe holds them.
+            :raises OSError: when a chunk is missing or the file can't be written.
+        '''
+        with open(path, 'wb') as file:
+            for digest, _ in chunks: file.write(self.read(digest))
+
+    def recipe_file(self, destname: str="") -> str:
+        return os.path.join(self.recipes, destname + ".json")
+
+    def books(self) -> list:
+        '''
+        Returns the names of the sources with a RecipeBook in the store.
+        '''
+        try:
+            with os.scandir(self.recipes) as it:
+                return [entry.name[:-5] for entry in it if entry.is_file() and entry.name.endswith(".json")]
+        except FileNotFoundError:
+            return []
+
+    def collect(self, referenced: set=set()) -> tuple:
+        '''
+        ### collect(self, referenced: set) -> (int, int)
+        Deletes the chunks that are not referenced, along with any temporary files a write left behind.  Call it
+        with the store locked exclusively.  Where it can't be locked, files younger than GRACE are left alone.
+            :returns (int, int): the number of chunks deleted, and the bytes they held.
+        '''
+        count, size = (0, 0)
+        spare = (time.time() - ChunkStore.GRACE) if fcntl is None else None
+        try:
+            folders = [entry.path for entry in os.scandir(self.objects) if entry.is_dir(follow_symlinks=False)]
+        except FileNotFoundError:
+            return (0, 0)
+        for folder in folders:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.name in referenced: continue
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                        if spare is not None and st.st_mtime >= spare: continue
+                        size += st.st_size
+                        os.remove(entry.path)
+                        count += 1
+                    except OSError:
+                        logger.exception(f"{ChunkStore.collect.__qualname__}: could not delete \"{entry.path}\"")
+                    self._known.discard(entry.name)
+        return (count, size)
+
+
+class RecipeBook:
+    '''
+    The recipes of the files of one source stored in a ChunkStore.  For every file it keeps the size,
+    the modification time (in nanoseconds) of the source when it was stored, and the chunks it is made
+    of, as [[digest, size]].  Like a BackupManifest, that's enough to tell whether a source file changed
+    without reading it.  Files that were not seen during a run are swept out of the book at the end of it.
+    '''
+    def __init__(self, store: ChunkStore=None, destname: str=""):
+        self.store = store
+        self.destname = destname
+        self.files = {} #relative path -> [size, mtime_ns, [[digest, size]]]
+        self.folders = set()
+        self._seen = set()
+
+    @property
+    def filename(self) -> str:
+        return self.store.recipe_file(self.destname)
+
+    def unchanged(self, relpath: str="", st: os.stat_result=None) -> bool:
+        '''
+        Returns True, and counts the file as seen, if the book has its recipe and the source's size and
+        modification time are what they were when it was stored.
+        '''
+        recipe = self.files.get(relpath)
+        if recipe is None or recipe[0] != st.st_size or recipe[1] != st.st_mtime_ns: return False
+        self._seen.add(relpath)
+        return True
+
+    def keep(self, relpath: str="") -> None:
+        '''
+        Counts a path as seen, so the recipe it has is kept.
+        '''
+        self._seen.add(relpath)
+
+    def keep_folder(self, relpath: str="") -> None:
+        '''
+        Counts a folder and everything the book has under it as seen.  An empty relpath is the source itself.
+        '''
+        prefix = (relpath + os.path.sep) if len(relpath) > 0 else ""
+        self._seen.update([path for path in self.files if path.startswith(prefix)])
+        self._seen.update([path for path in self.folders if path.startswith(prefix)])
+        if len(relpath) > 0: self._seen.add(relpath)
+
+    def record(self, relpath: str="", size: int=0, mtime_ns: int=0, chunks: list=[]) -> None:
+        self.files[relpath] = [size, mtime_ns, chunks]
+        self._seen.add(relpath)
+
+    def record_folder(self, relpath: str="") -> None:
+        if len(relpath) > 0:
+            self.folders.add(relpath)
+            self._seen.add(relpath)
+
+    def sweep(self) -> int:
+        '''
+        Drops everything that wasn't seen since the book was loaded.  Returns the number of paths dropped.
+        '''
+        gone = [f for f in self.files if f not in self._seen] + [f for f in self.folders if f not in self._seen]
+        for path in gone:
+            self.files.pop(path, None)
+            self.folders.discard(path)
+        return len(gone)
+
+    def chunks(self) -> set:
+        '''
+        Returns the digests of every chunk the book's recipes use.
+        '''
+        return set(digest for recipe in self.files.values() for digest, _ in recipe[2])
+
+    def save(self) -> bool:
+        '''
+        Saves the book.  Like a manifest it is synced and renamed over the old one.
+        '''
+        temp = (self.filename + ".tmp")
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(temp, 'wt') as file:
+                json.dump(obj={"version": 1, "files": self.files, "folders": sorted(self.folders)}, fp=file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp, self.filename)
+        except OSError:
+            logger.exception(f"Failed to save the recipes \"{self.filename}\"")
+            return False
+        return True
+
+    def load(self) -> bool:
+        '''
+        Loads the book.  Returns False if there is none, or it can't be read.
+        '''
+        try:
+            with open(self.filename, 'rt') as file:
+                data = json.load(file)
+            self.files = dict(data["files"])
+            self.folders = set(data["folders"])
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError):
+            logger.exception(f"The recipes \"{self.filename}\" could not be read.")
+            return False
+        self._seen = set()
+        return True
@@ -1,18 +1,21 @@
-import argparse, logging, tqdm, sys, math, os
+import argparse, logging, tqdm, sys, math, os, threading
 
 from data import BackupProfile
-from algorithms import Backup, ProcessStatus, prune_backup
+from algorithms import Backup, ProcessStatus, prune_backup, TrashReaper, Verify
 from globaldata import PDATA, CONFIG
 from iterator import recursivecopy
+from scheduler import DeviceScheduler
 
 logger = logging.getLogger(__name__)
 
 class ProgressState:
     def __init__(self, total=1):
-        self.prevpercent = 0.0
+        self.prevpercent = {} #the last whole percent shown for each process, by key.
+        self.summaries = {} #the last summary of each process, by key.
         self.count=total
         self.progressbar = None
         self.errors = []
+        self._lock = threading.Lock()
     
     def __del__(self):
         if self.progressbar is not None:
@@ -30,13 +33,30 @@ class ProgressState:
             self.progressbar.close()
             self.progressbar = None
 
-    def printProgress(self, status: ProcessStatus=ProcessStatus(0.0, ""))->None:
-        self.getProgressbar().update(float(math.floor(status.percent)) - self.prevpercent)
-        if float(math.floor(status.percent)) != self.prevpercent:
-            self.prevpercent = float(math.floor(status.percent))
+    def printProgress(self, status: ProcessStatus=ProcessStatus(0.0, ""), key=None)->None:
+        '''
+        Shows status.  Processes running at the same time share the progress bar, each
+        passing its own key, and the summaries of all of them are shown together.
+        '''
+        percent = float(math.floor(status.percent))
+        with self._lock:
+            self.getProgressbar().update(percent - self.prevpercent.get(key, 0.0))
+            self.prevpercent[key] = percent
+            summary = status.summary()
+            if len(summary) > 0:
+                self.summaries[key] = summary
+                self.getProgressbar().set_postfix_str(self.postfix(), refresh=False)
+
+    def postfix(self) -> str:
+        '''
+        Returns the summaries of every process, each named after its key when there is more than one.
+        '''
+        if len(self.summaries) == 1: return next(iter(self.summaries.values()))
+        return " | ".join(f"{os.path.basename(str(key))}: {summary}" for key, summary in self.summaries.items())
     
     def listError(self, error) -> None:
-        self.errors.append(error)
+        with self._lock:
+            self.errors.append(error)
 
     def finishedCallback(self)->None:
         print("BACKUP COMPLETE.")
@@ -46,7 +66,8 @@ class ProgressState:
         return self.progressbar
 
     def reset(self):
-        self.prevpercent = 0.0
+        self.prevpercent = {}
+        self.summaries = {}
 
     def setProgressbar(self, newbar: tqdm.tqdm=None)->None:
         if newbar is not None:
@@ -71,8 +92,10 @@ def run_backup(backup: BackupProfile=None) -> None:
     with ProgressState(total=len(sources)) as state:
         for d in destinations: print(f"DESTINATION: {d}")
         
-        backups = [Backup({"source": source, "destinations": destinations, "newdest": mapping[source]}, 
-            {"progressupdate": state.printProgress, "reporterror": state.listError, "finished": None})
+        backups = [Backup({"source": source, "destinations": destinations, "newdest": mapping[source], "mapping": mapping,
+            "compression": backup.compression, "sync": backup.sync}, 
+            {"progressupdate": (lambda status, key=source: state.printProgress(status, key)), 
+            "reporterror": state.listError, "finished": None})
             for source in sources]
         
         if len(backups) == 0:
@@ -88,11 +111,23 @@ def run_backup(backup: BackupProfile=None) -> None:
                 logger.error("User chose to abort.")
                 return
         
-        #execute all the backups:
-        for b in backups:
-            state.getProgressbar().set_description(os.path.basename(b.source))
-            b.execute()
-            state.reset()
+        #execute all the backups.  Unless threadcount allows more, they run one after the other; otherwise
+        #those on separate disks run at the same time.
+        state.getProgressbar().set_description(", ".join(os.path.basename(b.source) for b in backups))
+        threadcount = int(CONFIG["BackupBehavior"]["threadcount"])
+        scheduler = DeviceScheduler(threadcount)
+        try:
+            if threadcount <= 1:
+                for b in backups: b.execute()
+            else:
+                for b in backups: scheduler.addThread(threading.Thread(target=b.execute, daemon=True), [b.source] + b.destinations)
+                scheduler.join()
+        except KeyboardInterrupt:
+            for b in backups: b.abort = True
+            #waits for the threads of the backups that stopped, which still save what they did.
+            scheduler.halt_thread()
+            raise
+        state.reset()
         sys.stdout.flush()
         
         #check for errors.  If there were any, then tell the user:
@@ -111,8 +146,29 @@ def run_backup(backup: BackupProfile=None) -> None:
         state.getProgressbar().set_description("Pruning the backup sources")
         prune_backup(backup, mapping, state.printProgress)
     
+    print("Emptying the trash...")
+    TrashReaper.wait_all()
     print(f"{backup.name} COMPLETED")
 
+def run_verify(backup: BackupProfile=None) -> bool:
+    '''
+    Reads back the copies on every destination of backup, and prints what was wrong with them.
+    Returns true if nothing was.
+    '''
+    with ProgressState() as state:
+        state.getProgressbar().set_description(f"Verifying {backup.name}")
+        verify = Verify(backup, backup.find_mapping(CONFIG), 
+            {"progressupdate": state.printProgress, "reporterror": None, "finished": None})
+        try:
+            report = verify.execute()
+        except KeyboardInterrupt:
+            verify.abort = True
+            raise
+    sys.stdout.flush()
+    print()
+    for line in report.lines(): print(line)
+    return report.ok()
+
 def load_named_profile(name: str="") -> BackupProfile:
     for p in PDATA.profiles:
         if p.name == name: return p
@@ -147,6 +203,7 @@ def run_commandline(args: argparse.ArgumentParser=None) -> int:
     if args.profile:
         profile = load_named_profile(args.profile)
         if profile is not None:
+            if args.verify: return (0 if run_verify(profile) else 2)
             run_backup(profile)
             return 0
     return 1
\ No newline at end of file
@@ -0,0 +1,223 @@
+# Backup backs up a user's computer to one or more disk drives or block devices.
+# Copyright (C) 2019 Jonathan Whitlock
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os, zlib, lzma, bz2, gzip, math, struct, hashlib, logging, collections
+import concurrent.futures
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# what reading data that isn't valid raises, besides OSError.
+_DATA_ERRORS = (EOFError, lzma.LZMAError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# extensions of formats that are compressed already.  Compressing them again costs time and saves nothing.
+COMPRESSED_TYPES = frozenset([
+    ".gz", ".tgz", ".xz", ".txz", ".bz2", ".tbz", ".tbz2", ".zst", ".lz", ".lz4", ".lzma", ".z", ".zip", ".7z", ".rar",
+    ".cab", ".jar", ".war", ".apk", ".whl", ".deb", ".rpm", ".dmg", ".squashfs",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif", ".jxl",
+    ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac", ".mp4", ".m4v", ".mkv", ".webm", ".avi", ".mov", ".wmv",
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".epub"])
+
+def entropy(data) -> float:
+    '''
+    Returns the Shannon entropy of data in bits per byte.  8 is as random as data gets, and data that
+    is compressed already comes close to it.
+    '''
+    total = len(data)
+    if total == 0: return 0.0
+    return -sum((n / total) * math.log2(n / total) for n in collections.Counter(bytes(data)).values())
+
+def _varint(n: int=0) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def _crc32(data) -> bytes:
+    return struct.pack("<I", zlib.crc32(data))
+
+def stored_xz(data) -> bytes:
+    '''
+    Returns data as a complete xz stream without compressing it:  a single block of uncompressed LZMA2 chunks,
+    checked with CRC32.  Nothing is searched for matches, so it costs no more than copying, and any xz reads it.
+    '''
+    flags = b'\x00\x01' #CRC32
+    stream = bytearray(b'\xfd7zXZ\x00' + flags + _crc32(flags))
+    index = bytearray(b'\x00' + _varint(1 if len(data) > 0 else 0))
+    if len(data) > 0:
+        #block header:  its size, no optional sizes, one filter (LZMA2 with the smallest dictionary), padded.
+        header = bytearray(b'\x02\x00\x21\x01\x00\x00\x00\x00')
+        header += _crc32(header)
+        chunks = bytearray()
+        with memoryview(data) as view:
+            for offset in range(0, len(data), 2**16):
+                chunk = view[offset:offset + 2**16]
+                #an uncompressed chunk, the first resetting the dictionary.
+                chunks += (b'\x01' if offset == 0 else b'\x02') + struct.pack(">H", len(chunk) - 1)
+                chunks += chunk
+        chunks += b'\x00'
+        stream += header + chunks + (b'\x00' * (-len(chunks) % 4)) + _crc32(data)
+        index += _varint(len(header) + len(chunks) + 4) + _varint(len(data))
+    index += b'\x00' * (-len(index) % 4)
+    index += _crc32(index)
+    footer = struct.pack("<I", (len(index) // 4) - 1) + flags
+    return bytes(stream + index + _crc32(footer) + footer + b'YZ')
+
+class codec:
+    '''
+    Compresses copies into a standard format, named with the format's usual suffix, so that a copy can be
+    restored with gunzip, xz, bunzip2 or zstd without this program.  A file is compressed in blocks,
+    each into a member (or stream, or frame) of its own.  Those are valid one after another in all four
+    formats, so the blocks of a file are compressed side by side on a pool of threads and written in order.
+
+    Files with the extension of a compressed format are copied as they are.  Files whose first block looks
+    like random data are stored in the format without being compressed (zstd's fastest level stores them
+    too), so their name doesn't depend on their contents, and so neither does finding or pruning their copy.
+    bzip2 has no way to store data, so it compresses every file the same way.
+    '''
+    SUFFIXES = {"gzip": ".gz", "xz": ".xz", "bzip2": ".bz2", "zstd": ".zst"}
+    LEVELS = {"gzip": (6, 0), "xz": (6, 0), "bzip2": (9, 1), "zstd": (3, 1)} #name -> (default level, fastest level)
+    BLOCKSIZE = (2**22)
+    THRESHOLD = 7.5 #the entropy over which a block counts as random.
+
+    def __init__(self, name: str="gzip", level: int=None, threads: int=2):
+        '''
+        :param name:    "gzip", "xz", "bzip2" or "zstd".
+        :param level:   the compression level, or None for the format's default.
+        :param threads: the number of blocks compressed at once.
+        '''
+        self.name = name
+        self.suffix = codec.SUFFIXES[name]
+        self.level = codec.LEVELS[name][0] if level is None else level
+        self.threads = max(1, threads)
+        self._pool = None
+
+    @staticmethod
+    def available() -> list:
+        '''
+        Returns the names of the formats that can be used here.  zstd needs the zstandard module.
+        '''
+        return [name for name in codec.SUFFIXES if name != "zstd" or zstandard is not None]
+
+    @staticmethod
+    def parse(spec: str="", threads: int=2):
+        '''
+        ### parse(spec: str, threads: int) -> codec
+        Returns the codec a profile's compression setting names:  a format, optionally followed by ":level".
+        Returns None when it's empty or "none".  zstd falls back on gzip if the zstandard module isn't there.
+
+            :raises ValueError: when the format isn't known, or the level isn't a number.
+        '''
+        if spec is None or spec.strip().lower() in ("", "none"): return None
+        name, _, level = spec.strip().lower().partition(":")
+        if name not in codec.SUFFIXES: raise ValueError(f"Unknown compression format \"{name}\"")
+        if name not in codec.available():
+            logger.warning(f"The zstandard module isn't installed, compressing with gzip instead of {name}.")
+            name, level = ("gzip", "")
+        return codec(name, int(level) if len(level) > 0 else None, threads)
+
+    @staticmethod
+    def of(path: str=""):
+        '''
+        Returns a codec that can read path, going by its suffix, or None if it doesn't have the suffix of one.
+        '''
+        for name, suffix in codec.SUFFIXES.items():
+            if path.endswith(suffix) and name in codec.available(): return codec(name, threads=1)
+        return None
+
+    def compresses(self, name: str="") -> bool:
+        '''
+        Returns True if a file by this name gets compressed.
+        '''
+        return os.path.splitext(name)[1].lower() not in COMPRESSED_TYPES and not name.endswith(self.suffix)
+
+    def rename_listing(self, listing: list=[]) -> list:
+        '''
+        Takes the (name, kind, entry) listing of a source folder (see iterator.recursiveprune.listing) and returns
+        it with the names the copies have, sorted by them.  A file isn't compressed if the folder also holds a
+        file by the compressed name.
+        '''
+        names = set(name for name, _, _ in listing)
+        renamed = [(((name + self.suffix) if kind == "file" and self.compresses(name) and (name + self.suffix) not in names else name), kind, entry)
+            for name, kind, entry in listing]
+        return sorted(renamed, key=lambda e: e[0])
+
+    def random(self, data) -> bool:
+        '''
+        Returns True if data looks like it won't compress, in a format that can store data instead.
+        '''
+        if self.name == "bzip2": return False
+        return entropy(data[:(2**16)]) > codec.THRESHOLD
+
+    def compress(self, data, fast: bool=False) -> bytes:
+        '''
+        Compresses data into a complete member of the format.  With fast, data that won't compress is stored.
+        '''
+        if fast and self.name == "xz": return stored_xz(data)
+        level = codec.LEVELS[self.name][1] if fast else self.level
+        if self.name == "gzip":
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31) #31: a gzip header and trailer.
+            return compressor.compress(data) + compressor.flush()
+        if self.name == "xz": return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+        if self.name == "bzip2": return bz2.compress(data, level)
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def submit(self, data, fast: bool=False) -> concurrent.futures.Future:
+        '''
+        Compresses data on the codec's threads.  The compressors release the GIL, so blocks really are
+        compressed at the same time.
+        '''
+        if self._pool is None: self._pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        return self._pool.submit(self.compress, bytes(data), fast)
+
+    def open(self, path: str=""):
+        '''
+        Opens a compressed file for reading its contents.
+            :raises OSError: when it can't be opened.
+        '''
+        if self.name == "gzip": return gzip.open(path, 'rb')
+        if self.name == "xz": return lzma.open(path, 'rb')
+        if self.name == "bzip2": return bz2.open(path, 'rb')
+        handle = open(path, 'rb')
+        try:
+            return zstandard.ZstdDecompressor().stream_reader(handle, read_across_frames=True, closefd=True)
+        except TypeError: #older versions of zstandard only read the first frame.
+            handle.close()
+            raise OSError(f"This version of zstandard can't read \"{path}\"")
+
+    def digest(self, path: str="", hasher=None) -> str:
+        '''
+        Returns the hex digest of the contents of a compressed file.
+            :param hasher: a new hash object, blake2b if it's None.
+            :raises OSError: when it can't be read or isn't valid.
+        '''
+        if hasher is None: hasher = hashlib.blake2b()
+        try:
+            with self.open(path) as handle:
+                for block in iter(lambda: handle.read(2**20), b''): hasher.update(block)
+        except _DATA_ERRORS as e:
+            raise OSError(f"\"{path}\" is not valid {self.name} data: {str(e)}")
+        return hasher.hexdigest()
+
+    def close(self) -> None:
+        if self._pool is not None: self._pool.shutdown(wait=True)
+        self._pool = None
@@ -14,9 +14,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import json, os, configparser, dataclasses, logging, typing
+import json, os, configparser, dataclasses, logging, typing, threading, time
 from pathlib import Path
 
+from iterator import recursivescan, split_path
+
 logger = logging.getLogger("data")
 
 
@@ -62,7 +64,31 @@ class Configuration:
 
         c['BackupBehavior'] = {
             "threadcount": 3,
-            "sourcemapname": "mapfile"
+            "hddthreads": 1, #backups using one spinning disk at once
+            "ssdthreads": 4,
+            "otherthreads": 2,
+            "sourcemapname": "mapfile",
+            "manifestname": "manifest",
+            "fanoutdepth": 4,
+            "progressrate": 10, #status updates per second
+            "fusedprune": "yes", #prune the destinations during the copy instead of walking them again after it.
+            "prunethreads": 4, #threads deleting on each destination device
+            "usetrash": "yes", #move pruned paths to the destination's trash, which is emptied in the background.
+            "trashgracedays": 3, #days pruned paths stay in the trash, where they can be restored, before they are deleted.  0 empties it right away.
+            "checksum": "blake2b", #hashes files while they are copied.  Any hashlib algorithm, or xxh64/xxh3_64/xxh3_128 with xxhash installed.  none turns it off, and lets the kernel copy files to a single destination.
+            "comparecontent": "yes", #compare the contents of files whose modification time changed but size didn't.
+            "hashcache": os.path.join(Configuration.program_home, "hashcache.json"),
+            "hashcachesize": 1000000, #the most file hashes remembered
+            "deltasize": 67108864, #files this big or bigger only have their changed blocks written.  0 turns it off.
+            "deltablocksize": 1048576, #the size of those blocks
+            "tailcopy": "yes", #only copy the new end of files that were appended to, like logs.
+            "snapshots": "no", #write each run into a new snapshot, hard linking the files that didn't change from the last one.
+            "destinationformat": "mirror", #or "chunks":  files are split into chunks, each stored once in the destination's chunk store.
+            "chunksize": 1048576, #the average size of a chunk
+            "compressthreads": 2, #threads compressing a file, for profiles that compress their copies.
+            "resume": "yes", #keep a journal while copying, so a run that was cut short carries on where it stopped next time.
+            "checkpointsize": 67108864, #how often (in bytes) the copy of a large file is synced and recorded in the journal.
+            "sync": "none" #"none", "file" (sync every copy), or "destination" (sync each destination once at the end).  Profiles can override it.
         }
 
         return c
@@ -141,6 +167,8 @@ class BackupProfile:
     sources: list = dataclasses.field(default_factory=list)
     destinations: list = dataclasses.field(default_factory=list)
     ID: int = 0
+    compression: str = "" #the format copies are compressed in (see compression.codec.parse), or "" for none.
+    sync: str = "" #when copies are synced to disk (see recursivecopy.SYNC_POLICIES), or "" for the configuration's setting.
 
     def __str__(self):
         return "Name: " + self.name + \
@@ -201,7 +229,7 @@ class BackupProfile:
         with open(filename, 'w') as file:
             return json.dump(
                 [{"name": p.name, "sources": p.sources,
-                    "destinations": p.destinations, "id": p.ID} for p in profiles],
+                    "destinations": p.destinations, "id": p.ID, "compression": p.compression, "sync": p.sync} for p in profiles],
                 fp=file, indent=4, sort_keys=True)
 
     @staticmethod
@@ -217,7 +245,7 @@ class BackupProfile:
         return []
 
 def _profile_from_dict(profile: dict = {"name": "", "sources": [], "destinations": [], "id": 0}) -> BackupProfile:
-    return BackupProfile(profile["name"], profile["sources"], profile["destinations"], profile["id"])
+    return BackupProfile(profile["name"], profile["sources"], profile["destinations"], profile["id"], profile.get("compression", ""), profile.get("sync", ""))
 
 @dataclasses.dataclass
 class BackupMapping:
@@ -233,11 +261,24 @@ class BackupMapping:
     no intention of making things dificult if for some reason I need to make a minor change.
     This will also make it far easier to add other metadata to a backup should that become necessary
     in the future.
+
+    In snapshot mode each run of a source is written into a folder of its own under
+    "<destination>/.snapshots/<destname>/", named after the time it was made.  The mapping keeps
+    the names of the snapshots that were completed, oldest first.
+
+    When the destinations are chunk stores, the mapping points to the file holding the recipes of
+    each source, relative to the destination folder.
     '''
 
+    SNAPSHOTS = ".snapshots"
+
     #a map of fully qualified source directory names and the basenames of the destination folders.
     sourcemap: typing.Dict[str, str]=dataclasses.field(default_factory=dict)
     backup_id: int = 0
+    #destination basename -> the names of its snapshots, oldest first.
+    snapshots: typing.Dict[str, typing.List[str]]=dataclasses.field(default_factory=dict)
+    #destination basename -> its recipes in a chunk store, relative to the destination folder.
+    recipes: typing.Dict[str, str]=dataclasses.field(default_factory=dict)
 
     def generate_map(self, profile: BackupProfile=None) -> None:
         if profile is None: raise TypeError(f"{BackupMapping.generate_map.__qualname__}: profile argument should not be None type!")
@@ -255,6 +296,8 @@ class BackupMapping:
 
         for source in todelete: del self.sourcemap[source]
         for source in toadd: self.sourcemap[source] = self._new_key()
+        for destname in set(self.snapshots.keys()).difference(set(self.sourcemap.values())): del self.snapshots[destname]
+        for destname in set(self.recipes.keys()).difference(set(self.sourcemap.values())): del self.recipes[destname]
 
     def __getitem__(self, key) -> str:
         '''
@@ -287,6 +330,27 @@ class BackupMapping:
 
         if sourcepath in self.sourcemap.keys(): del self.sourcemap[sourcepath]
     
+    @staticmethod
+    def snapshot_folder(folder: str="", destname: str="") -> str:
+        '''
+        Returns the folder the snapshots of destname are kept in, in the destination folder.
+        '''
+        return os.path.join(folder, BackupMapping.SNAPSHOTS, destname)
+
+    def add_snapshot(self, destname: str="", name: str="") -> None:
+        self.snapshots.setdefault(destname, []).append(name)
+
+    def latest_snapshot(self, folder: str="", destname: str="") -> str:
+        '''
+        ### latest_snapshot(self, folder: str="", destname: str="") -> str
+        Returns the path of the newest snapshot of destname that the destination folder holds, or
+        None if it doesn't hold any.  A destination that missed a run still has an older one.
+        '''
+        for name in reversed(self.snapshots.get(destname, [])):
+            path = os.path.join(BackupMapping.snapshot_folder(folder, destname), name)
+            if os.path.isdir(path): return path
+        return None
+
     def _new_key(self) -> str:
         used_keys = [dest for _,dest in self.sourcemap.items()]
         key = int("0x01", 16)
@@ -304,7 +368,9 @@ class BackupMapping:
         success = False
         if not os.path.isfile(filename) or overwrite:
             with open(filename, 'wt') as file:
-                json.dump(obj={"backupid": self.backup_id, "mapping": self.sourcemap}, fp=file, indent=4, sort_keys=True)
+                json.dump(obj={"backupid": self.backup_id, "mapping": self.sourcemap, "snapshots": self.snapshots, 
+                    "recipes": self.recipes}, 
+                    fp=file, indent=4, sort_keys=True)
                 success = True
                 logger.info(f"Attempted to save mapping to \"{filename}\"  exists = {os.path.exists(filename)}")
         return success
@@ -315,6 +381,8 @@ class BackupMapping:
                 data = json.load(file)
                 self.backup_id = int(data["backupid"])
                 self.sourcemap = dict(data["mapping"])
+                self.snapshots = dict(data.get("snapshots", {}))
+                self.recipes = dict(data.get("recipes", {}))
                 return True
         return False
 
@@ -341,4 +409,329 @@ class BackupMapping:
             if os.path.isdir(folder) and not os.path.islink(folder):
                 path = (folder + os.path.sep + filename)
                 success |= self.save(path, overwrite)
-        return success
\ No newline at end of file
+        return success
+
+@dataclasses.dataclass
+class BackupManifest:
+    '''
+    A record of what a destination folder holds for a single backed up source.  For every file it
+    stores the size, the modification time (in nanoseconds) and the inode of the copy.  Because
+    the modification time of a copy is set to that of its source, the manifest is enough to decide
+    whether a source file has changed without looking at the destination's metadata at all.  That
+    matters a lot when the destination is a slow disk.
+
+    The manifest is saved next to the mapfile in the destination as "<manifestname>.<destname>", where
+    destname is the basename of the folder the source is copied into.  If it is missing (or deleted
+    on purpose) it is rebuilt from the destination tree the next time it is loaded.
+    '''
+
+    #the folder the source is copied into.  All paths in the manifest are relative to it.
+    root: str = ""
+    #relative path -> [size, mtime_ns, inode] or [size, mtime_ns, inode, digest]
+    files: typing.Dict[str, list] = dataclasses.field(default_factory=dict)
+    folders: typing.Set[str] = dataclasses.field(default_factory=set)
+
+    def lookup(self, relpath: str="") -> list:
+        '''
+        ### lookup(self, relpath: str="") -> list
+            :param relpath: the path of a file relative to the manifest's root.
+
+            :returns list|None: [size, mtime_ns, inode] if the file is recorded, otherwise None.  A fourth
+                                element holds the digest when there is one.
+        '''
+        return self.files.get(relpath)
+
+    def digest(self, relpath: str="") -> str:
+        '''
+        Returns the digest recorded for a file as "algorithm:hexdigest", or None if there isn't one.
+        '''
+        record = self.files.get(relpath)
+        if record is None or len(record) < 4: return None
+        return record[3]
+
+    def has_folder(self, relpath: str="") -> bool:
+        return (relpath in self.folders)
+
+    def record(self, relpath: str="", size: int=0, mtime_ns: int=0, inode: int=0, digest: str=None) -> None:
+        self.files[relpath] = [size, mtime_ns, inode] if digest is None else [size, mtime_ns, inode, digest]
+
+    def record_folder(self, relpath: str="") -> None:
+        if len(relpath) > 0: self.folders.add(relpath)
+
+    def forget(self, relpath: str="") -> None:
+        '''
+        ### forget(self, relpath: str="") -> None
+        Removes a path from the manifest.  If it is a folder, everything under it is removed too.
+        '''
+        self.files.pop(relpath, None)
+        if relpath in self.folders:
+            prefix = (relpath + os.path.sep)
+            self.folders = set([f for f in self.folders if f != relpath and not f.startswith(prefix)])
+            for f in [f for f in self.files if f.startswith(prefix)]: del self.files[f]
+
+    def relative(self, path: str="") -> str:
+        '''
+        Returns a destination path relative to the root of this manifest.
+        '''
+        return split_path(self.root, path)[1]
+
+    def rebuild(self) -> None:
+        '''
+        ### rebuild(self) -> None
+        Discards what the manifest holds and records what is actually in the destination tree.
+        '''
+        logger.info(f"Rebuilding the manifest of \"{self.root}\" from the destination tree.")
+        self.files.clear()
+        self.folders.clear()
+        for entry in recursivescan(self.root):
+            if entry.path == self.root: continue
+            if entry.is_dir(follow_symlinks=False):
+                self.record_folder(self.relative(entry.path))
+            elif entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                self.record(self.relative(entry.path), st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def save(self, filename: typing.AnyStr) -> bool:
+        '''
+        ### save(self, filename: str) -> bool
+        Saves the manifest.  It is written to a temporary file which is synced and then renamed
+        over the old one, so a crash leaves either the old manifest or the new one, never half of one.
+            :param filename: the path to the file that this manifest will be saved to.
+
+            :returns bool: True if the file was saved successfully.
+        '''
+        temp = (filename + ".tmp")
+        try:
+            with open(temp, 'wt') as file:
+                json.dump(obj={"version": 1, "files": self.files, "folders": sorted(self.folders)}, fp=file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp, filename)
+        except OSError:
+            logger.exception(f"Failed to save the manifest \"{filename}\"")
+            return False
+        return True
+
+    def load(self, filename: typing.AnyStr) -> bool:
+        if os.path.isfile(filename) and not os.path.islink(filename):
+            try:
+                with open(filename, 'rt') as file:
+                    data = json.load(file)
+                self.files = dict(data["files"])
+                self.folders = set(data["folders"])
+                return True
+            except (OSError, ValueError, KeyError):
+                logger.exception(f"The manifest \"{filename}\" could not be read.  It will be rebuilt.")
+        return False
+
+    @staticmethod
+    def filename(folder: str="", destname: str="", config: Configuration=None) -> str:
+        '''
+        Returns the path of the manifest for destname in the destination folder, or None if
+        manifests are turned off in the configuration.
+        '''
+        name = config["BackupBehavior"]["manifestname"]
+        if len(name) == 0: return None
+        return (folder + os.path.sep + name + "." + destname)
+
+    @staticmethod
+    def for_destination(folder: str="", destname: str="", config: Configuration=None):
+        '''
+        ### for_destination(folder: str="", destname: str="", config: Configuration=None) -> BackupManifest
+        Loads the manifest for destname from a destination folder.  If it can not be loaded it
+        is rebuilt from the destination tree.
+            :param folder: the destination folder (the one holding the mapfile).
+            :param destname: the basename of the folder the source is copied into.
+
+            :returns BackupManifest|None: the manifest, or None if manifests are turned off.
+        '''
+        filename = BackupManifest.filename(folder, destname, config)
+        if filename is None: return None
+        manifest = BackupManifest(root=os.path.join(folder, destname))
+        if not manifest.load(filename):
+            manifest.rebuild()
+        return manifest
+
+@dataclasses.dataclass
+class HashCache:
+    '''
+    Remembers the content hash of files, keyed by the device, inode, size and modification time (in
+    nanoseconds) of the file and the algorithm of the hash.  As long as none of those change the file is never hashed again.  Keys
+    are specific to this computer, so the cache is kept in the program's folder rather than on a
+    destination.
+
+    Only the most recently used entries are kept, at most limit of them.  It can be used from several
+    threads at once.
+    '''
+
+    #key -> hex digest, least recently used first.
+    entries: typing.Dict[str, str] = dataclasses.field(default_factory=dict)
+    limit: int = 1000000
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(st: os.stat_result, checksum: str="blake2b") -> str:
+        return f"{checksum}:{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+    def get(self, st: os.stat_result, checksum: str="blake2b") -> str:
+        '''
+        ### get(self, st: os.stat_result, checksum: str="blake2b") -> str
+            :param st: the stat of the file.
+            :param checksum: the algorithm the digest was made with.
+
+            :returns str|None: the digest recorded for the file as it is now, or None.
+        '''
+        key = HashCache.key(st, checksum)
+        with self._lock:
+            digest = self.entries.pop(key, None)
+            if digest is not None: self.entries[key] = digest
+        return digest
+
+    def put(self, st: os.stat_result, digest: str="", checksum: str="blake2b") -> None:
+        key = HashCache.key(st, checksum)
+        with self._lock:
+            self.entries.pop(key, None)
+            self.entries[key] = digest
+
+    def save(self, filename: typing.AnyStr) -> bool:
+        '''
+        ### save(self, filename: str) -> bool
+        Saves the cache, dropping the least recently used entries beyond the limit.  Written the same way a
+        BackupManifest is, so a crash never leaves half of it.
+            :param filename: the path to the file that this cache will be saved to.
+
+            :returns bool: True if the file was saved successfully.
+        '''
+        with self._lock:
+            for key in list(self.entries.keys())[:max(0, len(self.entries) - self.limit)]: del self.entries[key]
+            entries = dict(self.entries)
+        temp = (filename + ".tmp")
+        try:
+            Path(os.path.dirname(filename)).mkdir(parents=True, exist_ok=True)
+            with open(temp, 'wt') as file:
+                json.dump(obj={"version": 1, "entries": entries}, fp=file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp, filename)
+        except OSError:
+            logger.exception(f"Failed to save the hash cache \"{filename}\"")
+            return False
+        return True
+
+    def load(self, filename: typing.AnyStr) -> bool:
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'rt') as file:
+                    data = json.load(file)
+                with self._lock:
+                    self.entries = dict(data["entries"])
+                return True
+            except (OSError, ValueError, KeyError):
+                logger.exception(f"The hash cache \"{filename}\" could not be read.  Starting a new one.")
+        return False
+
+@dataclasses.dataclass
+class RunJournal:
+    '''
+    A record of how far a backup of one source to one destination got, kept while it runs so that a run
+    that was cancelled or cut short can carry on where it stopped.  It holds the folders that were copied
+    completely, and the large files that were being copied along with the size and modification time (in
+    nanoseconds) of the source and the offset up to which the copy was synced to disk.  The journal is
+    deleted once a run finishes.
+
+    A loaded journal keeps the folders the run it records finished, and when that run started, apart as
+    previous and previous_started_ns.  Only the folders this run finishes are saved, so a folder is never
+    skipped by more than the one run after the run that copied it.
+    '''
+    FOLDER = ".backup-journal"
+
+    filename: str = ""
+    done: typing.Set[str] = dataclasses.field(default_factory=set) #folders, relative to the destination folder
+    partial: typing.Dict[str, typing.List[int]] = dataclasses.field(default_factory=dict) #relative path -> [size, mtime_ns, offset]
+    interval: float = 5.0 #the least number of seconds between saves, unless a save is forced.
+    started_ns: int = dataclasses.field(default_factory=time.time_ns) #when this run started
+    previous: typing.Set[str] = dataclasses.field(default_factory=set) #the folders the last run finished
+    previous_started_ns: int = 0 #when the last run started
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._saved = 0.0
+
+    @staticmethod
+    def path(destination: str="", destname: str="") -> str:
+        return os.path.join(destination, RunJournal.FOLDER, destname + ".json")
+
+    def finish_folder(self, relpath: str="") -> None:
+        with self._lock:
+            self.done.add(relpath)
+
+    def progress(self, relpath: str="", size: int=0, mtime_ns: int=0, offset: int=0) -> None:
+        with self._lock:
+            self.partial[relpath] = [size, mtime_ns, offset]
+
+    def finish_file(self, relpath: str="") -> None:
+        with self._lock:
+            self.partial.pop(relpath, None)
+
+    def resumes(self, relpath: str="", st: os.stat_result=None) -> int:
+        '''
+        Returns the offset a copy of the file at relpath was synced up to, if the source still has the size and
+        modification time it had then.  Otherwise 0.
+        '''
+        with self._lock:
+            record = self.partial.get(relpath)
+        if record is None or record[0] != st.st_size or record[1] != st.st_mtime_ns: return 0
+        return record[2]
+
+    def save(self, force: bool=True) -> bool:
+        '''
+        ### save(self, force: bool=True) -> bool
+        Saves the journal the same way a BackupManifest is saved.  Without force, it is only saved if it
+        wasn't in the last interval seconds.
+
+            :returns bool: False if saving failed.
+        '''
+        if not force and (time.monotonic() - self._saved) < self.interval: return True
+        with self._lock:
+            obj = {"version": 1, "started": self.started_ns, "done": sorted(self.done), "partial": dict(self.partial)}
+            self._saved = time.monotonic()
+        temp = (self.filename + ".tmp")
+        try:
+            Path(os.path.dirname(self.filename)).mkdir(parents=True, exist_ok=True)
+            with open(temp, 'wt') as file:
+                json.dump(obj=obj, fp=file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp, self.filename)
+        except OSError:
+            logger.exception(f"Failed to save the journal \"{self.filename}\"")
+            return False
+        return True
+
+    def load(self) -> bool:
+        try:
+            with open(self.filename, 'rt') as file:
+                data = json.load(file)
+            with self._lock:
+                self.previous = set(data["done"])
+                self.previous_started_ns = int(data["started"])
+                self.partial = dict(data["partial"])
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.exception(f"The journal \"{self.filename}\" could not be read.  Starting from scratch.")
+            return False
+        return True
+
+    def remove(self) -> None:
+        '''
+        Deletes the journal, once the run it records has finished.
+        '''
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.exception(f"Could not delete the journal \"{self.filename}\"")
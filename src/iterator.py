@@ -15,7 +15,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import os, shutil, typing, logging, enum, re, sys
+import os, shutil, typing, logging, enum, re, sys, stat, threading, queue, hashlib, json, collections, errno, ctypes, dataclasses
+import concurrent.futures
+
+from chunkstore import chunker, ChunkStore
+from compression import codec
+
+try:
+    import fcntl
+except ImportError: #windows
+    fcntl = None
+
+try:
+    import xxhash
+except ImportError: #optional, for the xxh checksums
+    xxhash = None
 
 logger = logging.getLogger("filesystem.iterator")
 
@@ -45,41 +59,457 @@ def current_os() -> OsType:
             return systems[expression]
     return OsType.NO_SUPPORT
 
+# ioctl request to clone (reflink) a whole file on copy-on-write filesystems.  Linux only.
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409) if (fcntl is not None and current_os() == OsType.LINUX) else None
+
+# fallocate(2), to punch holes in copies.  Linux only.
+FALLOC_FL_KEEP_SIZE, FALLOC_FL_PUNCH_HOLE = (0x01, 0x02)
+try:
+    _fallocate = ctypes.CDLL(None, use_errno=True).fallocate64 if current_os() == OsType.LINUX else None
+    if _fallocate is not None: _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError):
+    _fallocate = None
+
+# syncfs(2), to sync one filesystem instead of all of them.  Linux only.
+try:
+    _syncfs = ctypes.CDLL(None, use_errno=True).syncfs if current_os() == OsType.LINUX else None
+    if _syncfs is not None: _syncfs.argtypes = [ctypes.c_int]
+except (OSError, AttributeError):
+    _syncfs = None
+
+
+class fsentry:
+    '''
+    A filesystem entry that caches its type and stat information.  It mirrors the
+    interface of os.DirEntry so the two can be used interchangeably.  os.DirEntry can
+    not be constructed for an arbitrary path (the root of a walk, for instance), so this
+    fills that gap.  The stat is taken lazily, and at most once per follow_symlinks value.
+    '''
+
+    def __init__(self, path: str=""):
+        self.path = path
+        self.name = os.path.basename(path)
+        self._lstat = None
+        self._stat = None
+
+    def __fspath__(self) -> str:
+        return self.path
+
+    def __repr__(self) -> str:
+        return f"<{fsentry.__name__} \"{self.path}\">"
+
+    def stat(self, follow_symlinks: bool=True) -> os.stat_result:
+        if not follow_symlinks or not self.is_symlink():
+            if self._lstat is None: self._lstat = os.lstat(self.path)
+            return self._lstat
+        if self._stat is None: self._stat = os.stat(self.path)
+        return self._stat
+
+    def inode(self) -> int:
+        return self.stat(follow_symlinks=False).st_ino
+
+    def is_symlink(self) -> bool:
+        try:
+            if self._lstat is None: self._lstat = os.lstat(self.path)
+        except OSError:
+            return False
+        return stat.S_ISLNK(self._lstat.st_mode)
+
+    def is_dir(self, follow_symlinks: bool=True) -> bool:
+        return self._is_type(stat.S_ISDIR, follow_symlinks)
+
+    def is_file(self, follow_symlinks: bool=True) -> bool:
+        return self._is_type(stat.S_ISREG, follow_symlinks)
+
+    def _is_type(self, test, follow_symlinks: bool) -> bool:
+        try:
+            return test(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+class recursivescan:
+    '''
+    A recursive directory iterator built on os.scandir.  It yields entries (os.DirEntry, or
+    an fsentry for the root) rather than path strings, so the type and stat information
+    gathered while reading a directory can be reused by the caller without any further
+    system calls.
+
+    The order of iteration is identical to that of os.walk (top-down): a folder is
+    returned, followed by all of its non-folder children, followed by each of its sub-folders
+    in turn.  Just like os.walk, symbolic links to folders are not followed, and folders
+    that can not be read are skipped.  <code>onerror(entry: folder, OSError: error)</code> is called
+    for each of those, if it's given.
+
+    <code>onfolder(entry: folder, list: entries)</code> is called with the listing of each folder
+    as it is read, before the folder is returned.
+    '''
+
+    def __init__(self, root_path, onfolder=None, onerror=None):
+        self.root = root_path if isinstance(root_path, fsentry) else fsentry(root_path)
+        self._onfolder = onfolder
+        self._onerror = onerror
+        self.iter = self._walk()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iter)
+
+    def _walk(self):
+        stack = [self.root]
+        while len(stack) > 0:
+            folder = stack.pop()
+            try:
+                with os.scandir(folder.path) as it:
+                    entries = list(it)
+            except OSError as e:
+                if self._onerror is not None: self._onerror(folder, e)
+                continue
+            if self._onfolder is not None: self._onfolder(folder, entries)
+            yield folder
+
+            subfolders = []
+            for entry in entries:
+                try:
+                    isdir = entry.is_dir()
+                except OSError:
+                    isdir = False
+                if not isdir:
+                    yield entry
+                elif not entry.is_symlink():
+                    subfolders.append(entry)
+
+            #pushed in reverse so that the first sub-folder is the next one visited.
+            stack.extend(reversed(subfolders))
+
 
-# This is basically just a wrapper class around os.walk, but it actually
-# iterates over everything.
 class recursive:
     '''
     A recursive directory iterator, the first element of which is the root_path
-    being iterated over.
+    being iterated over.  This yields path strings.  Use recursivescan if you want
+    the entries themselves.
     '''
 
     def __init__(self, root_path):
-        self.iter = os.walk(root_path)
-        self.returned_parent = False
-        self.files = None
-        self.files_pos = 0
-        self.dirs = None
-        self.path = None
+        self.iter = recursivescan(root_path)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if self.files is not None:
-            if self.files_pos >= len(self.files):
-                self.returned_parent = False
-        if not self.returned_parent:
-            self.path, self.dirs, self.files = next(self.iter)
-            if self.files is not None:
-                self.returned_parent = True
-                self.files_pos = 0
-            return self.path
-        elif self.files is not None:
-            if self.files_pos < len(self.files):
-                s = os.path.join(self.path, self.files[self.files_pos])
-                self.files_pos += 1
-                return s
+        return next(self.iter).path
+
+
+class bufferpool:
+    '''
+    A pool of preallocated buffers for the copy loop.  Reading into a recycled buffer instead
+    of allocating a new bytes object for every block keeps the memory use of a backup flat, no
+    matter how many files, threads, or destinations are involved.  The pool is thread safe.
+    '''
+    def __init__(self, size: int=((2**20) * 10), keep: int=8):
+        '''
+        :param size: the size of each buffer in bytes.
+        :param keep: the maximum number of idle buffers held on to.  More than this can be
+                     handed out at once; the extra ones are dropped when they come back.
+        '''
+        self.size = size
+        self.keep = keep
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        with self._lock:
+            if len(self._free) > 0: return self._free.pop()
+        return bytearray(self.size)
+
+    def release(self, buffer: bytearray=None) -> None:
+        with self._lock:
+            if len(self._free) < self.keep: self._free.append(buffer)
+
+# the buffers shared by every copy operation.  10 megabytes each.
+BUFFERS = bufferpool()
+
+
+def new_checksum(name: str=""):
+    '''
+    ### new_checksum(name: str)
+    Returns a new hash object for the named algorithm.  Any algorithm hashlib knows is accepted, as well as
+    "xxh64", "xxh3_64" and "xxh3_128" when the xxhash module is installed.
+        :raises ValueError: when the algorithm is not available.
+    '''
+    if name.startswith("xxh"):
+        if xxhash is None: raise ValueError(f"The checksum \"{name}\" needs the xxhash module, which is not installed.")
+        if not hasattr(xxhash, name): raise ValueError(f"Unknown checksum: \"{name}\"")
+        return getattr(xxhash, name)()
+    return hashlib.new(name)
+
+def file_digest(path: str="", checksum: str="blake2b") -> str:
+    '''
+    ### file_digest(path: str, checksum: str="blake2b") -> str
+    Returns the hex digest of a file's contents.  Reads into a pooled buffer, and since hashlib
+    lets go of the GIL while it hashes, files can be hashed on several threads at once.
+        :param checksum: the algorithm, see new_checksum.
+
+        :raises OSError: when the file can not be read.
+        :raises ValueError: when the algorithm isn't available.
+    '''
+    digest = new_checksum(checksum)
+    buffer = BUFFERS.acquire()
+    try:
+        with memoryview(buffer) as view, open(path, 'rb') as file:
+            while True:
+                count = file.readinto(buffer)
+                if not count: break
+                digest.update(view[:count])
+    finally:
+        BUFFERS.release(buffer)
+    return digest.hexdigest()
+
+def data_extents(fd: int=-1, size: int=0) -> list:
+    '''
+    ### data_extents(fd: int, size: int) -> list
+    Returns the (start, end) ranges of the first size bytes of a file that hold data, found with SEEK_DATA
+    and SEEK_HOLE.  Everything else is a hole.  Moves the position of fd.
+
+        :returns list: the ranges in order, or None if the platform or the filesystem can't tell.
+    '''
+    if not hasattr(os, "SEEK_DATA"): return None
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO: break #there is only a hole after offset.
+                raise
+            if start >= size: break
+            end = min(size, os.lseek(fd, start, os.SEEK_HOLE))
+            extents.append((start, end))
+            offset = end
+    except OSError:
+        return None
+    return extents
+
+def punch_hole(fd: int=-1, offset: int=0, length: int=0) -> bool:
+    '''
+    Deallocates a range of a file without changing its size.  The range reads as zeros afterwards.
+    Returns False where that isn't supported, in which case the zeros have to be written.
+    '''
+    if _fallocate is None or length <= 0: return False
+    return _fallocate(fd, (FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE), offset, length) == 0
+
+def sync_filesystem(path: str="") -> bool:
+    '''
+    Writes everything cached for the filesystem path is on to disk.  Where syncfs isn't there every
+    filesystem is synced.  Returns False if it failed.
+    '''
+    if _syncfs is None:
+        if not hasattr(os, "sync"): return False
+        os.sync()
+        return True
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        return _syncfs(fd) == 0
+    finally:
+        os.close(fd)
+
+def sync_folder(path: str="") -> None:
+    '''
+    Syncs a folder, so that the names made or replaced in it last through a crash.  Does nothing on Windows.
+        :raises OSError: when it fails.
+    '''
+    if current_os() == OsType.WINDOWS: return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+_ZEROS = b''
+def zeros(size: int=0) -> memoryview:
+    '''
+    Returns size zero bytes, without allocating them every time.
+    '''
+    global _ZEROS
+    if len(_ZEROS) < size: _ZEROS = bytes(size)
+    return memoryview(_ZEROS)[:size]
+
+class pooledblock:
+    '''
+    A block read into a buffer from a bufferpool, shared by a number of writers.  The buffer
+    goes back to the pool once every writer has released the block.
+    '''
+    def __init__(self, pool: bufferpool=None, users: int=1):
+        self.pool = pool
+        self.buffer = pool.acquire()
+        self.data = None #a memoryview of the part of the buffer holding the block
+        self._users = users
+        self._lock = threading.Lock()
+
+    def release(self, count: int=1) -> None:
+        with self._lock:
+            self._users -= count
+            if self._users > 0 or self.buffer is None: return
+            buffer, self.buffer = self.buffer, None
+        if self.data is not None: self.data.release()
+        self.pool.release(buffer)
+
+
+class blockwriter(threading.Thread):
+    '''
+    A thread that writes the pooledblocks put into its bounded queue to a single destination file,
+    releasing each one once it is written.
+    Putting None into the queue finishes it.  When a write fails the error is kept, the file
+    is closed, and any blocks that follow are thrown away so whoever is feeding the queue never
+    waits on a destination that is no longer being written.
+    '''
+    def __init__(self, handle, path: str="", write=None, depth: int=4, onwrite=None):
+        '''
+        :param handle:  the destination's handle.
+        :param path:    the destination's path, for error reporting.
+        :param write:   write(handle, data) -> recursivecopy.UnexpectedError
+        :param depth:   the maximum number of blocks waiting to be written.
+        :param onwrite: onwrite(path, byte_count), called after each successful write.
+        '''
+        super(blockwriter, self).__init__(daemon=True)
+        self.handle = handle
+        self.path = path
+        self.error = None
+        self.exception = None
+        self._write = write
+        self._onwrite = onwrite
+        self._queue = queue.Queue(maxsize=depth)
+
+    def put(self, data) -> None:
+        self._queue.put(data)
+
+    def failed(self) -> bool:
+        return (self.error is not None) or (self.exception is not None)
+
+    def run(self):
+        while True:
+            block = self._queue.get()
+            if block is None: break
+            if self.failed():
+                block.release()
+                continue
+            try:
+                self.error = self._write(self.handle, block.data)
+                if self.error is None and self._onwrite is not None: self._onwrite(self.path, len(block.data))
+            except Exception as e:
+                #handed to the reading thread, which raises it.
+                self.exception = e
+            finally:
+                block.release()
+            if self.error is not None:
+                self.error.path = self.path
+                if not self.handle.closed: self.handle.close()
+
+
+class blockmap:
+    '''
+    The digests of the blocks of a copy, kept in the destination so that when a large file changes only
+    the blocks that differ have to be written again.  Maps are stored under FOLDER at the top of the
+    destination, laid out like the copies themselves:  the map of "<dest>/<destname>/a/b.img" is
+    "<dest>/.backup-blockmaps/<destname>/a/b.img".  A map is only trusted while the size, modification
+    time and inode of its copy are what they were when it was saved, so anything else writing to the
+    copy makes the next update a full one.
+    '''
+    FOLDER = ".backup-blockmaps"
+
+    def __init__(self, blocksize: int=(2**20), size: int=0, mtime_ns: int=0, inode: int=0, blocks: list=None):
+        self.blocksize = blocksize
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.inode = inode
+        self.blocks = [] if blocks is None else blocks #hex digests, one per block.
+
+    @staticmethod
+    def digest(data) -> str:
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    @staticmethod
+    def path(root: str="", relpath: str="") -> str:
+        '''
+        Returns the path of the map for the copy at relpath under root, the folder a source is copied into.
+        '''
+        return os.path.join(os.path.dirname(root), blockmap.FOLDER, os.path.basename(root), relpath)
+
+    def matches(self, st: os.stat_result=None, blocksize: int=0) -> bool:
+        '''
+        Returns True if the map still describes the copy st was taken of, in blocks of blocksize.
+        '''
+        return (self.blocksize == blocksize and self.size == st.st_size and self.mtime_ns == st.st_mtime_ns 
+            and self.inode == st.st_ino and len(self.blocks) == -(-st.st_size // blocksize))
+
+    def changed(self, index: int=0, digest: str="") -> bool:
+        return (index >= len(self.blocks)) or (self.blocks[index] != digest)
+
+    @staticmethod
+    def load(path: str=""):
+        '''
+        ### load(path: str) -> blockmap
+        Returns the map saved at path, or None if there isn't one that can be read.
+        '''
+        try:
+            with open(path, 'rt') as file:
+                data = json.load(file)
+            return blockmap(data["blocksize"], data["size"], data["mtime_ns"], data["inode"], list(data["blocks"]))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.warning(f"The block map \"{path}\" could not be read, the copy will be written in full.")
+            return None
+
+    def save(self, path: str="") -> bool:
+        temp = (path + ".tmp")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp, 'wt') as file:
+                json.dump(obj={"version": 1, "blocksize": self.blocksize, "size": self.size, "mtime_ns": self.mtime_ns, 
+                    "inode": self.inode, "blocks": self.blocks}, fp=file)
+            os.replace(temp, path)
+        except OSError:
+            logger.exception(f"Failed to save the block map \"{path}\"")
+            return False
+        return True
+
+    @staticmethod
+    def forget(root: str="", relpath: str="") -> None:
+        '''
+        Deletes the map of the copy at relpath under root, or every map under it if it was a folder.
+        '''
+        path = blockmap.path(root, relpath)
+        try:
+            if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path, ignore_errors=True)
+            else: os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.exception(f"Failed to delete the block map \"{path}\"")
+
+
+@dataclasses.dataclass
+class copyoptions:
+    '''
+    How a recursivecopy copies files.  The same for every file of a run, so Backup builds them once from the
+    configuration.
+    '''
+    fanoutdepth: int = 4 #blocks queued for each destination's writer thread.  0 writes to the destinations one after another.
+    checksum: str = None #the algorithm files are hashed with as they are copied (see new_checksum).  None or "none" turns it off.
+    deltasize: int = 0 #files this big or bigger are updated block by block, using a blockmap.  0 turns it off.
+    deltablock: int = (2**20) #the size of those blocks, no larger than a pooled buffer.
+    tailcopy: bool = False #copy only the new end of files that were appended to.
+    chunksize: int = (2**20) #the average size of a chunk, when writing to chunk stores.
+    compression: codec = None #compresses the copies of the files it compresses.
+    checkpoint: int = (2**26) #the bytes between the checkpoints of a large file, when there are journals.
+    sync: str = "none" #when copies are synced to disk.  One of recursivecopy.SYNC_POLICIES.
 
 
 class recursivecopy:
@@ -93,15 +523,30 @@ class recursivecopy:
     It is expected that if /a/b/c is copied into /z, then the result should
     be /z/c/*, where * represents the contents of /a/b/c.
 
-    An optional argument <code>predicate(str: source_path, str: source_destination)</code> can 
-    be used to define the condition under which a copy operation proceeds.
+    An optional argument <code>predicate(entry: source, str: source_destination)</code> can 
+    be used to define the condition under which a copy operation proceeds.  The source is
+    passed as an entry (see recursivescan) so the predicate can use its cached stat.
     By applying a predicate you can do things like skip files that have not 
     changed, or only copy a specific type of file.
 
     Occassionally a path will be skipped.  This can happend when the predicate returns False or
     when no destinations are specified.  In this case the iterator will return None.
+
+    <code>oncopied(entry: source, str: destination, dict: details)</code> is called after every successful
+    copy to a destination.  For files, details holds the "inode" of the new copy, and its "digest" as
+    "name:hexdigest" when files are hashed.  The number of bytes written to each destination is kept in
+    bytes_written, keyed by the destination folder.
+
+    A file copied from scratch is written under a temporary name (ending in TEMP_SUFFIX), which replaces
+    the copy once it is whole.  How large, sparse, appended to and compressed files are copied is set by
+    the copyoptions; see the methods that copy them.
     '''
-    def __init__(self, root_path, destination_folders, predicate=None, newdestname: str=None):
+    TEMP_SUFFIX = ".backup-tmp"
+    SYNC_POLICIES = ("none", "file", "destination")
+
+    def __init__(self, root_path, destination_folders, predicate=None, newdestname: str=None, oncopied=None,
+        onprogress=None, onstale=None, recorded=None, linkfrom: list=None, recipes: list=None, journals: list=None,
+        options: copyoptions=None, stopped=None):
         '''
         Initializes the copy iterator.
 
@@ -109,16 +554,27 @@ class recursivecopy:
             :param root_path (string):                 the folder you want to copy.  Also called the "source" folder.
             :param destination_folders (list<string>): a list of destination folders (or a string representing the 
                                                        path to a single destination)
-            :param predicate:                          A function with the signature
-                                                       predicate(str: sourcePath, str: sourceDestination)
+            :param predicate:                          predicate(entry: source, str: sourceDestination)
+            :param oncopied:                           oncopied(entry: source, str: destination, dict: details)
+            :param onprogress:                         onprogress(int: byte_count), called as the data of a file is copied.
+            :param onstale:                            onstale(str: path).  Prunes the destinations during the copy (see _compare_folder).
+            :param recorded:                           recorded(str: destination) -> str, the digest recorded for a copy (see _appended).
+            :param linkfrom (list<string>):            writes snapshots, linking from the previous one of each destination folder (see _link_previous).
+            :param recipes (list<RecipeBook>):         writes to chunk stores instead of copying (see _store_fsobject).
+            :param journals (list<RunJournal>):        carries on with a run that was cut short (see _resumed).
+            :param options (copyoptions):              how files are copied.  The defaults if it's None.
+            :param stopped:                            stopped() -> bool, asked before each block of a file is copied.  Once it's
+                                                       true the file is left where it got to (see _read_file).
         
         ### Exceptions
             :raises AttributeError:              when an argument passed does not conform to what was expected.
             :raises NotADirectoryError:          When an argument passed is not a directory.  All arguments are expected to be directories.
             :raises ValueError:                  When the typing of an argument to this function is not an array of strings or a snigle string.
             :raises shutil.SameFileError:        When any of the arguments are duplicates.
+            :raises ValueError:                  When the checksum algorithm isn't available, or sync isn't one of SYNC_POLICIES.
 
         '''
+        if options is None: options = copyoptions()
         if (root_path is None) or (destination_folders is None):
             raise AttributeError("recursivecopy: invalid arguments")
         if not os.path.isdir(root_path):
@@ -142,12 +598,53 @@ class recursivecopy:
                     destinations given is a path under the source.""")
         self._source = root_path
         self._destinations = [os.path.join(d, os.path.basename(self._source) if newdestname is None else newdestname) for d in destination_folders]
-        self.iter = recursive(self._source)
+        if options.sync not in recursivecopy.SYNC_POLICIES: raise ValueError(f"recursivecopy: unknown sync policy \"{options.sync}\"")
+        self._sync = options.sync
+        self._onstale = onstale
+        self._journals = dict(zip(self._destinations, journals)) if journals is not None else {}
+        self._checkpoint_size = max(1, options.checkpoint)
+        self._checkpoints = {} #destination -> the offset of the next checkpoint of the file being copied
+        self._checkpointed = None #(relative path, stat) of the file being copied, while it is checkpointed.
+        #folders the last run finished, according to every journal.
+        self._done = set.intersection(*[set(j.previous) for j in self._journals.values()]) if len(self._journals) > 0 else set()
+        self._done_since = min([j.previous_started_ns for j in self._journals.values()], default=0)
+        self.folders_skipped = 0
+        self._quiet = set() #finished folders nothing in changed since, whose files are passed over.
+        self._open_folders = [] #the folders being walked, outermost first.
+        self._failed_folders = set() #walked folders something in which failed to copy.
+        self._books = dict(zip(self._destinations, recipes)) if recipes is not None else None
+        self._unread = [] #errors of the folders that could not be read since the last call to __next__
+        self.iter = recursivescan(self._source, onfolder=(None if onstale is None and len(self._done) == 0 else self._read_folder),
+            onerror=(None if self._books is None else self._unreadable))
         self._predicate = predicate
+        self._predicate_name = getattr(predicate, "__qualname__", type(predicate).__qualname__)
+        self._oncopied = oncopied
+        self._copied_inodes = {}
+        self._checksum = options.checksum if options.checksum and options.checksum.lower() != "none" else None
+        if self._checksum is not None: new_checksum(self._checksum)
+        self._digest = None
+        self._delta_size = options.deltasize
+        self._delta_block = max(1, min(options.deltablock, BUFFERS.size))
+        self._blocks = None #the digests of the blocks of the file being copied in blocks.
+        self._zero_digests = {} #block size -> the blockmap digest of a block of zeros
+        self._tailcopy = options.tailcopy
+        self._recorded = recorded
+        self._previous = dict([(d, p) for d, p in zip(self._destinations, linkfrom) if p is not None]) if linkfrom is not None else {}
+        self._snapshot = (linkfrom is not None)
+        self.files_linked = 0
+        self._chunker = chunker(options.chunksize)
+        self._codec = options.compression
+        self._fanout_depth = options.fanoutdepth
+        self._onprogress = onprogress
+        self._stopped = stopped
+        self.bytes_written = dict([(d, 0) for d in self._destinations])
+        self._made_folders = set() #folders we know exist at the destination.  Saves a stat per file.
+        self.current = None
+        self.current_entry = None
 
         # log the type of predicate used
         if predicate is not None:
-            logger.warning("conditional predicate passed to recursivecopy: " + self._predicate.__qualname__)
+            logger.warning("conditional predicate passed to recursivecopy: " + self._predicate_name)
 
     def __iter__(self):
         return self
@@ -155,8 +652,84 @@ class recursivecopy:
     def __next__(self):
         if len(self._destinations) == 0:
             raise StopIteration()
-        self.current = next(self.iter)
-        return self._copy_fsobject(self.current, self._destinations)
+        try:
+            self.current_entry = next(self.iter)
+        except StopIteration:
+            if len(self._unread) == 0: raise
+            self.current_entry = None
+        self.current = self._source if self.current_entry is None else self.current_entry.path
+        unread, self._unread = (self._unread, [])
+        if self.current_entry is None: return unread
+        if len(self._journals) == 0: return unread + self._copy_fsobject(self.current_entry, self._destinations)
+
+        relpath = split_path(self._source, self.current)[1]
+        self._close_folders(relpath)
+        errors = unread + ([] if self._passed_over(self.current_entry) else self._copy_fsobject(self.current_entry, self._destinations))
+        if errors: self._failed_folders.update(self._open_folders)
+        if self.current_entry.is_dir() and not self.current_entry.is_symlink(): self._open_folders.append(relpath)
+        return errors
+
+    def _unreadable(self, folder, e: OSError) -> None:
+        '''
+        onerror callback for recursivescan, when the destinations are chunk stores.  Everything the books have
+        under a source folder that can't be read is kept, so a folder that can't be listed for a moment doesn't
+        lose its recipes to the sweep.  The error is returned by the next call to __next__.
+        '''
+        logger.error(f"{recursivecopy._unreadable.__qualname__}: could not read \"{folder.path}\": {str(e)}")
+        relpath = split_path(self._source, folder.path)[1]
+        for book in self._books.values(): book.keep_folder(relpath)
+        if isinstance(e, PermissionError):
+            self._unread.append(recursivecopy.AccessDeniedError(f"Permission error encountered while reading from source \"{folder.path}\"", e, folder.path))
+        else:
+            self._unread.append(recursivecopy.UnexpectedError(f"Could not read \"{folder.path}\"", e))
+
+    def _read_folder(self, folder, entries: list=[]) -> None:
+        '''
+        onfolder callback for recursivescan.  Prunes the destinations during the copy, and notes the finished
+        folders whose files can be passed over.
+        '''
+        if self._onstale is not None: self._compare_folder(folder, entries)
+        if len(self._done) > 0 and self._finished(folder, entries): self._quiet.add(folder.path)
+
+    def _finished(self, folder, entries: list=[]) -> bool:
+        '''
+        Returns True for a folder the last run finished, as long as neither it nor the files in its listing were
+        modified or had their status changed since that run started.  Its sub-folders aren't looked into, the walk
+        gets to them.  The stats are cached in the entries, so copying what did change doesn't take them again.
+        '''
+        if split_path(self._source, folder.path)[1] not in self._done: return False
+        try:
+            st = folder.stat(follow_symlinks=False)
+            if max(st.st_mtime_ns, st.st_ctime_ns) >= self._done_since: return False
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False): continue
+                st = entry.stat(follow_symlinks=False)
+                if max(st.st_mtime_ns, st.st_ctime_ns) >= self._done_since: return False
+        except OSError:
+            return False
+        self.folders_skipped += 1
+        return True
+
+    def _passed_over(self, entry) -> bool:
+        '''
+        Returns True for a file in a finished folder nothing in changed since the last run started.
+        '''
+        if len(self._quiet) == 0 or (entry.is_dir() and not entry.is_symlink()): return False
+        return os.path.dirname(entry.path) in self._quiet
+
+    def _close_folders(self, relpath: str="") -> None:
+        '''
+        Records the folders being walked that relpath is not under in the journals.  The walk is depth first, so
+        everything in them has been copied.  Folders something failed to copy in are left out, and so is the source.
+        '''
+        while len(self._open_folders) > 0:
+            folder = self._open_folders[-1]
+            if len(folder) == 0 or relpath.startswith(folder + os.path.sep): return
+            self._open_folders.pop()
+            if folder in self._failed_folders: continue
+            for journal in self._journals.values():
+                journal.finish_folder(folder)
+                journal.save(force=False)
 
     def getCurrentPath(self):
         '''
@@ -169,10 +742,10 @@ class recursivecopy:
     # errors are returned as an array of errors.
     # Returns:
     # [UnexpectedError]
-    def _copy_fsobject(self, source_path: str, destination_folders: list):
+    def _copy_fsobject(self, source, destination_folders: list):
         '''
-        ### _copy_fsobject(self, source_path: str, destination_folders: list) -> List[recursivecopy.UnexpectedError]
-            :param source_path: A fully qualified path to the source
+        ### _copy_fsobject(self, source, destination_folders: list) -> List[recursivecopy.UnexpectedError]
+            :param source: The source entry (os.DirEntry or fsentry), or a fully qualified path to the source
             :param List[destination_folders]: A list of fully qualified paths representing destination directories that the source will be copied into.
 
             :returns List[recursivecopy.UnexpectedError]: A list of any errors that occured during the operation(s).
@@ -201,22 +774,37 @@ class recursivecopy:
             return [recursivecopy.NothingWasDoneError("Destination folders had a length of zero.  Returned from \
                 copy immediately.")]
         
+        if isinstance(source, str): source = fsentry(source)
+        source_path = source.path
+        relative_path = split_path(self._source, source_path)[1]
+        if self._books is not None: return self._store_fsobject(source, relative_path)
+        compress = self._compresses(source)
+        if compress: relative_path += self._codec.suffix
+
         # first if the predicate is set, filter our destinations so that we are only going
         # to copy what we want.
         if self._predicate is not None:
-            tempdlist = [x for x in destination_folders if self._predicate(source_path, 
-                os.path.join(x, split_path(self._source, source_path)[1]))]
-            
-            destination_folders = tempdlist #we'll need this (tempdlist) if we need to log what we are not backup up
+            tempdlist = [x for x in destination_folders if self._predicate(source, os.path.join(x, relative_path))]
 
             # purely for logging purposes, we gather information on what paths were removed from the
             # list of destinations and log that.  That's good info... yum yum
             if logging.getLogger().level == logging.DEBUG: # do this only if the log level is debug
                 excluded = [ex for ex in destination_folders if ex not in tempdlist]
                 if len(excluded) > 0:
-                    logger.debug(self._predicate.__qualname__ +
+                    logger.debug(self._predicate_name +
                                 " ruled out operations for source[\"" + source_path + "\"] to " +
                                 "destinations " + str(excluded))
+            
+            # a snapshot holds everything:  its folders are always made, and what didn't change is linked.
+            if self._snapshot:
+                if source.is_dir() and not source.is_symlink(): tempdlist = destination_folders
+                else: tempdlist += [d for d in destination_folders if d not in tempdlist and not self._link_previous(source, d, relative_path, compress)]
+
+            # a copy that was cut short can look up to date.  Its journal knows better.
+            if len(self._journals) > 0 and not compress:
+                tempdlist += [d for d in destination_folders if d not in tempdlist and relative_path in self._journals[d].partial]
+
+            destination_folders = tempdlist
 
         # return if we aren't going to copy anything.
         if len(destination_folders) == 0:
@@ -228,20 +816,25 @@ class recursivecopy:
         # we construct the new destination path if the source currently being iterated over is not the same
         # as the root source path.
         if source_path != self._source:
-            new_dests = [os.path.join(d, split_path(self._source, source_path)[1]) for d in destination_folders]
+            new_dests = [os.path.join(d, relative_path) for d in destination_folders]
         
-        #now we make sure that the source path is somthing we are programmed to copy:
-        if os.path.isdir(source_path) or os.path.isfile(source_path) or os.path.islink(source_path):
+        #now we make sure that the source path is somthing we are programmed to copy.  The entry
+        #caches its type so none of these checks touch the disk more than once.
+        isfile = (source.is_file() or source.is_symlink())
+        if isfile or source.is_dir():
 
             # Make sure that if the parent directory of our destination doesn't exist, 
             # that we create it and all intermediate directories.
             for dest in new_dests: self._make_parent_folders(dest)
             
             #next copy them.
-            if os.path.isfile(source_path) or os.path.islink(source_path):
-                operation_results.extend(self._copy_file(source_path, new_dests))
-            elif os.path.isdir(source_path):
-                operation_results.extend(self._copy_folder(source_path, new_dests))
+            if isfile:
+                errors = self._copy_file(source, new_dests, compress)
+                if len(errors) > 0: self._discard_temps(new_dests)
+            else:
+                errors = self._copy_folder(source, new_dests)
+            operation_results.extend(errors)
+            self._notify_copied(source, new_dests, errors)
         else:
             logger.error(f"{self._copy_fsobject.__qualname__}: Source is neither " + 
                 f"a file nor a folder.  Source = [\"{source_path}\"]")
@@ -256,21 +849,30 @@ class recursivecopy:
     # 
     # Returns: an array containing recursivecopy.UnexpectedErrors that contains
     # all errors that occured.
-    def _copy_file(self, source: str, destinations: list = []):
+    def _copy_file(self, source, destinations: list = [], compress: bool=False):
         '''
-        ### _copy_file(self, source: str, destinations: list = []) -> [[bool, recursivecopy.UnexpectedError]]
-            :param source: the source path.  A fully qualified path.
+        ### _copy_file(self, source, destinations: list = [], compress: bool=False) -> [[bool, recursivecopy.UnexpectedError]]
+            :param source: the source entry, or a fully qualified path.
             :param destinations: fully qualified destinations.  (representing the new filenames)
+            :param compress: write the copies compressed with the codec passed as compression.
 
             :returns [recursivecopy.UnexpectedError]: an array of results.
         '''
         if isinstance(destinations, str):
             destinations = [destinations]
-        if not os.path.isfile(source):
+        if isinstance(source, str): source = fsentry(source)
+        sourceentry = source
+        source = sourceentry.path
+        self._copied_inodes = {}
+        self._digest = None
+        self._blocks = None
+        self._checkpointed = None
+        if not sourceentry.is_file():
             logger.error(f"{recursivecopy._copy_file.__qualname__}: [\"{source}\"] path is not a file.")
             return [recursivecopy.PathNotWorkingError("The source path argument is not a file!", source)]
+        compress = compress and (self._codec is not None)
         
-        checkresult = self._check_dest_rectified(source, destinations)
+        checkresult = self._check_dest_rectified(source, [(d[:-len(self._codec.suffix)] if compress else d) for d in destinations])
         if len(checkresult) > 0:
             logger.error(f"{recursivecopy._copy_file.__qualname__}: a check for destination rectification to the new path's destination failed.")
             return checkresult
@@ -279,109 +881,930 @@ class recursivecopy:
         #----------------------------
         # perform the copy operation.
         #----------------------------
-        do_continue = False
-        
         # open the source file
-        ophandle, opsuccess, opresult = self._open_file(source, 'rb')
-        sourcefile = None
+        sourcefile, opsuccess, opresult = self._open_file(source, 'rb')
         if not opsuccess: return [opresult]
-        sourcefile = ophandle
 
-        #Open all the destination files.
-        dest_files = []
-        for dest in destinations:
+        sourcesize = sourceentry.stat().st_size
+        hasher = new_checksum(self._checksum) if self._checksum is not None else None
+        relpath = split_path(self._source, source)[1]
+        checkpointed = (len(self._journals) > 0) and (sourcesize >= self._checkpoint_size) and not compress
+        dest_files = [] #[[fileHandle, error, pathstring]]
+        # Whatever happens from here on, every handle is closed on the way out.
+        try:
+            # A large file whose copy was cut short carries on from the last checkpoint the journals recorded.
+            prefix = 0
+            resumed = False
+            if checkpointed:
+                prefix = self._resumed(sourcefile, sourceentry, relpath, destinations, hasher)
+                if prefix == 0:
+                    if hasher is not None: hasher = new_checksum(self._checksum)
+                    sourcefile.seek(0)
+                else:
+                    logger.info(f"Resuming the copy of [\"{source}\"] at {prefix} bytes.")
+                    self._progress(prefix)
+                    resumed = True
+
+            # Large files are updated in place where a block map says what the copy holds.
+            delta = (self._delta_size > 0) and (sourcesize >= self._delta_size) and not compress and prefix == 0
+            maps = dict([(dest, self._load_blockmap(dest)) for dest in destinations]) if delta else {}
+
+            # A file that was appended to only needs its new end copied.
+            if self._tailcopy and not delta and not compress and prefix == 0:
+                prefix = self._appended(sourcefile, sourcesize, destinations, hasher)
+                if prefix == 0:
+                    if hasher is not None: hasher = new_checksum(self._checksum)
+                    sourcefile.seek(0)
+                else:
+                    logger.debug(f"Copying the last {sourcesize - prefix} bytes of [\"{source}\"], the rest is unchanged.")
+                    self._progress(prefix)
+
+            # Only the data of a sparse file is copied.  Compressed copies are left to the compressor.
+            extents = None
+            if not compress and prefix == 0 and self._sparse(sourceentry):
+                extents = data_extents(sourcefile.fileno(), sourcesize)
+                sourcefile.seek(0)
+            if checkpointed and extents is None:
+                self._checkpointed = (relpath, sourceentry.stat())
+                self._checkpoints = dict([(dest, prefix + self._checkpoint_size) for dest in destinations])
+
+            # A copy made from scratch is written under a temporary name, and replaces the old one once it's whole.
+            targets = dict([(dest, (self._temp_of(dest) if resumed or (maps.get(dest) is None and prefix == 0) else dest)) for dest in destinations])
+
+            #Open all the destination files.
+            for dest in destinations:
+                dhandle, dsuccess, dresult = self._open_file(targets[dest], ('r+b' if (maps.get(dest) is not None or prefix > 0) else 'wb'))
+                if dsuccess and prefix > 0: dhandle.seek(prefix)
+                dest_files.append([(dhandle if dsuccess else None), (None if dsuccess else dresult), dest])
+
+            logger.debug(f"Copying [\"{source}\"] -> {str(destinations)}")
+            if(sourcesize > (2**30)): #greater than 1GB
+                logger.warning("Largefile, will take some time.")
+            rerror = self._write_copies(sourcefile, dest_files, hasher, sourcesize, prefix, maps if delta else None, extents, compress)
+            if isinstance(rerror, recursivecopy.StoppedError):
+                logger.info(f"The copy of [\"{source}\"] was stopped at {sourcefile.tell()} bytes.")
+                return [rerror]
+            if rerror is not None:
+                logger.error("READ ERROR OCCURRED!")
+                #return the error(s).  We can't do anything now.
+                return ([error for _,error,_ in dest_files if error is not None] + [rerror])
+
+            # the write operations are complete.  Take note of the inode of each new copy while we have it open:
+            for dest_file in dest_files:
+                handle, error, dest = dest_file
+                if handle is not None and not handle.closed and error is None:
+                    inode = os.fstat(handle.fileno()).st_ino
+                    if self._sync == "file": dest_file[1] = self._fsync(handle, dest)
+                    if dest_file[1] is None: self._copied_inodes[dest] = inode
+        finally:
+            for handle,_,_ in dest_files:
+                if handle is not None: handle.close()
+            sourcefile.close()
+
+        if hasher is not None: self._digest = f"{self._checksum}:{hasher.hexdigest()}"
+
+        logger.debug(f"Copying stat info for source [\"{source}\"] to destinations: {str(destinations)}")
+        # now we need to copy over all the attributes.  Only destinations we actually
+        # opened are candidates, so there is no need to ask the filesystem whether they exist.
+        for dest_file in dest_files:
+            handle, error, dest = dest_file
+            if handle is not None and error is None:
+                try:
+                    self._copy_stat(sourceentry, targets[dest])
+                except: # noqa E722
+                    logger.exception(f"\n\n\n{recursivecopy._copy_file.__qualname__}: UNHANDLED EXCEPTION!\n\n\n")
+                    raise
+                if targets[dest] != dest:
+                    dest_file[1] = self._replace(targets[dest], dest)
+                    if dest_file[1] is not None:
+                        self._copied_inodes.pop(dest, None) #the copy never made it into place.
+                        continue
+                if self._blocks is not None: self._save_blockmap(dest)
+                if checkpointed: self._journal_of(dest).finish_file(relpath)
+        self._checkpointed = None
+        return [error for _,error,_ in dest_files if error is not None]
+
+    def _write_copies(self, sourcefile, dest_files: list, hasher=None, sourcesize: int=0, prefix: int=0, maps: dict=None,
+        extents: list=None, compress: bool=False):
+        '''
+        ### _write_copies(self, sourcefile, dest_files: list, hasher, sourcesize: int, prefix: int, maps: dict, extents: list, compress: bool) -> recursivecopy.UnexpectedError
+        Writes the source to the destinations that were opened, the way that suits it:  block by block
+        when there are block maps, only the data of a sparse file, compressed, by the kernel, fanned out
+        to a writer per destination, or one block at a time to each destination in turn.  Write errors
+        are left in dest_files, and the handles are left open.
+
+            :param sourcefile: the source's handle, at prefix.
+            :param dest_files: [[fileHandle, error, pathstring]] as built by _copy_file.
+            :param hasher:     a hash object the whole file is added to, or None.
+            :param prefix:     the bytes the copies already hold.
+            :param maps:       pathstring -> the destination's blockmap or None, to update the copies block by block.
+            :param extents:    the ranges of a sparse source that hold data, or None.
+            :param compress:   write the copies compressed.
+
+            :returns recursivecopy.UnexpectedError: a read error if there was one, otherwise None.
+        '''
+        opened = [handle for handle, error, _ in dest_files if handle is not None and error is None]
+        if len(opened) == 0: return None
+        if maps is not None: return self._delta_copy(sourcefile, dest_files, maps, hasher, extents)
+        if extents is not None:
+            #a reflink shares the source's extents, holes and all.  It's only made when the file isn't hashed.
+            if hasher is None and len(dest_files) == 1 and self._reflink(sourcefile, opened[0]): return None
+            return self._sparse_copy(sourcefile, dest_files, extents, sourcesize, hasher)
+        if compress: return self._compressed_copy(sourcefile, dest_files, hasher)
+
+        # With a single destination and no checksum there is nothing to fan out, so let the kernel move the data.  The
+        # data never passes through python there, and a hashed file would have to be read again.  If the kernel can't
+        # finish, the loop below carries on from where it stopped.
+        if hasher is None and len(dest_files) == 1 and prefix == 0:
+            if self._kernel_copy(sourcefile, opened[0], dest_files[0][2]): return None
+
+        # With several destinations and more than a block to move, each destination gets its own writer
+        # so the copy runs at the pace of the slowest destination rather than the sum of all of them.
+        if len(opened) > 1 and self._fanout_depth > 0 and sourcesize > BUFFERS.size:
+            return self._fanout_copy(sourcefile, dest_files, BUFFERS.size, hasher)
+        return self._serial_copy(sourcefile, dest_files, hasher, sourcesize)
+
+    def _serial_copy(self, sourcefile, dest_files: list, hasher=None, sourcesize: int=0):
+        '''
+        ### _serial_copy(self, sourcefile, dest_files: list, hasher=None, sourcesize: int=0) -> recursivecopy.UnexpectedError
+        Reads the source a block at a time from where it is, writing each block to every destination in turn.
+        A destination that fails to write gets its error recorded in dest_files and its handle closed.
+
+            :returns recursivecopy.UnexpectedError: a read error if there was one, otherwise None.
+        '''
+        buffer = BUFFERS.acquire()
+        try:
+            while True:
+                # read once from the source, and write that data to each destination stream.
+                # this should ease the stress of the operation on the source drive.
+                rateof, data, rerror = self._read_file(sourcefile, BUFFERS.size, buffer)
+                if rerror is not None: return rerror
+                if rateof: return None
+                if hasher is not None: hasher.update(data)
+                self._progress(len(data))
+
+                # Attempt to write the read data to each target destination:
+                for dest in dest_files:
+                    handle, error, path = dest
+                    if handle is None or error is not None or handle.closed: continue
+                    werror = self._write_file(handle, data)
+                    if werror is None: self._wrote(handle, path, len(data))
+                    else:
+                        werror.path = path #set the error's path vairable so we have that information
+                        dest[1] = werror
+                        if not handle.closed: handle.close()
+
+                #if we have a large file, log the progress
+                if (sourcesize > 2**30) and ((int((sourcefile.tell() / sourcesize) * 100) % 10) == 0):
+                    logger.warning("Largefile copy: %" + str((sourcefile.tell() / sourcesize) * 100))
+
+                # if for any reason all our destination streams were closed, 
+                # we need to break out of the write operation and halt the process.
+                if all(h is None or e is not None or h.closed for h, e, _ in dest_files): return None
+        finally:
+            BUFFERS.release(buffer)
+
+    def _store_fsobject(self, source, relpath: str="") -> list:
+        '''
+        ### _store_fsobject(self, source, relpath: str) -> List[recursivecopy.UnexpectedError]
+        Records a source in the recipe books, storing the chunks of a file that changed.  The source is read
+        once however many destinations there are, and each chunk is hashed once.  Nothing is made in the
+        destination folders, and the predicate isn't used:  the recipes say what changed.
+
+            :returns List[recursivecopy.UnexpectedError]: A list of any errors that occured.
+        '''
+        if source.is_dir() and not source.is_symlink():
+            for book in self._books.values(): book.record_folder(relpath)
+            return []
+        if not source.is_file():
+            logger.error(f"{self._store_fsobject.__qualname__}: Source is neither a file nor a folder.  Source = [\"{source.path}\"]")
+            return [recursivecopy.PathNotWorkingError("Could not store path because it was not a file or a folder!", path=source.path)]
+        st = source.stat()
+        books = dict([(root, book) for root, book in self._books.items() if not book.unchanged(relpath, st)])
+        if len(books) == 0: return []
+
+        handle, success, error = self._open_file(source.path, 'rb')
+        if not success:
+            for book in books.values(): book.keep(relpath)
+            return [error]
+        errors = {}
+        chunks = []
+        try:
+            for chunk in self._chunker.chunks(handle.read):
+                digest = ChunkStore.digest(chunk)
+                chunks.append([digest, len(chunk)])
+                for root, book in books.items():
+                    if root in errors: continue
+                    try:
+                        self.bytes_written[root] += book.store.put(digest, chunk)
+                    except OSError as e:
+                        logger.exception(f"{recursivecopy._store_fsobject.__qualname__}")
+                        errors[root] = recursivecopy.FileWriteFailure(message="Failed to store a chunk!", e=e, 
+                            path=book.store.path(digest))
+                self._progress(len(chunk))
+                if len(errors) == len(books): break
+        except PermissionError as e:
+            logger.exception(f"{recursivecopy._store_fsobject.__qualname__}")
+            for book in books.values(): book.keep(relpath)
+            return list(errors.values()) + [recursivecopy.AccessDeniedError(f"Permission error encountered while reading from source \"{source.path}\"", e, source.path)]
+        except OSError as e:
+            logger.exception(f"{recursivecopy._store_fsobject.__qualname__}")
+            for book in books.values(): book.keep(relpath)
+            return list(errors.values()) + [recursivecopy.UnexpectedError(f"Could not read \"{source.path}\"", e)]
+        finally:
+            handle.close()
+        for root, book in books.items():
+            #a destination that failed keeps the recipe it had, if it had one.
+            if root in errors: book.keep(relpath)
+            else: book.record(relpath, st.st_size, st.st_mtime_ns, chunks)
+        return list(errors.values())
+
+    def _link_previous(self, source, root: str="", relpath: str="", compressed: bool=False) -> bool:
+        '''
+        ### _link_previous(self, source, root: str, relpath: str, compressed: bool) -> bool
+        Hard links the copy of source in the previous snapshot into the snapshot at root, if it still has the
+        size and modification time of the source.  The size of a compressed copy isn't compared.
+
+            :returns bool: True if it was linked.  Otherwise the source has to be copied.
+        '''
+        previous = self._previous.get(root)
+        if previous is None or len(relpath) == 0: return False
+        old, new = (os.path.join(previous, relpath), os.path.join(root, relpath))
+        try:
+            st = os.stat(old, follow_symlinks=False)
+            sst = source.stat()
+            if not stat.S_ISREG(st.st_mode) or (st.st_size != sst.st_size and not compressed) or st.st_mtime_ns != sst.st_mtime_ns: return False
+            self._make_parent_folders(new)
+            os.link(old, new)
+        except OSError as e:
+            #the previous copy went away, the filesystem can't link, or the file has too many links already.
+            logger.debug(f"{recursivecopy._link_previous.__qualname__}: could not link \"{old}\": {str(e)}")
+            return False
+        self.files_linked += 1
+        if self._oncopied is not None: self._oncopied(source, new, {"inode": st.st_ino, "linked": True})
+        return True
+
+    def _delta_copy(self, sourcefile, dest_files: list, maps: dict, hasher=None, extents: list=None):
+        '''
+        ### _delta_copy(self, sourcefile, dest_files: list, maps: dict, hasher=None, extents: list=None) -> recursivecopy.UnexpectedError
+        Reads the source a block at a time, and writes each block only to the destinations whose block
+        map has a different digest for it.  Destinations without a map get every block.  Once the source
+        is read every destination is cut to its size.  The digests of the source's blocks are left in
+        self._blocks so the maps can be saved once the copies are done.
+
+        Blocks that fall in a hole of a sparse source are not read.  They are left unwritten in a new copy,
+        and punched out of a copy that is updated in place.
+
+            :param sourcefile: the source's handle.
+            :param dest_files: [[fileHandle, error, pathstring]] as built by _copy_file.
+            :param maps:       pathstring -> the destination's blockmap, or None.
+            :param hasher:     a hash object the whole file is added to, or None.
+            :param extents:    the (start, end) ranges of a sparse source that hold data, or None.
+
+            :returns recursivecopy.UnexpectedError: a read error if there was one, otherwise None.
+        '''
+        self._blocks = []
+        offset = 0
+        rerror = None
+        size = os.fstat(sourcefile.fileno()).st_size if extents is not None else 0
+        e = 0 #the first extent that ends after offset
+        buffer = BUFFERS.acquire()
+        try:
+            with memoryview(buffer) as view:
+                while True:
+                    hole = 0
+                    if extents is not None:
+                        while e < len(extents) and extents[e][1] <= offset: e += 1
+                        length = min(self._delta_block, size - offset)
+                        if length > 0 and (e == len(extents) or extents[e][0] >= (offset + length)): hole = length
+                    if hole > 0:
+                        data = zeros(hole)
+                        sourcefile.seek(offset + hole)
+                        digest = self._zero_digest(hole)
+                    else:
+                        ateof, data, rerror = self._read_file(sourcefile, buffer=view[:self._delta_block])
+                        if ateof or rerror is not None: break
+                        digest = blockmap.digest(data)
+                    index = len(self._blocks)
+                    self._blocks.append(digest)
+                    if hasher is not None: hasher.update(data)
+                    for dest in dest_files:
+                        handle, error, path = dest
+                        if handle is None or error is not None or handle.closed: continue
+                        if maps.get(path) is not None and not maps[path].changed(index, digest): continue
+                        if hole > 0 and (maps.get(path) is None or self._punch(handle, offset, hole)): continue
+                        handle.seek(offset)
+                        werror = self._write_file(handle, data)
+                        if werror is None: self._count_written(path, len(data))
+                        else:
+                            werror.path = path
+                            dest[1] = werror
+                            if not handle.closed: handle.close()
+                    offset += len(data)
+                    self._progress(len(data))
+                    if self._checkpointed is not None:
+                        for handle, error, path in dest_files:
+                            if handle is not None and error is None and not handle.closed: self._checkpoint(handle, path, offset)
+                    if all(h is None or error is not None for h, error, _ in dest_files): break
+        finally:
+            BUFFERS.release(buffer)
+        if rerror is not None: 
+            self._blocks = None
+            return rerror
+        for dest in dest_files:
+            handle, error, path = dest
+            if handle is None or error is not None or handle.closed: continue
             try:
-                dhandle, dsuccess, dresult = self._open_file(dest, 'wb')
-                dest_files.append(tuple(((dhandle if dsuccess else None), (None if dsuccess else dresult), dest)))
-                if dsuccess: do_continue = True #set the write loop to run if we have a handle to write to
-            except: # noqa E722
-                for d,_,_ in dest_files:
-                    if d is not None: d.close()
-                sourcefile.close()
-                raise
-        
-        #dest_files -> [tuple(fileHandle, error, pathstring)]
+                handle.truncate(offset)
+            except OSError as e:
+                logger.exception(f"{recursivecopy._delta_copy.__qualname__}")
+                dest[1] = recursivecopy.FileWriteFailure(message="Failed to resize the destination!", e=e, path=path)
+                handle.close()
+        return None
 
-        # perform the writing operation.
-        haveread = False
-        logger.debug(f"Copying [\"{source}\"] -> {str(destinations)}")
+    def _zero_digest(self, size: int=0) -> str:
+        if size not in self._zero_digests: self._zero_digests[size] = blockmap.digest(zeros(size))
+        return self._zero_digests[size]
 
-        sourcesize = os.stat(source).st_size
-        read_blocksize = ((2**20) * 10) # 10 megabytes
-        if(sourcesize > (2**30)): #greater than 1GB
-            logger.warning("Largefile, will take some time.")
-        
-        while do_continue:
-            # read once from the source, and write that data to each destination stream.
-            # this should ease the stress of the operation on the source drive.
+    @staticmethod
+    def _punch(handle, offset: int=0, length: int=0) -> bool:
+        '''
+        Punches a hole in a destination that is open for writing.  Returns False if it couldn't, and the zeros
+        have to be written instead.
+        '''
+        try:
+            handle.flush()
+            return punch_hole(handle.fileno(), offset, length)
+        except OSError:
+            return False
+
+    @staticmethod
+    def _sparse(source) -> bool:
+        '''
+        Returns True if fewer blocks are allocated to source than its size needs, so it has holes.
+        '''
+        st = source.stat()
+        return (getattr(st, "st_blocks", None) is not None) and ((st.st_blocks * 512) < st.st_size)
+
+    def _sparse_copy(self, sourcefile, dest_files: list, extents: list, size: int=0, hasher=None):
+        '''
+        ### _sparse_copy(self, sourcefile, dest_files: list, extents: list, size: int, hasher=None) -> recursivecopy.UnexpectedError
+        Copies the data extents of a sparse source to every destination, and sets the destinations' size.
+        The destinations were just opened with 'wb', so whatever isn't written is a hole.
+
+            :param sourcefile: the source's handle.
+            :param dest_files: [[fileHandle, error, pathstring]] as built by _copy_file.
+            :param extents:    the (start, end) ranges of the source that hold data, as data_extents returns them.
+            :param size:       the size of the source.
+            :param hasher:     a hash object the whole file, holes included, is added to, or None.
 
+            :returns recursivecopy.UnexpectedError: a read error if there was one, otherwise None.
+        '''
+        offset = 0
+        shrank = False
+        buffer = BUFFERS.acquire()
+        try:
+            with memoryview(buffer) as view:
+                for start, end in extents:
+                    self._skip_hole(offset, start, hasher)
+                    offset = start
+                    sourcefile.seek(start)
+                    while offset < end:
+                        ateof, data, rerror = self._read_file(sourcefile, buffer=view[:min(len(view), end - offset)])
+                        if rerror is not None: return rerror
+                        if ateof: break
+                        if hasher is not None: hasher.update(data)
+                        for dest in dest_files:
+                            handle, error, path = dest
+                            if handle is None or error is not None or handle.closed: continue
+                            handle.seek(offset)
+                            werror = self._write_file(handle, data)
+                            if werror is None: self._count_written(path, len(data))
+                            else:
+                                werror.path = path
+                                dest[1] = werror
+                                if not handle.closed: handle.close()
+                        offset += len(data)
+                        self._progress(len(data))
+                    if all(h is None or e is not None for h, e, _ in dest_files): return None
+                    #the source shrank while it was being copied.
+                    shrank = (offset < end)
+                    if shrank: break
+        finally:
+            BUFFERS.release(buffer)
+        if not shrank:
+            self._skip_hole(offset, size, hasher)
+            offset = size
+        for dest in dest_files:
+            handle, error, path = dest
+            if handle is None or error is not None or handle.closed: continue
             try:
-                rateof, data, rerror = self._read_file(sourcefile, read_blocksize)
-                if rerror is not None:
-                    logger.error("READ ERROR OCCURRED!")
-                    for d,_,_ in dest_files:
-                        if d is not None: d.close() #sourcefile is already closed by _read_file
-
-                    #return the error(s).  We can't do anything now.
-                    return ([error for _,error,_ in dest_files if error is not None] + [rerror])
-
-                if rateof: break
-                if not haveread: haveread = True
-            except: # noqa E722
-                #the sourcefile will be closed if an exception is raised from _read_file
-                for d,_,_ in dest_files:
-                    if d is not None: d.close()
-                raise
+                handle.truncate(offset)
+            except OSError as e:
+                logger.exception(f"{recursivecopy._sparse_copy.__qualname__}")
+                dest[1] = recursivecopy.FileWriteFailure(message="Failed to resize the destination!", e=e, path=path)
+                handle.close()
+        return None
 
-            # Attempt to write the read data to each target destination:
+    def _skip_hole(self, start: int=0, end: int=0, hasher=None) -> None:
+        '''
+        Accounts for a hole of the source from start to end that isn't copied:  its zeros are hashed, and
+        it counts as progress.
+        '''
+        if end <= start: return
+        if hasher is not None:
+            for offset in range(start, end, (2**20)): hasher.update(zeros(min((2**20), end - offset)))
+        self._progress(end - start)
+
+    def _compresses(self, source) -> bool:
+        '''
+        Returns True if the copies of source are compressed:  it's a file, its name is one the codec compresses,
+        and there is no file by the compressed name next to it, whose copy would have the same name.
+        '''
+        if self._codec is None or source.is_symlink() or not source.is_file(): return False
+        return self._codec.compresses(source.name) and not os.path.lexists(source.path + self._codec.suffix)
+
+    def _compressed_copy(self, sourcefile, dest_files: list, hasher=None):
+        '''
+        ### _compressed_copy(self, sourcefile, dest_files: list, hasher=None) -> recursivecopy.UnexpectedError
+        Writes the source compressed to every destination.  The source is read in blocks that are compressed on
+        the codec's threads, a few ahead of the one being written, and written in order.  A source whose first
+        block looks random is stored instead (see codec.random).  hasher gets the data of the source, not what is
+        written.
+
+            :param sourcefile: the source's handle.
+            :param dest_files: [[fileHandle, error, pathstring]] as built by _copy_file.
+            :param hasher:     a hash object the whole file is added to, or None.
+
+            :returns recursivecopy.UnexpectedError: a read error if there was one, otherwise None.
+        '''
+        blocks = collections.deque()
+        fast = None
+        def write(data):
             for dest in dest_files:
-                if dest[0] is not None:
-                    if not dest[0].closed:
-                        try:
-                            werror = self._write_file(dest[0], data)
-                            if werror is not None:
-                                werror.path = dest[2] #set the error's path vairable so we have that information
-                                dest[1] = werror
-                                dest[0].close()
-                        except: # noqa E722
-                            for d,_,_ in dest_files:
-                                if d is not None: d.close()
-                            sourcefile.close()
-                            raise
-            
-            #if we have a large file, log the progress
-            if (sourcesize > 2**30) and ((int((sourcefile.tell() / sourcesize) * 100) % 10) == 0):
-                logger.warning("Largefile copy: %" + str((sourcefile.tell() / sourcesize) * 100))
-            
-            # if for any reason all our destination streams were closed, 
-            # we need to break out of the write operation and halt the process.
-            do_continue = False
-            for handle ,error,_ in dest_files:
-                if error is None and handle is not None:
-                    if not handle.closed: do_continue = True
-
-        # the write operations are complete.  Close all the destination
-        # streams:
+                handle, error, path = dest
+                if handle is None or error is not None or handle.closed: continue
+                werror = self._write_file(handle, data)
+                if werror is None: self._count_written(path, len(data))
+                else:
+                    werror.path = path
+                    dest[1] = werror
+                    if not handle.closed: handle.close()
+
+        while True:
+            ateof, data, rerror = self._read_file(sourcefile, self._codec.BLOCKSIZE)
+            if rerror is not None: return rerror
+            if ateof: break
+            if fast is None: fast = self._codec.random(data)
+            if hasher is not None: hasher.update(data)
+            self._progress(len(data))
+            blocks.append(self._codec.submit(data, fast))
+            while len(blocks) > self._codec.threads: write(blocks.popleft().result())
+            if all(h is None or e is not None for h, e, _ in dest_files): return None
+        #an empty file still needs a member, or it isn't a valid compressed file.
+        if fast is None: blocks.append(self._codec.submit(b'', True))
+        while len(blocks) > 0: write(blocks.popleft().result())
+        return None
+
+    def _appended(self, sourcefile, sourcesize: int=0, destinations: list=[], hasher=None) -> int:
+        '''
+        ### _appended(self, sourcefile, sourcesize: int, destinations: list, hasher=None) -> int
+        Finds out whether the source was only appended to since it was copied.  Every copy has to be the same
+        size, smaller than the source, and hold what the source starts with.  When the same digest is recorded
+        for all of them, that much of the source is hashed and compared with it.  Otherwise a few samples of each
+        copy are compared with the source, which can't see a change that misses all of them.
+
+            :param sourcefile: the source's handle, at its start.  It is left where the copies end.
+            :param hasher:     a hash object for the whole source, which the start of the source is added to.
+
+            :returns int: the number of bytes the copies already hold, or 0 if they have to be copied in full.
+                          When it's 0 the source handle and the hasher may have been used.
+        '''
+        try:
+            sizes = set()
+            for dest in destinations:
+                st = os.stat(dest, follow_symlinks=False)
+                if not stat.S_ISREG(st.st_mode): return 0
+                sizes.add(st.st_size)
+        except OSError:
+            return 0
+        if len(sizes) != 1: return 0
+        prefix = sizes.pop()
+        if prefix == 0 or prefix >= sourcesize: return 0
+
+        digests = set([self._recorded(dest) for dest in destinations]) if self._recorded is not None else set([None])
+        expected = digests.pop() if len(digests) == 1 else None
+        check = None
+        if expected is not None:
+            try:
+                check = new_checksum(expected.split(":", 1)[0])
+            except ValueError:
+                check = None
+        try:
+            if check is None and not self._samples_match(sourcefile, prefix, destinations): return 0
+            if not self._hash_prefix(sourcefile, prefix, check, hasher): return 0
+        except OSError:
+            logger.exception(f"{recursivecopy._appended.__qualname__}: could not compare [\"{sourcefile.name}\"] with its copies.")
+            return 0
+        if check is not None and expected.split(":", 1)[1] != check.hexdigest(): return 0
+        return prefix
+
+    def _resumed(self, sourcefile, sourceentry, relpath: str="", destinations: list=[], hasher=None) -> int:
+        '''
+        ### _resumed(self, sourcefile, sourceentry, relpath: str, destinations: list, hasher=None) -> int
+        Finds out how far the copies of a large file got in a run that was cut short.  The journal of every copy
+        has to hold an offset for the source as it is now, the temporary files of the copies have to be at least
+        that long, and a few samples of them have to match the source.  The copies are cut back to the smallest offset, since
+        nothing after the last checkpoint was synced.
+
+            :param sourcefile: the source's handle, at its start.  It is left at the offset.
+            :param hasher:     a hash object for the whole source, which the start of the source is added to.
+
+            :returns int: the offset the copies carry on from, or 0 if they have to be copied in full.
+                          When it's 0 the source handle and the hasher may have been used.
+        '''
+        st = sourceentry.stat()
+        offsets = []
+        for dest in destinations:
+            journal = self._journal_of(dest)
+            offset = journal.resumes(relpath, st) if journal is not None else 0
+            try:
+                if offset == 0 or os.stat(self._temp_of(dest), follow_symlinks=False).st_size < offset: return 0
+            except OSError:
+                return 0
+            offsets.append(offset)
+        if len(offsets) == 0: return 0
+        prefix = min(offsets)
+        temps = [self._temp_of(dest) for dest in destinations]
+        try:
+            if not self._samples_match(sourcefile, prefix, temps): return 0
+            for temp in temps: os.truncate(temp, prefix)
+            if not self._hash_prefix(sourcefile, prefix, hasher): return 0
+        except OSError:
+            logger.exception(f"{recursivecopy._resumed.__qualname__}: could not pick up the copies of [\"{sourcefile.name}\"].")
+            return 0
+        return prefix
+
+    def _hash_prefix(self, sourcefile, prefix: int=0, *hashers) -> bool:
+        '''
+        Adds the first prefix bytes of the source to the hash objects that aren't None, leaving the source's
+        handle at prefix.  Returns False if the source turns out to be shorter.
+            :raises OSError: when the source can't be read.
+        '''
+        hashers = [h for h in hashers if h is not None]
+        if len(hashers) == 0:
+            sourcefile.seek(prefix)
+            return True
+        sourcefile.seek(0)
+        buffer = BUFFERS.acquire()
+        try:
+            with memoryview(buffer) as view:
+                left = prefix
+                while left > 0:
+                    count = sourcefile.readinto(view[:min(left, len(buffer))])
+                    if not count: return False
+                    for h in hashers: h.update(view[:count])
+                    left -= count
+        finally:
+            BUFFERS.release(buffer)
+        return True
+
+    def _samples_match(self, sourcefile, prefix: int=0, destinations: list=[], size: int=(2**16)) -> bool:
+        '''
+        Compares the first and last blocks of the copies, and a few in between, with the same parts of the source.
+            :raises OSError: when the source can't be read.
+        '''
+        size = min(size, prefix)
+        offsets = sorted(set([0, prefix - size] + [((prefix - size) * n) // 4 for n in range(1, 4)]))
+        samples = []
+        for offset in offsets:
+            sourcefile.seek(offset)
+            samples.append(sourcefile.read(size))
+        for dest in destinations:
+            try:
+                with open(dest, 'rb') as copy:
+                    for offset, sample in zip(offsets, samples):
+                        copy.seek(offset)
+                        if copy.read(size) != sample: return False
+            except OSError:
+                return False
+        return True
+
+    def _blockmap_of(self, dest: str="") -> str:
+        '''
+        Returns the path of the block map of the copy at dest, or None if dest isn't under a destination.
+        '''
+        for root in self._destinations:
+            if dest.startswith(root + os.path.sep): return blockmap.path(root, split_path(root, dest)[1])
+        return None
+
+    def _load_blockmap(self, dest: str="") -> blockmap:
+        '''
+        Returns the block map of the copy at dest if it still describes the copy, otherwise None.
+        '''
+        path = self._blockmap_of(dest)
+        if path is None: return None
+        try:
+            st = os.stat(dest, follow_symlinks=False)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode): return None
+        old = blockmap.load(path)
+        if old is None or not old.matches(st, self._delta_block): return None
+        return old
+
+    def _save_blockmap(self, dest: str="") -> None:
+        path = self._blockmap_of(dest)
+        if path is None: return
+        try:
+            st = os.stat(dest)
+        except OSError:
+            return
+        blockmap(self._delta_block, st.st_size, st.st_mtime_ns, st.st_ino, self._blocks).save(path)
+
+    def _fanout_copy(self, sourcefile, dest_files: list, blocksize: int, hasher=None):
+        '''
+        ### _fanout_copy(self, sourcefile, dest_files: list, blocksize: int, hasher=None) -> recursivecopy.UnexpectedError
+        Reads the source once, handing each block to a writer thread per destination.  Every writer
+        has a bounded queue, so at most a few blocks are held in memory no matter how far the slowest
+        destination falls behind.  A destination that fails to write gets its error recorded in
+        dest_files and its handle closed, while the other destinations carry on.
+
+            :param sourcefile: the source's handle.
+            :param dest_files: [[fileHandle, error, pathstring]] as built by _copy_file.
+            :param blocksize: the number of bytes read at a time.
+            :param hasher: a hash object each block is added to while the writers write it, or None.
+
+            :returns recursivecopy.UnexpectedError: a read error if there was one, otherwise None.
+        '''
+        writers = [blockwriter(handle, path, self._write_file, self._fanout_depth, (lambda p, count, handle=handle: self._wrote(handle, p, count)))
+            for handle, error, path in dest_files if handle is not None and error is None]
+        for w in writers: w.start()
+        rerror = None
+        try:
+            #while hashing, the reader is a user of the block too, so it stays valid until it's hashed.
+            users = len(writers) + (0 if hasher is None else 1)
+            while True:
+                block = pooledblock(BUFFERS, users)
+                ateof, block.data, rerror = self._read_file(sourcefile, blocksize, block.buffer)
+                if ateof or rerror is not None:
+                    block.release(users)
+                    break
+                size = len(block.data)
+                for w in writers: w.put(block)
+                if hasher is not None:
+                    hasher.update(block.data)
+                    block.release()
+                self._progress(size)
+                if all(w.failed() for w in writers): break
+        finally:
+            for w in writers: w.put(None)
+            for w in writers: w.join()
+
+        for w in writers:
+            if w.exception is not None: raise w.exception
         for dest in dest_files:
-            if dest[0] is not None: dest[0].close()
+            for w in writers:
+                if w.path == dest[2] and w.error is not None: dest[1] = w.error
+        return rerror
 
-        sourcefile.close()
+    def _kernel_copy(self, sourcefile, destfile, path: str=None) -> bool:
+        '''
+        ### _kernel_copy(self, sourcefile, destfile, path: str=None) -> bool
+        Copies a file without moving its data through python.  A reflink is tried first since it
+        is nearly free on copy-on-write filesystems (btrfs, xfs) and fails immediately everywhere else.  Then
+        os.copy_file_range, then os.sendfile.  Any of them may not be supported by the platform, the
+        filesystems involved, or the pair of them.
+
+            :param sourcefile: the source's handle, opened with 'rb' and not yet read from.
+            :param destfile:   the destination's handle, opened with 'wb' and not yet written to.
+            :param path:       the destination's path, when the handle is of a temporary file standing in for it.
+
+            :returns bool: True if the whole file was copied.  If False, both handles are positioned
+                           at the point the copy reached so an ordinary copy can carry on from there, or
+                           find that it was stopped.
+        '''
+        infd, outfd = sourcefile.fileno(), destfile.fileno()
+        if path is None: path = destfile.name
+        if self._reflink(sourcefile, destfile): return True
+
+        offset = 0
+        #some filesystems (procfs, some FUSE ones) report nothing copied before the end, so 0 only ends the copy at the size.
+        size = os.fstat(infd).st_size
+        blocksize = ((2**20) * 64) #small enough for regular progress updates
+        if hasattr(os, "copy_file_range"):
+            try:
+                while not self._stopping():
+                    copied = os.copy_file_range(infd, outfd, blocksize, offset, offset)
+                    if copied == 0:
+                        if offset >= size: return True
+                        break
+                    offset += copied
+                    self._progress(copied)
+                    self._count_written(path, copied)
+                    self._checkpoint(destfile, path, offset)
+            except OSError as e:
+                logger.debug(f"{recursivecopy._kernel_copy.__qualname__}: copy_file_range stopped at {offset}: {str(e)}")
+        if hasattr(os, "sendfile") and current_os() == OsType.LINUX:
+            try:
+                os.lseek(outfd, offset, os.SEEK_SET)
+                while not self._stopping():
+                    copied = os.sendfile(outfd, infd, offset, blocksize)
+                    if copied == 0:
+                        if offset >= size: return True
+                        break
+                    offset += copied
+                    self._progress(copied)
+                    self._count_written(path, copied)
+                    self._checkpoint(destfile, path, offset)
+            except OSError as e:
+                logger.debug(f"{recursivecopy._kernel_copy.__qualname__}: sendfile stopped at {offset}: {str(e)}")
+        sourcefile.seek(offset)
+        destfile.seek(offset)
+        return False
 
-        logger.debug(f"Copying stat info for source [\"{source}\"] to destinations: {str(destinations)}")
-        # now we need to copy over all the attributes:
-        for x in range(0, len(destinations)):
-            if os.path.isfile(destinations[x]):
-                try:
-                    shutil.copystat(source, destinations[x], follow_symlinks=False)
-                except: # noqa E722
-                    logger.exception(f"\n\n\n{recursivecopy._copy_file.__qualname__}: UNHANDLED EXCEPTION!\n\n\n")
-                    raise
-        return [error for _,error,_ in dest_files if error is not None]
+    def _reflink(self, sourcefile, destfile) -> bool:
+        '''
+        ### _reflink(self, sourcefile, destfile) -> bool
+        Clones the source into the destination, where the filesystem supports it.  Returns True if it did.
+        '''
+        if FICLONE is None: return False
+        try:
+            fcntl.ioctl(destfile.fileno(), FICLONE, sourcefile.fileno())
+        except OSError:
+            return False
+        size = os.fstat(sourcefile.fileno()).st_size
+        self._progress(size)
+        self._count_written(destfile.name, size)
+        return True
 
-    def _copy_folder(self, source: str, destinations: list = []):
+    def _compare_folder(self, folder, entries: list=[]) -> None:
         '''
-        ### _copy_folder(self, source: str, destinations: list = []): -> [[bool, recursivecopy.UnexpectedError]]
-            :param source: the source path.  A fully qualified path.
+        onfolder callback for recursivescan when pruning during the copy.  Passes each destination
+        entry that has no counterpart in the source folder's listing to onstale.
+        '''
+        sources = recursiveprune.sort_listing(entries)
+        if self._codec is not None: sources = self._codec.rename_listing(sources)
+        relative = split_path(self._source, folder.path)[1]
+        for dest in self._destinations:
+            listing = recursiveprune.listing(os.path.join(dest, relative) if len(relative) > 0 else dest)
+            if listing is None: continue
+            stale, _ = recursiveprune.compare(sources, listing)
+            for entry in stale:
+                if not self._resumable(entry.path): self._onstale(entry.path)
+
+    def _temp_of(self, dest: str="") -> str:
+        return dest + recursivecopy.TEMP_SUFFIX
+
+    def _discard_temps(self, dests: list=[]) -> None:
+        '''
+        Deletes the temporary files a failed copy left behind, except those a journal can carry on with.
+        '''
+        for dest in dests:
+            temp = self._temp_of(dest)
+            if not os.path.lexists(temp) or self._resumable(temp): continue
+            try:
+                os.remove(temp)
+            except OSError:
+                logger.exception(f"{recursivecopy._discard_temps.__qualname__}: could not delete \"{temp}\"")
+
+    def _resumable(self, path: str="") -> bool:
+        '''
+        Returns True if path is the temporary file of a copy a journal says can be carried on with.
+        '''
+        if not path.endswith(recursivecopy.TEMP_SUFFIX): return False
+        dest = path[:-len(recursivecopy.TEMP_SUFFIX)]
+        for root, journal in self._journals.items():
+            if dest.startswith(root + os.path.sep) and split_path(root, dest)[1] in journal.partial: return True
+        return False
+
+    def _fsync(self, handle, path: str=""):
+        '''
+        ### _fsync(self, handle, path: str) -> recursivecopy.UnexpectedError
+        Writes a copy to disk.  Returns an error if that failed, otherwise None.
+        '''
+        try:
+            handle.flush()
+            os.fsync(handle.fileno())
+        except OSError as e:
+            logger.exception(f"{recursivecopy._fsync.__qualname__}")
+            return recursivecopy.FileWriteFailure(message="Failed to sync the copy to disk!", e=e, path=path)
+        return None
+
+    def _replace(self, temp: str="", dest: str=""):
+        '''
+        ### _replace(self, temp: str, dest: str) -> recursivecopy.UnexpectedError
+        Moves a finished copy from its temporary file into place.  Returns an error if that failed, otherwise None.
+        '''
+        try:
+            os.replace(temp, dest)
+            if self._sync == "file": sync_folder(os.path.dirname(dest))
+        except OSError as e:
+            logger.exception(f"{recursivecopy._replace.__qualname__}")
+            return recursivecopy.FileWriteFailure(message="Failed to move the copy into place!", e=e, path=dest)
+        return None
+
+    def sync(self) -> None:
+        '''
+        With the "destination" sync policy, syncs the filesystem of each destination folder.  Call it once
+        the copy is done, or stopped.
+        '''
+        if self._sync != "destination": return
+        for dest in self._destinations:
+            folder = dest if os.path.isdir(dest) else os.path.dirname(dest)
+            if not sync_filesystem(folder): logger.error(f"Failed to sync \"{folder}\" to disk.")
+
+    def _progress(self, byte_count: int=0) -> None:
+        if self._onprogress is not None: self._onprogress(byte_count)
+
+    def _stopping(self) -> bool:
+        return (self._stopped is not None) and self._stopped()
+
+    def _wrote(self, handle, path: str="", byte_count: int=0) -> None:
+        self._count_written(path, byte_count)
+        self._checkpoint(handle, path)
+
+    def _journal_of(self, path: str=""):
+        '''
+        Returns the journal of the destination folder path is under, or None.
+        '''
+        for root, journal in self._journals.items():
+            if path.startswith(root + os.path.sep): return journal
+        return None
+
+    def _checkpoint(self, handle, path: str="", offset: int=None) -> None:
+        '''
+        Called as a checkpointed file is written.  Each time the copy at path gets past another checkpoint it is
+        synced to disk, and how far it got is recorded in its journal, which is saved.  Called from the writer
+        threads as well.
+            :param offset: how much of the copy is written, the handle's position if it's None.
+        '''
+        if self._checkpointed is None: return
+        if offset is None: offset = handle.tell()
+        if offset < self._checkpoints.get(path, 0): return
+        journal = self._journal_of(path)
+        if journal is None: return
+        try:
+            handle.flush()
+            os.fsync(handle.fileno())
+        except OSError:
+            return #the writes that follow fail too, and report it.
+        self._checkpoints[path] = offset + self._checkpoint_size
+        relpath, st = self._checkpointed
+        journal.progress(relpath, st.st_size, st.st_mtime_ns, offset)
+        journal.save()
+
+    def _count_written(self, path: str="", byte_count: int=0) -> None:
+        '''
+        Adds to the count of bytes written to the destination folder that path is under.
+        '''
+        for root in self.bytes_written:
+            if path.startswith(root + os.path.sep):
+                self.bytes_written[root] += byte_count
+                return
+
+    def _notify_copied(self, source, destinations: list=[], errors: list=[]) -> None:
+        '''
+        ### _notify_copied(self, source, destinations: list=[], errors: list=[]) -> None
+        Calls oncopied for every destination the source was copied to without an error.
+        '''
+        if self._oncopied is None: return
+        failed = set([error.path for error in errors])
+        destinations = [dest for dest in destinations if dest not in failed and self._temp_of(dest) not in failed]
+        if source.is_dir():
+            for dest in destinations:
+                if dest in self._made_folders: self._oncopied(source, dest, {})
+        else:
+            for dest in destinations:
+                if dest in self._copied_inodes: self._oncopied(source, dest, {"inode": self._copied_inodes[dest], "digest": self._digest})
+
+    def _copy_stat(self, source, destination: str) -> None:
+        '''
+        ### _copy_stat(self, source, destination: str) -> None
+        Copies the permission bits, access and modification times, and extended attributes
+        of the source to the destination.  The same as shutil.copystat, but it uses the stat
+        cached by the source entry instead of taking a new one.
+            :param source: the source entry.
+            :param destination: the path to the destination file.
+        '''
+        st = source.stat()
+        os.utime(destination, ns=(st.st_atime_ns, st.st_mtime_ns))
+        try:
+            os.chmod(destination, stat.S_IMODE(st.st_mode))
+        except NotImplementedError:
+            pass
+        if hasattr(os, "listxattr"):
+            try:
+                for name in os.listxattr(source.path):
+                    os.setxattr(destination, name, os.getxattr(source.path, name))
+            except OSError:
+                #the destination filesystem may not support them, just like shutil.copystat we ignore this.
+                pass
+
+    def _copy_folder(self, source, destinations: list = []):
+        '''
+        ### _copy_folder(self, source, destinations: list = []): -> [[bool, recursivecopy.UnexpectedError]]
+            :param source: the source entry, or a fully qualified path.
             :param destinations: fully qualified destinations.  (representing the new filenames)
 
             :returns [[bool, recursivecopy.UnexpectedError]]: an array of results.
@@ -390,9 +1813,11 @@ class recursivecopy:
         results = []
         if isinstance(destinations, str):
             destinations = [destinations]
+        if not isinstance(source, str): source = source.path
         for dest in destinations:
             if dest != source:
                 if not os.path.exists(dest):
+                    # os.mkdir either creates the folder or raises, so there is no need to check again after.
                     try:
                         os.mkdir(dest)
                     except FileNotFoundError:
@@ -401,9 +1826,7 @@ class recursivecopy:
                         logger.exception("recursivecopy._copy_folder")
                         results.append(recursivecopy.UnexpectedError("Can't make directory!", exception=e))
                         continue
-                    if not os.path.exists(dest):
-                        logger.warning(f"destination [\"{dest}\"] does not exist even after an attempt to create it.")
-                        results.append(recursivecopy.PathOperationFailedError(message="Could not mkdir!", path=dest))
+                self._made_folders.add(dest)
             else:
                 logger.error(f"{recursivecopy._copy_folder.__qualname__}: arguments invalid; SOURCE == DESTINATION   " + 
                     f"source: [\"{source}\"]  destinations: {str(destinations)}")
@@ -484,27 +1907,36 @@ class recursivecopy:
                 handle = None
         return handle, success, result
 
-    def _read_file(self, filehandle, blocksize:int = -1):
+    def _read_file(self, filehandle, blocksize:int = -1, buffer: bytearray=None):
         '''
-        ### _read_file(self, filehandle: HANDLE, blocksize: int = -1)
+        ### _read_file(self, filehandle: HANDLE, blocksize: int = -1, buffer: bytearray=None)
         Reads a block from the file.  File must have been open with 'rb'.
 
             :param filehandle: the handle to read
             :param blocksize:  the number of bytes to read from the file.  if unspecified
                                reads the entire file.
+            :param buffer:     a buffer to read into (see bufferpool).  If given, blocksize is
+                               ignored, the buffer is filled as far as possible, and a memoryview
+                               of the bytes read is returned instead of a new bytes object.
             
             :returns (bool, bytes, error): true if the file is at end.  The bytes read.  An error if there was one, or None.
+                                           Every copy loop reads through here, so once the copy is stopped nothing is read
+                                           and a recursivecopy.StoppedError is returned.
         '''
+        if self._stopping(): return False, b'', recursivecopy.StoppedError(path=self.current)
         success = False
 
         ateof = False
         data = b''
         error = None
         try:
-            data = filehandle.read(blocksize)
+            if buffer is None:
+                data = filehandle.read(blocksize)
+            else:
+                data = memoryview(buffer)[:filehandle.readinto(buffer)]
             success = True
         except PermissionError as e:
-            logger.exception()
+            logger.exception(f"{recursivecopy._read_file.__qualname__}")
             error = recursivecopy.AccessDeniedError(f"Permission error encountered while reading from source \"{self.current}\"", e, self.current)
             return ateof, data, error
         except: # noqa E722
@@ -538,6 +1970,11 @@ class recursivecopy:
         except BlockingIOError:
             logger.exception(f"\n\n\n{recursivecopy._write_file.__qualname__}: Blocking IO error on write!\n\n\n")
             raise
+        except OSError as e:
+            #the destination is full, or went away, or something like that.  This belongs to one destination
+            #and shouldn't stop the others.
+            logger.exception(f"{recursivecopy._write_file.__qualname__}")
+            return recursivecopy.FileWriteFailure(message="Failed to write to the destination!", e=e, path=getattr(filehandle, "name", ""))
         except: # noqa E722
             logger.exception(f"\n\n\n{recursivecopy._write_file.__qualname__}:  UNHANDLED EXCEPTION!\n\n\n")
             raise
@@ -549,7 +1986,7 @@ class recursivecopy:
         if len(data) == written:
             return None
         
-        return recursivecopy.FileWriteFailure(message="Failed to write all the bytes!", e=None)
+        return recursivecopy.FileWriteFailure(message="Failed to write all the bytes!", e=None, path=getattr(filehandle, "name", ""))
 
     def _remove(self, path: str):
         '''
@@ -613,6 +2050,7 @@ class recursivecopy:
 
         if not os.path.isabs(path): path = os.path.abspath(path)
         folder = os.path.dirname(path)
+        if folder in self._made_folders: return True
 
         if not os.path.isdir(folder):
             try:
@@ -620,7 +2058,10 @@ class recursivecopy:
             except FileExistsError:
                 return True
         
-        return os.path.isdir(folder)
+        if os.path.isdir(folder):
+            self._made_folders.add(folder)
+            return True
+        return False
 
     # -------------------------------------------------------------------------------------------\
     # Below is a family of errors.  When dealing with system calls (especially                   |
@@ -749,12 +2190,23 @@ class recursivecopy:
 
     class FileWriteFailure(UnexpectedError):
         def __init__(self, message: str="", e: Exception=None, path: str=""):
-            super(recursivecopy.UnexpectedError, self).__init__(message, e)
+            super(recursivecopy.FileWriteFailure, self).__init__(message, e)
             self.path = path
         
         def __str__(self) -> str:
             return f"[{recursivecopy.FileWriteFailure.__name__}] {self.message}{os.linesep}Failed to write to {self.path}."
 
+    class StoppedError(UnexpectedError):
+        '''
+        The copy of a file was stopped part of the way through.  Its temporary file is kept if a journal can carry on with it.
+        '''
+        def __init__(self, message: str="The copy was stopped.", path: str=""):
+            super(recursivecopy.StoppedError, self).__init__(message, None)
+            self.path = path
+
+        def __str__(self) -> str:
+            return f"[{recursivecopy.StoppedError.__name__}] {self.message}{os.linesep}Path: {self.path}"
+
     # this map is used to map error names with their types.  This can be used, for example, 
     # in a configuration file where the user can list types of errors they want or don't want to see.
     ERROR_TYPES = {
@@ -768,15 +2220,118 @@ class recursivecopy:
         CantOpenFileError.__name__:CantOpenFileError,
         NothingWasDoneError.__name__:NothingWasDoneError,
         AccessDeniedError.__name__:AccessDeniedError,
-        FileWriteFailure.__name__:FileWriteFailure
+        FileWriteFailure.__name__:FileWriteFailure,
+        StoppedError.__name__:StoppedError
     }
 
 class copypredicate:
+    class if_source_differs_from_manifest:
+        '''
+        A predicate that decides whether to copy using a record of what each destination holds
+        (see data.BackupManifest) instead of the destination's metadata.  A file is copied if it
+        is not in the manifest, its size changed, or it was modified more recently than the copy.
+        Destinations without a manifest fall back to if_source_was_modified_more_recently.
+        '''
+        def __init__(self, manifests: dict={}):
+            '''
+            :param manifests: maps each destination folder the source is copied into to its manifest.
+            '''
+            self.manifests = manifests
+
+        def __call__(self, source, destination: str="") -> bool:
+            if isinstance(source, str): source = fsentry(source)
+            manifest = None
+            for root in self.manifests:
+                if ischild(root, destination) and (len(destination) == len(root) or destination[len(root)] == os.path.sep):
+                    manifest = self.manifests[root]
+                    break
+            if manifest is None: return copypredicate.if_source_was_modified_more_recently(source, destination)
+
+            relpath = destination[(len(manifest.root) + 1):]
+            if len(relpath) == 0: return not os.path.isdir(destination)
+            if source.is_dir(): return not manifest.has_folder(relpath)
+            record = manifest.lookup(relpath)
+            if record is None: return True
+            st = source.stat()
+            return (st.st_size != record[0]) or (st.st_mtime_ns > record[1])
+
+    class if_content_differs:
+        '''
+        Wraps another predicate.  Whenever it wants to copy a file over a copy of the same size, the
+        contents of the two are hashed and the file is only copied if they differ.  This way files
+        that were only touched, like build outputs or trees synced by other tools, aren't copied again.
+        When they match, the copy is given the source's times so the next backup sees nothing to do.
+
+        Hashes are looked up in a cache (see data.HashCache) first, and the source and the copy are
+        hashed at the same time on a pool of threads.  Files of at least deltasize bytes are not compared:
+        reading both in full costs more than the block by block update of recursivecopy, which writes
+        only what differs anyway.
+        '''
+        def __init__(self, predicate=None, cache=None, onunchanged=None, workers: int=2, deltasize: int=0, checksum: str="blake2b"):
+            '''
+            :param predicate:   the predicate to ask first.
+            :param cache:       a data.HashCache.
+            :param onunchanged: onunchanged(entry: source, str: destination, dict: details), called when the
+                                contents matched.  details holds the "inode" and "digest" of the copy, like for
+                                oncopied.
+            :param workers:     the number of threads hashing files.
+            :param deltasize:   the size from which files are left to recursivecopy's delta copy.  0 compares all of them.
+            :param checksum:    the algorithm files are hashed with, see new_checksum.  The digest passed to onunchanged
+                                is prefixed with it, like the ones recursivecopy records.
+            '''
+            self.predicate = predicate
+            self.cache = cache
+            self.onunchanged = onunchanged
+            self.deltasize = deltasize
+            self.checksum = checksum
+            self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+            self.__qualname__ = f"{type(self).__qualname__}({getattr(predicate, '__qualname__', type(predicate).__qualname__)})"
+
+        def __call__(self, source, destination: str="") -> bool:
+            if isinstance(source, str): source = fsentry(source)
+            if not self.predicate(source, destination): return False
+            if source.is_symlink() or not source.is_file(): return True
+            try:
+                sstat = source.stat()
+                dstat = os.stat(destination)
+            except OSError:
+                return True
+            if (sstat.st_size != dstat.st_size) or not stat.S_ISREG(dstat.st_mode): return True
+            if self.deltasize > 0 and sstat.st_size >= self.deltasize: return True
+            try:
+                digests = [self._pool.submit(self._digest, path, st) for path, st in [(source.path, sstat), (destination, dstat)]]
+                if digests[0].result() != digests[1].result(): return True
+                os.utime(destination, ns=(sstat.st_atime_ns, sstat.st_mtime_ns))
+            except OSError:
+                return True
+            #the copy's key changed with its modification time.
+            dstat = os.stat(destination)
+            self.cache.put(dstat, digests[1].result(), self.checksum)
+            if self.onunchanged is not None: self.onunchanged(source, destination, {"inode": dstat.st_ino, "digest": f"{self.checksum}:{digests[1].result()}"})
+            return False
+
+        def _digest(self, path: str="", st: os.stat_result=None) -> str:
+            digest = self.cache.get(st, self.checksum)
+            if digest is None:
+                digest = file_digest(path, self.checksum)
+                self.cache.put(st, digest, self.checksum)
+            return digest
+
+        def close(self) -> None:
+            self._pool.shutdown(wait=True)
+
     @staticmethod
-    def if_source_was_modified_more_recently(source: str = "", destination: str = "") -> bool:
-        if os.path.exists(destination):
-            return os.path.getmtime(source) > os.path.getmtime(destination)
-        return True
+    def if_source_was_modified_more_recently(source = "", destination: str = "") -> bool:
+        '''
+        The source may be an entry (as passed by recursivecopy) or a path.  The destination
+        is only stat'ed once.
+        '''
+        if isinstance(source, str): source = fsentry(source)
+        try:
+            dstat = os.stat(destination)
+        except OSError:
+            return True
+        return source.stat().st_mtime > dstat.st_mtime
 
 class recursiveprune:
     '''
@@ -785,17 +2340,27 @@ class recursiveprune:
     that don't exist in the source anymore.
 
     This iterator ONLY iterates over paths that exist in the destination, but not in
-    the source.  It does not do any deleting.  Moreover, it does not get invalidated
-    when a path is removed.  It gathers all paths to delete on construction,
-    so iteration happens without a dependency on filesystem state.
+    the source, or that exist in both as different types (a file in one and a folder in the
+    other, for instance).  It does not do any deleting.
+
+    The source and destination are walked together one folder at a time.  Each pair of folders is
+    listed, sorted by name and merged, so nothing is stat'ed and only the listings of the folders
+    still to visit are held in memory.  A folder that is missing from the source is returned
+    without its contents, which are deleted along with it.  Paths are returned as soon as the folder
+    they are in has been compared, and since a folder's listing is read before anything in it is
+    returned, deleting what is returned does not affect the iteration.  Folders of the source that
+    can not be read are left alone rather than taken for empty.
+
+    When the copies were compressed, pass the compression.codec as compression so the compressed copies of files
+    that are still in the source are not taken for stale.
     '''
-    def __init__(self, source, destination, newdestname: str=None):
+    def __init__(self, source, destination, newdestname: str=None, compression: codec=None):
         self.source = source
+        self.compression = compression
         self.destination = destination
         self.current = None
         self.destination = os.path.join(self.destination, os.path.basename(source)) if newdestname is None else os.path.join(self.destination, newdestname)
-        self.todelete = set([element for element in recursive(self.destination) if not self._dest_in_source(element)])
-        self.iter = iter(self.todelete)
+        self.iter = self._walk()
     
     def __iter__(self):
         return self
@@ -803,17 +2368,74 @@ class recursiveprune:
     def __next__(self):
         self.current = next(self.iter)
         return self.current
-    
-    def _dest_in_source(self, subdir) -> bool:
-        if subdir == self.destination: return True
-        newsource = os.path.join(self.source, split_path(self.destination, subdir)[1])
-        if os.path.islink(subdir):
-            return os.path.islink(newsource)
-        if os.path.isfile(subdir):
-            return (os.path.isfile(newsource) and not os.path.islink(newsource))
-        if os.path.isdir(subdir):
-            return (os.path.isdir(newsource) and not os.path.islink(newsource))
-        return False
+
+    def _walk(self):
+        stack = [(self.source, self.destination)]
+        while len(stack) > 0:
+            source, destination = stack.pop()
+            sources = recursiveprune.listing(source)
+            destinations = recursiveprune.listing(destination)
+            if sources is None or destinations is None: continue
+            if self.compression is not None: sources = self.compression.rename_listing(sources)
+
+            stale, subfolders = recursiveprune.compare(sources, destinations)
+            for entry in stale: yield entry.path
+            stack.extend(reversed([(s.path, d.path) for s, d in subfolders]))
+
+    @staticmethod
+    def compare(sources: list=[], destinations: list=[]) -> tuple:
+        '''
+        ### compare(sources: list, destinations: list) -> (list, list)
+        Merges a source folder's listing with the matching destination folder's listing, both as returned
+        by listing.
+
+            :returns tuple: (stale, subfolders).  stale holds the destination entries without a counterpart of the
+                            same type in the source.  subfolders holds (source, destination) entry pairs of the
+                            folders found in both.
+        '''
+        stale = []
+        subfolders = []
+        s = 0
+        for name, kind, entry in destinations:
+            while s < len(sources) and sources[s][0] < name: s += 1
+            if s == len(sources) or sources[s][0] != name or sources[s][1] != kind or kind is None:
+                stale.append(entry)
+            elif kind == "dir":
+                subfolders.append((sources[s][2], entry))
+        return stale, subfolders
+
+    @staticmethod
+    def listing(folder: str="") -> list:
+        '''
+        Returns the folder's entries as (name, kind, entry) sorted by name, or None if the folder can
+        not be read.
+        '''
+        try:
+            with os.scandir(folder) as it:
+                return recursiveprune.sort_listing(it)
+        except OSError:
+            return None
+
+    @staticmethod
+    def sort_listing(entries) -> list:
+        '''
+        Returns the entries of a folder as (name, kind, entry) sorted by name.
+        '''
+        return sorted([(entry.name, recursiveprune._kind(entry), entry) for entry in entries], key=lambda e: e[0])
+
+    @staticmethod
+    def _kind(entry) -> str:
+        '''
+        Returns "link", "dir" or "file" from what the folder listing says the entry is, without following
+        links.  Returns None for anything else.
+        '''
+        try:
+            if entry.is_symlink(): return "link"
+            if entry.is_dir(follow_symlinks=False): return "dir"
+            if entry.is_file(follow_symlinks=False): return "file"
+        except OSError:
+            pass
+        return None
 
 # /c/abc
 # /c/abc/abc1/bac3
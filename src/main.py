@@ -75,6 +75,9 @@ def setup_argparse() -> argparse.ArgumentParser:
     mugroup.add_argument("--listerrortypes", "-e", help="List the types of errors that can be reported." + 
         "  Use this to ignore certain types of errors.", action="store_true")
 
+    arguments.add_argument("--verify", help="Instead of backing up the profile, read back every copy on its " + 
+        "destinations and report the ones that are missing or don't match.", action="store_true")
+
     arguments.add_argument("--loglevel", help="Set the log level for this run.  Levels are:" + 
         "\ncritical\nerror\nwarning\ninfo\ndebug")
     return arguments
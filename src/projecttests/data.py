@@ -14,10 +14,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import unittest, os
+import unittest, os, shutil, tempfile, hashlib, gzip, lzma, filecmp, time
 
 from tqdm import tqdm
-from data import BackupProfile
+from data import BackupProfile, BackupMapping, BackupManifest, HashCache, RunJournal
+import algorithms
+from algorithms import Backup, ParallelDeleter, Trash, TrashReaper, Verify, prune_backup
+from chunkstore import ChunkStore, RecipeBook, chunker
+from compression import codec
+from globaldata import CONFIG
+from iterator import file_digest, recursivecopy, copypredicate, blockmap
 from projecttests.randomstuff import randomBackupProfile
 
 class DataTestCase(unittest.TestCase):
@@ -42,4 +48,693 @@ class DataTestCase(unittest.TestCase):
             BackupProfile.writejson(random_stuff, filename)
             loaded = BackupProfile.readjson(filename)
             self.assertTrue(loaded == random_stuff)
-        os.remove(filename)
\ No newline at end of file
+        os.remove(filename)
+
+class BackupTestCase(unittest.TestCase):
+    '''
+    Backs up a small source tree to a destination, both in a temporary folder.  Whatever a test changes in the
+    configuration is put back afterwards.
+    '''
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, "source")
+        self.destination = os.path.join(self.root, "destination")
+        os.makedirs(os.path.join(self.source, "a", "b"))
+        os.makedirs(self.destination)
+        for f in ["x.txt", "a/y.txt", "a/b/z.txt"]:
+            with open(os.path.join(self.source, f), 'wb') as handle:
+                handle.write(os.urandom(512))
+        self._behavior = dict(CONFIG["BackupBehavior"])
+        # the hash cache is kept with the test, not in the user's home.
+        CONFIG["BackupBehavior"]["hashcache"] = os.path.join(self.root, "hashcache.json")
+        algorithms._hashes = None
+
+    def tearDown(self):
+        TrashReaper.wait_all()
+        for key, value in self._behavior.items():
+            if CONFIG["BackupBehavior"][key] != value: CONFIG["BackupBehavior"][key] = value
+        algorithms._hashes = None
+        shutil.rmtree(self.root)
+
+    def _configure(self, **settings) -> None:
+        '''
+        Changes BackupBehavior settings for the rest of the test.
+        '''
+        for key, value in settings.items(): CONFIG["BackupBehavior"][key] = str(value)
+
+    def _new_backup(self, newdest: str="001", mapping: BackupMapping=None, compression: str=None, progressupdate=None,
+        errors: list=None) -> Backup:
+        '''
+        Returns a backup of the source to the destination that hasn't run yet.  Errors fail the test unless
+        a list is passed to collect them in.
+        '''
+        details = {"source": self.source, "destinations": [self.destination], "newdest": newdest}
+        if mapping is not None: details["mapping"] = mapping
+        if compression is not None: details["compression"] = compression
+        return Backup(details, {"progressupdate": progressupdate, "reporterror": (self.fail if errors is None else errors.append),
+            "finished": None})
+
+    def _backup(self, newdest: str="001", mapping: BackupMapping=None, compression: str=None, errors: list=None) -> Backup:
+        b = self._new_backup(newdest, mapping, compression, errors=errors)
+        b.execute()
+        return b
+
+    def _manifest(self, newdest: str="001") -> BackupManifest:
+        loaded = BackupManifest(root=os.path.join(self.destination, newdest))
+        loaded.load(BackupManifest.filename(self.destination, newdest, CONFIG))
+        return loaded
+
+    def _verify(self, mapping: BackupMapping=None, errors: list=None):
+        if mapping is None: mapping = BackupMapping({self.source: "001"})
+        return Verify(BackupProfile("verify", [self.source], [self.destination]), mapping,
+            {"progressupdate": None, "reporterror": (self.fail if errors is None else errors.append), "finished": None}).execute()
+
+class ManifestTestCase(BackupTestCase):
+    def test_forget(self):
+        manifest = BackupManifest(root=self.destination)
+        manifest.record_folder("a")
+        manifest.record_folder(os.path.join("a", "b"))
+        manifest.record(os.path.join("a", "b", "z.txt"), 1, 2, 3)
+        manifest.record("x.txt", 4, 5, 6)
+        manifest.forget("a")
+        self.assertEqual(manifest.files, {"x.txt": [4, 5, 6]})
+        self.assertEqual(manifest.folders, set())
+
+    def test_backup_records_manifest(self):
+        self._backup()
+        filename = BackupManifest.filename(self.destination, "001", CONFIG)
+        loaded = BackupManifest(root=os.path.join(self.destination, "001"))
+        self.assertTrue(loaded.load(filename))
+
+        rebuilt = BackupManifest(root=os.path.join(self.destination, "001"))
+        rebuilt.rebuild()
+        # a rebuild doesn't read the files, so it has no digests.
+        self.assertEqual(dict([(f, r[:3]) for f, r in loaded.files.items()]), rebuilt.files)
+        self.assertEqual(loaded.folders, rebuilt.folders)
+        self.assertEqual(loaded.lookup("x.txt")[0], 512)
+        with open(os.path.join(self.source, "x.txt"), 'rb') as handle:
+            self.assertEqual(loaded.digest("x.txt"), "blake2b:" + hashlib.blake2b(handle.read()).hexdigest())
+
+        # without a checksum there is no digest.
+        self._configure(checksum="none")
+        self._backup("002")
+        loaded = BackupManifest(root=os.path.join(self.destination, "002"))
+        self.assertTrue(loaded.load(BackupManifest.filename(self.destination, "002", CONFIG)))
+        self.assertIsNone(loaded.digest("x.txt"))
+
+    def test_incremental_uses_manifest(self):
+        self._backup()
+        changed = os.path.join(self.source, "a", "y.txt")
+        with open(changed, 'wb') as handle:
+            handle.write(os.urandom(100))
+        # the copy's timestamp is pushed ahead.  A stat based predicate would skip the file, the
+        # manifest still knows the copy is out of date.
+        copy = os.path.join(self.destination, "001", "a", "y.txt")
+        os.utime(copy, (os.stat(copy).st_atime + 1000, os.stat(copy).st_mtime + 1000))
+        self._backup()
+        with open(changed, 'rb') as a, open(copy, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+        os.remove(os.path.join(self.source, "x.txt"))
+        self._backup()
+        self.assertFalse(os.path.exists(os.path.join(self.destination, "001", "x.txt")))
+        self.assertIsNone(self._manifest().lookup("x.txt"))
+
+class ProgressTestCase(BackupTestCase):
+    def test_progress_total_from_manifest(self):
+        statuses = []
+        b = self._backup()
+        self.assertEqual(b._recorded_count(), 6) # the root, two folders, and three files
+        b.update_progress = lambda status: statuses.append(status.percent)
+        b.execute()
+        self.assertEqual(statuses[-1], 100)
+        self.assertEqual(statuses, sorted(statuses))
+
+    def test_scanner_stops_when_backup_fails(self):
+        scanners = []
+        def recorded_start(scanner):
+            scanners.append(scanner)
+            saved(scanner)
+        failed = []
+        def fail_once(status):
+            if status.message == "Copying..." and len(failed) == 0:
+                failed.append(status)
+                raise RuntimeError("the backup failed")
+        saved = algorithms.SourceScanner.start
+        algorithms.SourceScanner.start = recorded_start
+        try:
+            self._new_backup(progressupdate=fail_once, errors=[]).execute()
+        finally:
+            algorithms.SourceScanner.start = saved
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(len(scanners), 1)
+        self.assertTrue(scanners[0]._halt)
+
+    def test_progress_counts_bytes(self):
+        statuses = []
+        b = self._backup()
+        b.update_progress = statuses.append
+        b.execute()
+        copying = [s for s in statuses if s.bytes_total > 0]
+        self.assertEqual(copying[-1].bytes_total, (512 * 3))
+        self.assertEqual(copying[-1].bytes_done, (512 * 3))
+        self.assertEqual((copying[-1].files_done, copying[-1].files_total), (3, 3))
+        self.assertEqual([s.bytes_done for s in copying], sorted(s.bytes_done for s in copying))
+        self.assertIn("3/3 files", copying[-1].summary())
+
+    def test_status_updates_are_limited(self):
+        for x in range(0, 300):
+            with open(os.path.join(self.source, f"{x}.txt"), 'wb') as handle:
+                handle.write(os.urandom(16))
+        statuses = []
+        self._new_backup(progressupdate=statuses.append).execute()
+        self.assertLess(len(statuses), 100)
+        last = [s for s in statuses if s.files_total > 0][-1]
+        self.assertEqual((last.percent, last.files_done), (100, 303))
+
+class CopyTestCase(BackupTestCase):
+    def test_kernel_copies_without_checksum(self):
+        calls = []
+        kernel_copy = recursivecopy._kernel_copy
+        def counted(copier, sourcefile, destfile, path=None) -> bool:
+            calls.append(path)
+            return kernel_copy(copier, sourcefile, destfile, path)
+        recursivecopy._kernel_copy = counted
+        try:
+            # hashed files are read once, by python, which hashes what it copies.
+            self._backup()
+            self.assertEqual(calls, [])
+            self.assertEqual(self._manifest().digest("x.txt"), "blake2b:" + file_digest(os.path.join(self.source, "x.txt")))
+
+            self._configure(checksum="none")
+            self._backup("002")
+        finally:
+            recursivecopy._kernel_copy = kernel_copy
+        # without a checksum every file goes to the kernel.
+        self.assertEqual(sorted(calls), sorted([os.path.join(self.destination, "002", f) for f in ["x.txt", os.path.join("a", "y.txt"), os.path.join("a", "b", "z.txt")]]))
+
+    def test_appended_files_copy_tail(self):
+        self._backup()
+        grown = os.path.join(self.source, "a", "y.txt")
+        with open(grown, 'ab') as handle:
+            handle.write(os.urandom(100))
+        b = self._backup()
+        self.assertEqual(sum(b._iterator.bytes_written.values()), 100)
+        copy = os.path.join(self.destination, "001", "a", "y.txt")
+        with open(grown, 'rb') as a, open(copy, 'rb') as c:
+            self.assertEqual(a.read(), c.read())
+        self.assertEqual(self._manifest().digest(os.path.join("a", "y.txt")), "blake2b:" + file_digest(copy))
+
+        # the start changed too, so the whole file is copied.
+        with open(grown, 'r+b') as handle:
+            handle.write(os.urandom(16))
+            handle.seek(0, os.SEEK_END)
+            handle.write(os.urandom(100))
+        b = self._backup()
+        self.assertEqual(sum(b._iterator.bytes_written.values()), 712)
+        with open(grown, 'rb') as a, open(copy, 'rb') as c:
+            self.assertEqual(a.read(), c.read())
+
+    def test_copies_are_replaced_whole(self):
+        self._backup()
+        changed = os.path.join(self.source, "x.txt")
+        copy = os.path.join(self.destination, "001", "x.txt")
+        inode = os.stat(copy).st_ino
+        with open(changed, 'wb') as handle:
+            handle.write(os.urandom(1000))
+        # what a crash in the middle of a copy leaves behind.
+        leftover = os.path.join(self.destination, "001", "a", "y.txt" + recursivecopy.TEMP_SUFFIX)
+        with open(leftover, 'wb') as handle:
+            handle.write(os.urandom(100))
+
+        for policy in recursivecopy.SYNC_POLICIES:
+            self._configure(sync=policy)
+            self._backup()
+            self.assertTrue(filecmp.cmp(changed, copy, shallow=False))
+            with open(changed, 'wb') as handle:
+                handle.write(os.urandom(1001))
+        self.assertNotEqual(os.stat(copy).st_ino, inode)
+        self.assertFalse(os.path.exists(leftover))
+        self.assertEqual([], [f for _, _, files in os.walk(self.destination) for f in files if f.endswith(recursivecopy.TEMP_SUFFIX)])
+
+        # a copy that can't be moved into place doesn't leave its temporary file behind.
+        blocked = os.path.join(self.root, "blocked")
+        os.makedirs(os.path.join(blocked, "source", "x.txt", "in"))
+        errors = [e for result in recursivecopy(self.source, [blocked]) for e in result]
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(os.path.lexists(os.path.join(blocked, "source", "x.txt" + recursivecopy.TEMP_SUFFIX)))
+
+    def test_failed_replace_is_not_recorded(self):
+        changed = os.path.join(self.source, "x.txt")
+        copy = os.path.join(self.destination, "001", "x.txt")
+        replace = os.replace
+        def failing_replace(src, dst, **kwargs):
+            if dst == copy: raise OSError("no space left")
+            return replace(src, dst, **kwargs)
+        errors = []
+        os.replace = failing_replace
+        try:
+            self._backup(errors=errors)
+        finally:
+            os.replace = replace
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(os.path.exists(copy))
+        loaded = self._manifest()
+        self.assertIsNone(loaded.lookup("x.txt"))
+        self.assertIsNotNone(loaded.lookup(os.path.join("a", "y.txt")))
+
+        # the next run copies it.
+        self._backup()
+        self.assertTrue(filecmp.cmp(changed, copy, shallow=False))
+
+class CompareTestCase(BackupTestCase):
+    def test_touched_files_are_not_copied(self):
+        self._backup()
+        touched = os.path.join(self.source, "a", "y.txt")
+        os.utime(touched, (os.stat(touched).st_atime + 1000, os.stat(touched).st_mtime + 1000))
+        changed = os.path.join(self.source, "x.txt")
+        with open(changed, 'r+b') as handle:
+            handle.write(os.urandom(16))
+        b = self._backup()
+        # only the changed file was copied.
+        self.assertEqual(sum(b._iterator.bytes_written.values()), 512)
+        copy = os.path.join(self.destination, "001", "a", "y.txt")
+        self.assertEqual(os.stat(copy).st_mtime_ns, os.stat(touched).st_mtime_ns)
+        b = self._backup()
+        self.assertEqual(sum(b._iterator.bytes_written.values()), 0)
+
+        cache = HashCache()
+        self.assertTrue(cache.load(CONFIG["BackupBehavior"]["hashcache"]))
+        self.assertIsNotNone(cache.get(os.stat(touched)))
+        self.assertIsNotNone(cache.get(os.stat(copy)))
+        # a digest made with one algorithm is never taken for another's.
+        self.assertIsNone(cache.get(os.stat(copy), "sha256"))
+
+        # files the delta copy updates are left to it instead of being read in full.
+        for deltasize, expected in [(0, False), (256, True)]:
+            predicate = copypredicate.if_content_differs((lambda s, d: True), HashCache(), deltasize=deltasize)
+            try:
+                self.assertEqual(predicate(touched, copy), expected)
+            finally:
+                predicate.close()
+
+    def test_touched_files_are_compared_with_the_checksum(self):
+        self._configure(checksum="sha256")
+        self._backup()
+        touched = os.path.join(self.source, "a", "y.txt")
+        os.utime(touched, (os.stat(touched).st_atime + 1000, os.stat(touched).st_mtime + 1000))
+        b = self._backup()
+        self.assertEqual(sum(b._iterator.bytes_written.values()), 0)
+
+        # the digest recorded for the copy that wasn't written is named after the algorithm that made it.
+        copy = os.path.join(self.destination, "001", "a", "y.txt")
+        self.assertEqual(self._manifest().digest(os.path.join("a", "y.txt")), "sha256:" + file_digest(copy, "sha256"))
+        cache = HashCache()
+        self.assertTrue(cache.load(CONFIG["BackupBehavior"]["hashcache"]))
+        self.assertEqual(cache.get(os.stat(copy), "sha256"), file_digest(copy, "sha256"))
+        self.assertIsNone(cache.get(os.stat(copy)))
+        self.assertTrue(self._verify().ok())
+
+class VerifyTestCase(BackupTestCase):
+    def test_verify(self):
+        self._backup()
+        copied = os.path.join(self.destination, "001")
+        with open(os.path.join(copied, "a", "y.txt"), 'r+b') as handle:
+            handle.write(os.urandom(16))
+        os.remove(os.path.join(copied, "a", "b", "z.txt"))
+        errors = []
+        report = self._verify(errors=errors)
+        self.assertEqual(report.checked, 3)
+        self.assertEqual(report.mismatched, [os.path.join(copied, "a", "y.txt")])
+        self.assertEqual(report.missing, [os.path.join(copied, "a", "b", "z.txt")])
+        self.assertEqual(report.bytes_read, 1024)
+        self.assertEqual(len(errors), 2)
+        self.assertFalse(report.ok())
+
+        # without a manifest the copies are compared with their sources.
+        os.remove(BackupManifest.filename(self.destination, "001", CONFIG))
+        report = self._verify(errors=[])
+        self.assertEqual(report.checked, 3)
+        self.assertEqual(len(report.mismatched), 1)
+        self.assertEqual(len(report.missing), 1)
+
+class PruneTestCase(BackupTestCase):
+    def test_fused_prune(self):
+        self._backup()
+        copied = os.path.join(self.destination, "001")
+        shutil.rmtree(os.path.join(self.source, "a", "b"))
+        os.remove(os.path.join(self.source, "x.txt"))
+        os.makedirs(os.path.join(self.source, "x.txt"))
+        with open(os.path.join(self.source, "x.txt", "w.txt"), 'wb') as handle:
+            handle.write(os.urandom(16))
+        # the stale file is deleted before the folder that replaces it is copied, so one run is enough.
+        self._configure(fusedprune="yes")
+        self._backup()
+        self.assertFalse(os.path.exists(os.path.join(copied, "a", "b")))
+        self.assertTrue(os.path.isfile(os.path.join(copied, "x.txt", "w.txt")))
+        loaded = self._manifest()
+        rebuilt = BackupManifest(root=copied)
+        rebuilt.rebuild()
+        self.assertEqual(loaded.files.keys(), rebuilt.files.keys())
+        self.assertEqual(loaded.folders, rebuilt.folders)
+
+    def test_parallel_prune(self):
+        self._backup()
+        copied = os.path.join(self.destination, "001")
+        for x in range(0, 20):
+            folder = os.path.join(copied, "stale", str(x), "deeper")
+            os.makedirs(folder)
+            for y in range(0, 5):
+                with open(os.path.join(folder, f"{y}.txt"), 'wb') as handle:
+                    handle.write(os.urandom(16))
+        # links in a stale folder are deleted, never followed.
+        os.symlink(self.source, os.path.join(copied, "stale", "link"))
+        self._configure(fusedprune="no")
+        self._backup()
+        self.assertFalse(os.path.exists(os.path.join(copied, "stale")))
+        self.assertTrue(os.path.isfile(os.path.join(self.source, "a", "b", "z.txt")))
+
+        deleter = ParallelDeleter(2)
+        errors = deleter.delete(os.path.join(copied, "a")).result()
+        deleter.shutdown()
+        self.assertEqual(errors, [])
+        self.assertFalse(os.path.exists(os.path.join(copied, "a")))
+
+    def test_prune_backup_removes_block_maps(self):
+        self._configure(deltasize=256)
+        self._backup()
+        self._backup("old")
+        maps = os.path.join(self.destination, blockmap.FOLDER)
+        self.assertTrue(os.path.isdir(os.path.join(maps, "old")))
+        prune_backup(BackupProfile("prune", [self.source], [self.destination]), BackupMapping({self.source: "001"}))
+        TrashReaper.wait_all()
+        self.assertFalse(os.path.exists(os.path.join(maps, "old")))
+        self.assertFalse(os.path.exists(os.path.join(self.destination, "old")))
+        self.assertTrue(os.path.isfile(os.path.join(maps, "001", "x.txt")))
+
+class TrashTestCase(BackupTestCase):
+    def test_trash(self):
+        self._backup()
+        copied = os.path.join(self.destination, "001")
+        shutil.rmtree(os.path.join(self.source, "a"))
+        self._configure(trashgracedays=1)
+        self._backup()
+        TrashReaper.wait_all()
+        self.assertFalse(os.path.exists(os.path.join(copied, "a")))
+        # still in its grace period, so it can be put back.
+        trash = Trash(self.destination)
+        batches = trash.batches()
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(trash.restore(batches[0][0]), [os.path.join(copied, "a")])
+        self.assertTrue(os.path.isfile(os.path.join(copied, "a", "b", "z.txt")))
+
+        # out of its grace period, it's deleted.
+        self._configure(trashgracedays=0)
+        self._backup()
+        TrashReaper.wait_all()
+        self.assertEqual(Trash(self.destination).batches(), [])
+        self.assertFalse(os.path.exists(os.path.join(copied, "a")))
+
+class SnapshotTestCase(BackupTestCase):
+    def test_snapshots(self):
+        mapping = BackupMapping({self.source: "001"})
+        self._configure(snapshots="yes")
+        first = self._backup(mapping=mapping)
+        changed = os.path.join(self.source, "a", "y.txt")
+        with open(changed, 'wb') as handle:
+            handle.write(os.urandom(100))
+        os.remove(os.path.join(self.source, "x.txt"))
+        second = self._backup(mapping=mapping)
+        report = self._verify(mapping)
+
+        self.assertEqual(mapping.snapshots["001"], [first.snapshot, second.snapshot])
+        self.assertNotEqual(first.snapshot, second.snapshot)
+        old, new = [BackupMapping.snapshot_folder(self.destination, "001") + os.path.sep + b.snapshot for b in (first, second)]
+        # the file that didn't change is shared, the one that did was copied, and the deleted one is only in the old snapshot.
+        self.assertEqual(second._iterator.files_linked, 1)
+        self.assertEqual(os.stat(os.path.join(old, "a", "b", "z.txt")).st_ino, os.stat(os.path.join(new, "a", "b", "z.txt")).st_ino)
+        with open(changed, 'rb') as a, open(os.path.join(new, "a", "y.txt"), 'rb') as b, open(os.path.join(old, "a", "y.txt"), 'rb') as c:
+            data = a.read()
+            self.assertEqual(data, b.read())
+            self.assertNotEqual(data, c.read())
+        self.assertTrue(os.path.isfile(os.path.join(old, "x.txt")))
+        self.assertFalse(os.path.exists(os.path.join(new, "x.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.destination, "001")))
+        self.assertTrue(report.ok())
+        self.assertEqual(report.checked, 2)
+
+        loaded = BackupMapping()
+        self.assertTrue(loaded.try_load([self.destination], CONFIG))
+        self.assertEqual(loaded.latest_snapshot(self.destination, "001"), new)
+
+        # a run that is stopped leaves no snapshot behind.
+        with open(changed, 'wb') as handle:
+            handle.write(os.urandom(100))
+        stopped = self._new_backup(mapping=mapping)
+        record = stopped._record_copy
+        def record_and_stop(source, destination: str="", details: dict={}) -> None:
+            record(source, destination, details)
+            stopped.abort = True
+        stopped._record_copy = record_and_stop
+        stopped.execute()
+        self.assertIsNone(stopped.snapshot)
+        folder = BackupMapping.snapshot_folder(self.destination, "001")
+        self.assertEqual(sorted(os.listdir(folder)), sorted([first.snapshot, second.snapshot] + 
+            [os.path.basename(BackupManifest.filename(folder, b.snapshot, CONFIG)) for b in (first, second)]))
+        self.assertEqual(mapping.snapshots["001"], [first.snapshot, second.snapshot])
+
+class ChunkStoreTestCase(BackupTestCase):
+    def test_chunk_store(self):
+        mapping = BackupMapping({self.source: "001"})
+        big = os.path.join(self.source, "big.bin")
+        data = bytearray(os.urandom(2**18))
+        with open(big, 'wb') as handle:
+            handle.write(data)
+        shutil.copyfile(big, os.path.join(self.source, "a", "same.bin"))
+        self._configure(destinationformat="chunks", chunksize=4096)
+        first = self._backup(mapping=mapping)
+        store = ChunkStore(self.destination)
+        # the copy of big.bin didn't take any room of its own.
+        self.assertLess(first._iterator.bytes_written[os.path.join(self.destination, "001")], 2**18 + 2**12)
+        self.assertFalse(os.path.exists(os.path.join(self.destination, "001")))
+
+        data[1000:1000] = b"inserted"
+        with open(big, 'wb') as handle:
+            handle.write(data)
+        os.remove(os.path.join(self.source, "x.txt"))
+        second = self._backup(mapping=mapping)
+        # only the chunks around the insertion were new.
+        self.assertLess(second._iterator.bytes_written[os.path.join(self.destination, "001")], 2**16)
+        book = RecipeBook(store, "001")
+        self.assertTrue(book.load())
+        self.assertNotIn("x.txt", book.files)
+        restored = os.path.join(self.destination, "restored.bin")
+        store.restore(book.files["big.bin"][2], restored)
+        with open(restored, 'rb') as handle:
+            self.assertEqual(handle.read(), bytes(data))
+        os.remove(restored)
+
+        report = self._verify(mapping)
+        self.assertTrue(report.ok())
+        self.assertEqual(report.checked, len(book.chunks()))
+
+        # the chunks only the old big.bin used are collected, and the store still holds everything the recipes use.
+        before = sum(len(files) for _, _, files in os.walk(store.objects))
+        prune_backup(BackupProfile("prune", [self.source], [self.destination]), mapping)
+        after = sum(len(files) for _, _, files in os.walk(store.objects))
+        self.assertLess(after, before)
+        self.assertEqual(after, len(book.chunks()))
+
+        # a chunk a running backup stored but hasn't recorded yet is not collected.
+        orphan = os.urandom(100)
+        store.put(ChunkStore.digest(orphan), orphan)
+        running = ChunkStore(self.destination)
+        self.assertTrue(running.lock())
+        try:
+            prune_backup(BackupProfile("prune", [self.source], [self.destination]), mapping)
+            self.assertTrue(os.path.exists(store.path(ChunkStore.digest(orphan))))
+        finally:
+            running.unlock()
+        prune_backup(BackupProfile("prune", [self.source], [self.destination]), mapping)
+        self.assertFalse(os.path.exists(store.path(ChunkStore.digest(orphan))))
+
+        loaded = BackupMapping()
+        self.assertTrue(loaded.try_load([self.destination], CONFIG))
+        self.assertEqual(loaded.recipes["001"], store.recipe_file("001")[len(self.destination) + 1:])
+
+        # a chunk a crash left empty is written again.
+        digest = next(iter(book.chunks()))
+        data = ChunkStore(self.destination).read(digest)
+        with open(store.path(digest), 'wb'):
+            pass
+        self.assertEqual(ChunkStore(self.destination).put(digest, data), len(data))
+        self.assertEqual(ChunkStore(self.destination).read(digest), data)
+
+    def test_chunker(self):
+        cutter = chunker(4096)
+        for size in [100, 1024, 1025, 5000, 20000, 2**16]:
+            data = os.urandom(size)
+            # the same cut a byte at a time gives.
+            self.assertEqual(cutter.cut(data), cutter._cut_slowly(data, cutter.minimum - 64, min(size, cutter.maximum)) if size > cutter.minimum else size)
+
+    def test_chunk_recipes_survive_read_errors(self):
+        mapping = BackupMapping({self.source: "001"})
+        errors = []
+        keep = os.path.join(self.source, "keep.bin")
+        unread = os.path.join(self.source, "a", "b")
+        with open(keep, 'wb') as handle:
+            handle.write(os.urandom(2**14))
+        self._configure(destinationformat="chunks", chunksize=4096)
+        open_file, scandir = (recursivecopy._open_file, os.scandir)
+        def failing_open(iterator, path: str, access: str='wrb') -> tuple:
+            if path == keep: return (None, False, recursivecopy.AccessDeniedError("denied", PermissionError(), path))
+            return open_file(iterator, path, access)
+        def failing_scandir(path="."):
+            if path == unread: raise PermissionError("denied")
+            return scandir(path)
+        self._backup(mapping=mapping, errors=errors)
+        self.assertEqual(errors, [])
+        store = ChunkStore(self.destination)
+        before = RecipeBook(store, "001")
+        self.assertTrue(before.load())
+
+        # the source file can't be opened and a folder can't be listed, for a moment.
+        os.utime(keep, ns=(time.time_ns(), time.time_ns()))
+        recursivecopy._open_file, os.scandir = (failing_open, failing_scandir)
+        try:
+            self._backup(mapping=mapping, errors=errors)
+        finally:
+            recursivecopy._open_file, os.scandir = (open_file, scandir)
+        self.assertEqual(len(errors), 2)
+        after = RecipeBook(store, "001")
+        self.assertTrue(after.load())
+        self.assertEqual(after.files, before.files)
+        self.assertEqual(after.folders, before.folders)
+
+        # and their chunks are not collected.
+        prune_backup(BackupProfile("prune", [self.source], [self.destination]), mapping)
+        restored = os.path.join(self.root, "restored.bin")
+        store.restore(after.files["keep.bin"][2], restored)
+        self.assertTrue(filecmp.cmp(keep, restored, shallow=False))
+
+class CompressionTestCase(BackupTestCase):
+    def test_compressed_copies(self):
+        text = os.path.join(self.source, "a", "log.txt")
+        with open(text, 'wb') as handle:
+            for n in range(0, 200000): handle.write(f"{n},line of a log that compresses well\n".encode())
+        with open(os.path.join(self.source, "photo.jpg"), 'wb') as handle:
+            handle.write(os.urandom(1000))
+        copy = os.path.join(self.destination, "001", "a", "log.txt.gz")
+
+        first = self._backup(compression="gzip")
+        with gzip.open(copy, 'rb') as a, open(text, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertLess(os.path.getsize(copy), os.path.getsize(text) / 10)
+        # already compressed types keep their name, random data is stored but still named as compressed.
+        self.assertTrue(os.path.isfile(os.path.join(self.destination, "001", "photo.jpg")))
+        with gzip.open(os.path.join(self.destination, "001", "x.txt.gz"), 'rb') as a, open(os.path.join(self.source, "x.txt"), 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertGreater(first._iterator.bytes_written[os.path.join(self.destination, "001")], 0)
+
+        second = self._backup(compression="gzip")
+        self.assertEqual(second._iterator.bytes_written[os.path.join(self.destination, "001")], 0)
+        report = self._verify()
+        self.assertTrue(report.ok())
+        self.assertEqual(report.checked, 5)
+
+        os.remove(os.path.join(self.source, "x.txt"))
+        self._backup(compression="gzip")
+        self.assertFalse(os.path.exists(os.path.join(self.destination, "001", "x.txt.gz")))
+        self.assertTrue(os.path.isfile(copy))
+
+        # turning compression off replaces the compressed copies.
+        self._backup(compression="")
+        self.assertFalse(os.path.exists(copy))
+        self.assertTrue(filecmp.cmp(text, os.path.join(self.destination, "001", "a", "log.txt"), shallow=False))
+
+        # xz stores random data too, at the cost of a few bytes of framing.
+        data = os.urandom(200000)
+        xz = codec("xz")
+        self.assertTrue(xz.random(data))
+        stored = xz.compress(data, fast=True)
+        self.assertEqual(lzma.decompress(stored + stored), data + data)
+        self.assertLess(len(stored), len(data) + 100)
+
+class ResumeTestCase(BackupTestCase):
+    def test_resume_from_journal(self):
+        self._backup()
+        journal = RunJournal(filename=RunJournal.path(self.destination, "001"))
+        self.assertFalse(os.path.exists(journal.filename))
+
+        # a run that stopped in the middle of a large file, after it had finished "a/b".  Nothing in "a/b"
+        # changed since it started.
+        big = os.path.join(self.source, "a", "big.bin")
+        with open(big, 'wb') as handle:
+            handle.write(os.urandom(40000))
+        copy = os.path.join(self.destination, "001", "a", "big.bin")
+        with open(big, 'rb') as a, open(copy + recursivecopy.TEMP_SUFFIX, 'wb') as c:
+            c.write(a.read(16384) + os.urandom(1000))
+        st = os.stat(big)
+        journal.started_ns = time.time_ns() + (10**10)
+        journal.finish_folder(os.path.join("a", "b"))
+        journal.progress(os.path.join("a", "big.bin"), st.st_size, st.st_mtime_ns, 16384)
+        journal.save()
+
+        # the run after it only saves the folders it finished itself.
+        resumed = RunJournal(filename=journal.filename)
+        self.assertTrue(resumed.load())
+        self.assertEqual(resumed.previous, set([os.path.join("a", "b")]))
+        resumed.filename = os.path.join(self.root, "resumed.json")
+        resumed.save()
+        resumed.load()
+        self.assertEqual(resumed.previous, set())
+
+        self._configure(checkpointsize=4096)
+        b = self._backup()
+        self.assertEqual(sum(b._iterator.bytes_written.values()), 40000 - 16384)
+        self.assertTrue(filecmp.cmp(big, copy, shallow=False))
+        self.assertEqual(b._iterator.folders_skipped, 1)
+        # the journal is gone once the run finished.
+        self.assertFalse(os.path.exists(journal.filename))
+        self.assertEqual(self._manifest().digest(os.path.join("a", "big.bin")), "blake2b:" + file_digest(copy))
+
+        # a finished folder that was changed since the run started is copied again.  The folder above it
+        # didn't change, and its files are still passed over.
+        journal = RunJournal(filename=RunJournal.path(self.destination, "001"))
+        journal.finish_folder(os.path.join("a", "b"))
+        journal.finish_folder("a")
+        journal.save()
+        time.sleep(0.05)
+        changed = os.path.join(self.source, "a", "b", "z.txt")
+        with open(changed, 'wb') as handle:
+            handle.write(os.urandom(512))
+        b = self._backup()
+        self.assertEqual(b._iterator.folders_skipped, 1)
+        self.assertTrue(filecmp.cmp(changed, os.path.join(self.destination, "001", "a", "b", "z.txt"), shallow=False))
+
+    def test_stop_in_the_middle_of_a_file(self):
+        self._backup()
+        big = os.path.join(self.source, "a", "big.bin")
+        with open(big, 'wb') as handle:
+            handle.write(os.urandom((2**20) * 12))
+        copy = os.path.join(self.destination, "001", "a", "big.bin")
+
+        # stopped once the first block of the file was read, which is before the second one is.
+        self._configure(checkpointsize=4096)
+        stopped = self._new_backup()
+        count_progress = stopped._count_progress
+        def stop(byte_count):
+            count_progress(byte_count)
+            if byte_count >= (2**20): stopped.abort = True
+        stopped._count_progress = stop
+        stopped.execute()
+        written = sum(stopped._iterator.bytes_written.values())
+        self.assertLess(written, os.stat(big).st_size)
+        self.assertFalse(os.path.exists(copy))
+        self.assertEqual(os.stat(copy + recursivecopy.TEMP_SUFFIX).st_size, written)
+
+        # the next run carries on from where it was stopped.
+        b = self._backup()
+        self.assertEqual(sum(b._iterator.bytes_written.values()), os.stat(big).st_size - written)
+        self.assertTrue(filecmp.cmp(big, copy, shallow=False))
+        self.assertFalse(os.path.exists(copy + recursivecopy.TEMP_SUFFIX))
@@ -14,10 +14,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import unittest, os, shutil
-from iterator import recursive, recursivecopy, ischild, split_path, copypredicate, recursiveprune
+import unittest, os, shutil, tempfile, filecmp
+from iterator import recursive, recursivescan, recursivecopy, copyoptions, ischild, split_path, copypredicate, recursiveprune
+from iterator import bufferpool, pooledblock, file_digest, blockmap, punch_hole, current_os, OsType
 from tqdm import tqdm
-from algorithms import prune_backup
+from algorithms import prune_backup, SourceScanner
 import data
 
 
@@ -198,3 +199,312 @@ class IterationTestCase(unittest.TestCase):
         except FileExistsError:
             pass
 
+
+class ScanTestCase(unittest.TestCase):
+    '''
+    Tests the scandir based iterators against a small tree built in a temporary folder.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, "source")
+        self.destination = os.path.join(self.root, "destination")
+        for folder in ["a", "a/b", "a/b/c", "d"]:
+            os.makedirs(os.path.join(self.source, folder))
+        for f in ["x.txt", "a/y.txt", "a/b/z.txt", "a/b/c/w.txt", "d/v.txt"]:
+            with open(os.path.join(self.source, f), 'wb') as handle:
+                handle.write(os.urandom(1024))
+        os.makedirs(self.destination)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_recursivescan_matches_walk(self):
+        expected = []
+        for path, _, files in os.walk(self.source):
+            expected.append(path)
+            expected.extend(os.path.join(path, f) for f in files)
+        self.assertEqual([e.path for e in recursivescan(self.source)], expected)
+        self.assertEqual(list(recursive(self.source)), expected)
+
+    def test_sourcescanner(self):
+        scanner = SourceScanner(self.source)
+        self.assertEqual(scanner.total(3), 4)
+        scanner.start()
+        scanner.join()
+        self.assertEqual(scanner.total(3), len(list(recursive(self.source))))
+
+    def test_recursivecopy(self):
+        for errors in recursivecopy(self.source, self.destination, copypredicate.if_source_was_modified_more_recently):
+            self.assertEqual(errors, [])
+        copied = os.path.join(self.destination, "source")
+        for entry in recursivescan(self.source):
+            counterpart = os.path.join(copied, split_path(self.source, entry.path)[1])
+            if entry.is_file():
+                with open(entry.path, 'rb') as a, open(counterpart, 'rb') as b:
+                    self.assertEqual(a.read(), b.read())
+                self.assertEqual(entry.stat().st_mtime_ns, os.stat(counterpart).st_mtime_ns)
+            else:
+                self.assertTrue(os.path.isdir(counterpart))
+
+        # nothing changed, so the predicate should rule everything out.
+        for errors in recursivecopy(self.source, self.destination, copypredicate.if_source_was_modified_more_recently):
+            self.assertEqual(errors, [])
+
+    def test_recursivecopy_multiple_destinations(self):
+        destinations = [os.path.join(self.destination, str(x)) for x in range(0, 3)]
+        for d in destinations: os.makedirs(d)
+        with open(os.path.join(self.source, "large.bin"), 'wb') as handle:
+            handle.write(os.urandom((2**20) * 25))
+        digests = {}
+        copier = recursivecopy(self.source, destinations, options=copyoptions(checksum="blake2b"),
+            oncopied=lambda source, dest, details: digests.update([(dest, details.get("digest"))]))
+        for errors in copier:
+            self.assertEqual(errors, [])
+        # hashed while it was copied, over the blocks shared by the writers.
+        large = os.path.join(destinations[0], "source", "large.bin")
+        self.assertEqual(digests[large], "blake2b:" + file_digest(large))
+        for d in destinations:
+            for entry in recursivescan(self.source):
+                if entry.is_file():
+                    with open(entry.path, 'rb') as a, open(os.path.join(d, "source", split_path(self.source, entry.path)[1]), 'rb') as b:
+                        self.assertEqual(a.read(), b.read())
+
+    def test_bufferpool(self):
+        pool = bufferpool(size=16, keep=2)
+        buffers = [pool.acquire() for _ in range(0, 3)]
+        for b in buffers: pool.release(b)
+        self.assertEqual(len(pool._free), 2)
+        self.assertIn(pool.acquire(), buffers)
+
+        block = pooledblock(pool, users=2)
+        block.data = memoryview(block.buffer)[:4]
+        self.assertEqual(len(pool._free), 0)
+        block.release()
+        self.assertEqual(len(pool._free), 0)
+        block.release()
+        self.assertEqual(len(pool._free), 1)
+
+    def test_fanout_write_failure(self):
+        destinations = [os.path.join(self.destination, str(x)) for x in range(0, 2)]
+        for d in destinations: os.makedirs(d)
+        source = os.path.join(self.source, "large.bin")
+        with open(source, 'wb') as handle:
+            handle.write(os.urandom((2**20) * 25))
+
+        # the first destination fails after its first block, the second must still get everything.
+        copier = recursivecopy(self.source, destinations)
+        write = copier._write_file
+        def failing_write(handle, data):
+            if handle.name.startswith(destinations[0]) and handle.tell() > 0:
+                handle.close()
+                return recursivecopy.FileWriteFailure(message="Failed to write all the bytes!")
+            return write(handle, data)
+        copier._write_file = failing_write
+
+        copies = [os.path.join(d, "source", "large.bin") for d in destinations]
+        for c in copies: os.makedirs(os.path.dirname(c))
+        errors = copier._copy_file(source, copies)
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], recursivecopy.FileWriteFailure)
+        self.assertEqual(errors[0].path, copies[0])
+        with open(source, 'rb') as a, open(copies[1], 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_kernel_copy(self):
+        source = os.path.join(self.source, "x.txt")
+        copy = os.path.join(self.destination, "x.txt")
+        with open(source, 'rb') as a, open(copy, 'wb') as b:
+            if not recursivecopy(self.source, self.destination)._kernel_copy(a, b):
+                # whatever is left must be where the ordinary loop expects it.
+                self.assertEqual(a.tell(), b.tell())
+                b.write(a.read())
+        with open(source, 'rb') as a, open(copy, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+        # a filesystem that says nothing is left before the end doesn't make the copy look done.
+        saved = (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None))
+        os.copy_file_range = os.sendfile = (lambda *args: 0)
+        try:
+            with open(source, 'rb') as a, open(copy, 'wb') as b:
+                copier = recursivecopy(self.source, self.destination)
+                copier._reflink = (lambda sourcefile, destfile: False)
+                self.assertFalse(copier._kernel_copy(a, b))
+                self.assertEqual((a.tell(), b.tell()), (0, 0))
+        finally:
+            for name, function in zip(["copy_file_range", "sendfile"], saved):
+                if function is None: delattr(os, name)
+                else: setattr(os, name, function)
+
+    def test_kernel_copy_paths(self):
+        source = os.path.join(self.source, "x.txt")
+        copy = os.path.join(self.destination, "x.txt")
+        copier = recursivecopy(self.source, self.destination)
+        # a reflink either clones the whole file, or leaves the copy alone.
+        with open(source, 'rb') as a, open(copy, 'wb') as b:
+            if not copier._reflink(a, b): self.assertEqual((a.tell(), os.fstat(b.fileno()).st_size), (0, 0))
+        if os.path.getsize(copy) > 0: self.assertTrue(filecmp.cmp(source, copy, shallow=False))
+
+        # without copy_file_range, sendfile copies it.
+        if hasattr(os, "sendfile") and current_os() == OsType.LINUX:
+            saved = getattr(os, "copy_file_range", None)
+            if saved is not None: del os.copy_file_range
+            try:
+                with open(source, 'rb') as a, open(copy, 'wb') as b:
+                    copier._reflink = (lambda sourcefile, destfile: False)
+                    self.assertTrue(copier._kernel_copy(a, b))
+            finally:
+                if saved is not None: os.copy_file_range = saved
+            self.assertTrue(filecmp.cmp(source, copy, shallow=False))
+
+        # a sparse file going to a single destination is reflinked where that works, unless it's hashed.
+        if not hasattr(os, "SEEK_DATA"): return
+        sparse = os.path.join(self.source, "disk.img")
+        with open(sparse, 'wb') as handle:
+            handle.truncate(2**20)
+            handle.write(b"data")
+        cloned = []
+        def reflink(sourcefile, destfile) -> bool:
+            cloned.append(destfile.name)
+            shutil.copyfileobj(sourcefile, destfile)
+            return True
+        digests = {}
+        copy = os.path.join(self.destination, "source", "disk.img")
+        for checksum in ["blake2b", "none"]:
+            copier = recursivecopy(self.source, self.destination, options=copyoptions(checksum=checksum),
+                oncopied=(lambda entry, dest, details: digests.update({dest: details.get("digest")})))
+            copier._sparse = (lambda source: source.name == "disk.img")
+            copier._reflink = reflink
+            for errors in copier: self.assertEqual(errors, [])
+            self.assertTrue(filecmp.cmp(sparse, copy, shallow=False))
+            if checksum != "none":
+                self.assertEqual(cloned, [])
+                self.assertEqual(digests[copy], f"blake2b:{file_digest(sparse)}")
+        # without a checksum every file is offered to the reflink first.
+        self.assertEqual(len(cloned), len([e for e in recursivescan(self.source) if e.is_file()]))
+        self.assertIn(copy + recursivecopy.TEMP_SUFFIX, cloned)
+
+    def test_kernel_copy_is_finished(self):
+        source = os.path.join(self.source, "x.txt")
+        copy = os.path.join(self.destination, "source", "x.txt")
+        digests = {}
+        def copier() -> recursivecopy:
+            return recursivecopy(self.source, self.destination, options=copyoptions(checksum="none"),
+                oncopied=(lambda entry, dest, details: digests.update({dest: details.get("digest")})))
+        if not hasattr(os, "copy_file_range"): self.skipTest("there is no copy_file_range")
+        # the kernel stops part of the way, and python copies the rest.
+        saved = (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None))
+        def copy_file_range(infd, outfd, count, offset_src, offset_dst):
+            if offset_src > 0: raise OSError("not supported")
+            return saved[0](infd, outfd, 100, offset_src, offset_dst)
+        os.copy_file_range = copy_file_range
+        if saved[1] is not None: del os.sendfile
+        try:
+            kernel = copier()
+            kernel._reflink = (lambda sourcefile, destfile: False)
+            for errors in kernel: self.assertEqual(errors, [])
+        finally:
+            for name, function in zip(["copy_file_range", "sendfile"], saved):
+                if function is None: delattr(os, name)
+                else: setattr(os, name, function)
+        self.assertTrue(filecmp.cmp(source, copy, shallow=False))
+        self.assertIsNone(digests[copy])
+
+    def test_delta_copy(self):
+        block = 2**16
+        source = os.path.join(self.source, "image.bin")
+        with open(source, 'wb') as handle:
+            handle.write(os.urandom(block * 8 + 100))
+        copy = os.path.join(self.destination, "source", "image.bin")
+        def backup() -> recursivecopy:
+            copier = recursivecopy(self.source, self.destination, copypredicate.if_source_was_modified_more_recently,
+                options=copyoptions(deltasize=block, deltablock=block))
+            for errors in copier: self.assertEqual(errors, [])
+            with open(source, 'rb') as a, open(copy, 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+            return copier
+        self.assertEqual(sum(backup().bytes_written.values()), os.path.getsize(source) + (1024 * 5))
+        self.assertTrue(os.path.isfile(blockmap.path(os.path.join(self.destination, "source"), "image.bin")))
+
+        # one block changes, and the file shrinks.
+        with open(source, 'r+b') as handle:
+            handle.seek(block * 3 + 10)
+            handle.write(os.urandom(16))
+            handle.truncate(block * 6)
+        self.assertEqual(sum(backup().bytes_written.values()), block)
+
+        # a copy changed behind the backup's back is written in full.
+        with open(copy, 'r+b') as handle:
+            handle.write(b"changed")
+        os.utime(source, (os.stat(source).st_atime + 10, os.stat(source).st_mtime + 10))
+        self.assertEqual(sum(backup().bytes_written.values()), block * 6)
+
+    def test_sparse_copy(self):
+        mb = 2**20
+        source = os.path.join(self.source, "disk.img")
+        with open(source, 'wb') as handle:
+            handle.truncate(mb * 32)
+            handle.seek(mb * 4)
+            handle.write(os.urandom(mb))
+            handle.seek(mb * 20)
+            handle.write(b"end of the data")
+        if not hasattr(os, "SEEK_DATA") or os.stat(source).st_blocks * 512 >= mb * 8:
+            self.skipTest("the filesystem doesn't keep holes")
+        copy = os.path.join(self.destination, "source", "disk.img")
+        def backup(**kwargs) -> recursivecopy:
+            copier = recursivecopy(self.source, self.destination, copypredicate.if_source_was_modified_more_recently, **kwargs)
+            for errors in copier: self.assertEqual(errors, [])
+            self.assertTrue(filecmp.cmp(source, copy, shallow=False))
+            return copier
+
+        # with the checksum on the kernel can't copy it, and the holes are still hashed.
+        digests = {}
+        copier = backup(options=copyoptions(checksum="blake2b"), oncopied=(lambda entry, dest, details: digests.update({dest: details.get("digest")})))
+        self.assertLess(sum(copier.bytes_written.values()), mb * 4)
+        self.assertLess(os.stat(copy).st_blocks * 512, mb * 8)
+        self.assertEqual(os.stat(copy).st_size, mb * 32)
+        self.assertEqual(digests[copy], f"blake2b:{file_digest(source)}")
+
+        # updated in place, a new hole is punched into the copy.
+        os.remove(copy)
+        backup(options=copyoptions(deltasize=mb, deltablock=mb))
+        allocated = os.stat(copy).st_blocks
+        self.assertLess(allocated * 512, mb * 8)
+        with open(source, 'r+b') as handle:
+            handle.seek(mb * 4)
+            handle.write(bytes(mb))
+        os.utime(source, (os.stat(source).st_atime + 10, os.stat(source).st_mtime + 10))
+        with open(source, 'r+b') as handle:
+            punched = punch_hole(handle.fileno(), mb * 4, mb)
+        os.utime(source, (os.stat(source).st_atime + 10, os.stat(source).st_mtime + 10))
+        copier = backup(options=copyoptions(deltasize=mb, deltablock=mb))
+        self.assertEqual(sum(copier.bytes_written.values()), 0 if punched else mb)
+        if punched: self.assertLessEqual(os.stat(copy).st_blocks * 512, (allocated * 512) - mb)
+
+    def test_tail_copy(self):
+        for _ in recursivecopy(self.source, self.destination): pass
+        grown = os.path.join(self.source, "d", "v.txt")
+        with open(grown, 'ab') as handle:
+            handle.write(os.urandom(300))
+        # nothing is recorded, so samples of the copy are compared with the source.
+        copier = recursivecopy(self.source, self.destination, copypredicate.if_source_was_modified_more_recently, options=copyoptions(tailcopy=True))
+        for errors in copier: self.assertEqual(errors, [])
+        self.assertEqual(sum(copier.bytes_written.values()), 300)
+        with open(grown, 'rb') as a, open(os.path.join(self.destination, "source", "d", "v.txt"), 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_recursiveprune(self):
+        for _ in recursivecopy(self.source, self.destination): pass
+        copied = os.path.join(self.destination, "source")
+        os.remove(os.path.join(self.source, "a", "y.txt"))
+        shutil.rmtree(os.path.join(self.source, "a", "b"))
+        stale = set(recursiveprune(self.source, self.destination))
+        self.assertIn(os.path.join(copied, "a", "y.txt"), stale)
+        self.assertIn(os.path.join(copied, "a", "b"), stale)
+        self.assertNotIn(os.path.join(copied, "d", "v.txt"), stale)
+        # the contents of a folder that's gone are deleted with it.
+        self.assertNotIn(os.path.join(copied, "a", "b", "z.txt"), stale)
+
+        os.remove(os.path.join(self.source, "x.txt"))
+        os.makedirs(os.path.join(self.source, "x.txt"))
+        self.assertEqual(set(recursiveprune(self.source, self.destination)), stale.union([os.path.join(copied, "x.txt")]))
@@ -1,7 +1,78 @@
 '''
 Miscellaneous tests
 '''
-import unittest
+import unittest, threading, time, tempfile
+
+from threads import ThreadManager
+from scheduler import DeviceScheduler, DeviceType, device_of
+from globaldata import CONFIG
+from algorithms import ProcessStatus
+from commandline import ProgressState
 
 class MiscTestCase(unittest.TestCase):
-    pass
\ No newline at end of file
+    def _counted_work(self):
+        lock = threading.Lock()
+        counts = {"running": 0, "most": 0, "ran": 0}
+        def work():
+            with lock:
+                counts["running"] += 1
+                counts["most"] = max(counts["most"], counts["running"])
+            time.sleep(0.05)
+            with lock:
+                counts["running"] -= 1
+                counts["ran"] += 1
+        return counts, work
+
+    def test_threadmanager_limits_running_threads(self):
+        counts, work = self._counted_work()
+        manager = ThreadManager(2)
+        manager.start()
+        for x in range(0, 6): manager.addThread(threading.Thread(target=work))
+        manager.join()
+        self.assertEqual(counts["ran"], 6)
+        self.assertEqual(counts["most"], 2)
+        manager.halt_thread()
+        self.assertEqual(len(manager.runningthreads), 0)
+
+    def test_scheduler_limits_each_device(self):
+        folder = tempfile.gettempdir()
+        key, kind = device_of(folder)
+        self.assertIsInstance(kind, DeviceType)
+        saved = CONFIG["BackupBehavior"][kind.value + "threads"]
+        CONFIG["BackupBehavior"][kind.value + "threads"] = "1"
+        try:
+            counts, work = self._counted_work()
+            scheduler = DeviceScheduler(4)
+            for x in range(0, 3): scheduler.addThread(threading.Thread(target=work), [folder])
+            scheduler.join()
+            self.assertEqual((counts["ran"], counts["most"]), (3, 1))
+
+            #threads that don't share a device run side by side.
+            counts, work = self._counted_work()
+            for x in range(0, 3): scheduler.addThread(threading.Thread(target=work))
+            scheduler.join()
+            self.assertEqual((counts["ran"], counts["most"]), (3, 3))
+        finally:
+            CONFIG["BackupBehavior"][kind.value + "threads"] = saved
+
+    def test_scheduler_leaves_threads_alone(self):
+        ran = []
+        class Counted(threading.Thread):
+            def run(self):
+                ran.append(threading.current_thread())
+        threads = [Counted() for x in range(0, 3)]
+        scheduler = DeviceScheduler(2)
+        for t in threads: scheduler.addThread(t)
+        scheduler.join()
+        self.assertEqual(len(ran), 3)
+        # run() was called on the scheduler's own threads, which have all exited.
+        self.assertTrue(all("run" not in vars(t) and not t.is_alive() for t in threads))
+        self.assertTrue(all(runner not in threads and not runner.is_alive() for runner in ran))
+
+    def test_progress_shows_every_summary(self):
+        with ProgressState(total=2) as state:
+            state.printProgress(ProcessStatus(10.0, "", files_done=1, files_total=4), "/a/first")
+            self.assertEqual(state.postfix(), "1/4 files")
+            state.printProgress(ProcessStatus(20.0, "", files_done=2, files_total=8), "/b/second")
+            state.printProgress(ProcessStatus(30.0, "", files_done=3, files_total=4), "/a/first")
+            self.assertEqual(state.postfix(), "first: 3/4 files | second: 2/8 files")
@@ -0,0 +1,170 @@
+# Backup backs up a user's computer to one or more disk drives or block devices.
+# Copyright (C) 2019 Jonathan Whitlock
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading, logging, collections, os, enum
+
+from globaldata import CONFIG
+from iterator import current_os, OsType
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceType(enum.Enum):
+    '''
+    The kinds of device a path can be on, each with its own limit on the number of
+    backups using it at once.
+    '''
+    HDD = "hdd"
+    SSD = "ssd"
+    OTHER = "other" #network shares, virtual filesystems, and anything that couldn't be identified.
+
+def device_of(path: str="") -> tuple:
+    '''
+    ### device_of(path: str) -> (key, DeviceType)
+    Identifies the device a path is stored on.  On Linux, partitions of the same disk are
+    identified as that disk, so work on two partitions of one drive is still kept apart.
+
+        :param path: a path that exists.
+
+        :returns tuple: (key, DeviceType), where key is the same for every path on the device.
+    '''
+    try:
+        dev = os.stat(path).st_dev
+    except OSError:
+        return (path, DeviceType.OTHER)
+    if current_os() != OsType.LINUX: return (dev, DeviceType.OTHER)
+    block = os.path.realpath(f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}")
+    if not os.path.isdir(block): return (dev, DeviceType.OTHER)
+    if os.path.isfile(os.path.join(block, "partition")): block = os.path.dirname(block)
+    try:
+        with open(os.path.join(block, "queue", "rotational"), 'r') as rotational:
+            kind = DeviceType.HDD if rotational.read().strip() == "1" else DeviceType.SSD
+    except OSError:
+        kind = DeviceType.OTHER
+    return (block, kind)
+
+def device_limit(kind: DeviceType=DeviceType.OTHER) -> int:
+    '''
+    Returns the number of backups that may use a device of the given type at once.
+    '''
+    return max(1, int(CONFIG["BackupBehavior"][kind.value + "threads"]))
+
+class DeviceScheduler:
+    '''
+    Runs threads no more than maxcount at once, and no more on a device than that device's
+    limit allows.  Each thread is given the paths it works on.  It is started once every device
+    those paths are on has room for it, so backups on separate disks run side by side while backups
+    sharing a spinning disk take turns.  A queued thread is started as soon as a running one
+    finishes, and nothing runs while there is nothing to do.
+
+    The threads given to it are never started themselves.  Their run() is called on a thread of
+    the scheduler's own, which tells the scheduler once it returns.
+    '''
+    def __init__(self, maxcount: int=3):
+        self.maxcount = maxcount
+        self.runningthreads = set()
+        self.noadd = False #when true, disables the addition and starting of more threads.
+        self._waiting = collections.deque()
+        self._devices = {} #thread -> [device key]
+        self._busy = collections.Counter() #device key -> running threads using it
+        self._limits = {} #device key -> limit
+        self._runners = {} #thread -> the scheduler's thread calling its run()
+        self._changed = threading.Condition()
+
+    def start(self) -> None:
+        '''
+        Starts any threads that were added before the scheduler was running.
+        '''
+        with self._changed:
+            self.noadd = False
+            runners = self._startWaiting()
+        for runner in runners: runner.start()
+
+    def addThread(self, t: threading.Thread=None, paths: list=[]) -> None:
+        '''
+        Queues t to be started.
+
+            :param t:     the thread.
+            :param paths: the paths t reads and writes.  Without any, only maxcount limits it.
+        '''
+        devices = [device_of(p) for p in paths]
+        with self._changed:
+            if self.noadd: return
+            for key, kind in devices: self._limits[key] = device_limit(kind)
+            self._devices[t] = list(set(key for key, kind in devices))
+            self._waiting.append(t)
+            runners = self._startWaiting()
+        for runner in runners: runner.start()
+
+    def join(self) -> None:
+        '''
+        Waits until every thread that was added has run.
+        '''
+        with self._changed:
+            self._changed.wait_for(lambda: (len(self.runningthreads) == 0) and (len(self._waiting) == 0))
+        self._joinRunners()
+
+    def halt_thread(self) -> None:
+        '''
+        Drops the threads that have not started yet and waits for the running ones to finish.
+        '''
+        with self._changed:
+            self.noadd = True
+            self._waiting.clear()
+            self._changed.wait_for(lambda: len(self.runningthreads) == 0)
+        self._joinRunners()
+
+    def _joinRunners(self) -> None:
+        '''
+        Waits for the scheduler's threads whose thread has finished to exit.
+        '''
+        with self._changed:
+            runners = [self._runners.pop(t) for t in list(self._runners.keys()) if t not in self.runningthreads]
+        for runner in runners: runner.join()
+
+    def _fits(self, t: threading.Thread=None) -> bool:
+        return all(self._busy[key] < self._limits[key] for key in self._devices[t])
+
+    def _startWaiting(self) -> list:
+        '''
+        Takes the waiting threads that have room off the queue, oldest first, and returns the threads that run
+        them.  Call it holding self._changed, and start what it returns once that is released.
+        '''
+        runners = []
+        if self.noadd: return runners
+        for t in list(self._waiting):
+            if len(self.runningthreads) >= self.maxcount: break
+            if not self._fits(t): continue
+            self._waiting.remove(t)
+            self.runningthreads.add(t)
+            self._busy.update(self._devices[t])
+            self._runners[t] = threading.Thread(target=self._run, args=(t,), name=t.name, daemon=t.daemon)
+            runners.append(self._runners[t])
+        return runners
+
+    def _run(self, t: threading.Thread=None) -> None:
+        try:
+            t.run()
+        finally:
+            self._finished(t)
+
+    def _finished(self, t: threading.Thread=None) -> None:
+        with self._changed:
+            self.runningthreads.discard(t)
+            self._busy.subtract(self._devices.pop(t))
+            runners = self._startWaiting()
+            self._changed.notify_all()
+        for runner in runners: runner.start()
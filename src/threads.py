@@ -16,166 +16,25 @@
 
 from PyQt5.QtCore import pyqtSignal, QObject
 from iterator import recursivecopy
-from algorithms import ProcessStatus, Backup, prune_backup
+from algorithms import ProcessStatus, Backup, prune_backup, Verify, VerifyReport
 from data import BackupProfile, BackupMapping
+from scheduler import DeviceScheduler
 
-import threading, logging, queue, time
+import threading, logging
 
 logger = logging.getLogger("threads")
 
 
-class Worker(threading.Thread):
+class ThreadManager(DeviceScheduler):
     '''
-    An arbitrary worker thread.
-    '''
-    def __init__(self, functor):
-        '''
-        functor: the function to execute on each iteration.  Takes no arguments.
-
-        If the functor is None, Worker.doWork will be the function used for implimentation,
-        allowing for polymorphic implimentation much like threading.Thread, where doWork is the
-        implemented function instead of run.
-        '''
-        super(Worker, self).__init__()
-        self.throttle = 30 #iterates 30 times per second
-        self._running = False #True when the thread is running
-        self._stopthread = False #True when the caller wants the thread to stop
-        self._functor = functor
-    
-    def halt_thread(self) -> None:
-        '''
-        Stops this worker thread.
-        '''
-        if not self.isAlive():
-            return
-        self._stopthread = True
-        self.join()
-        if self._running:
-            raise RuntimeError("Failed to stop thread")
-    
-    def doWork(self) -> None:
-        '''
-        Impliment this in a subclass.  This is the only function you /need/ for function.
-        '''
-        raise NotImplementedError(Worker.doWork.__qualname__ + ": Not implemented.")
-
-    def tryLog(self, message) -> bool:
-        try:
-            logger.debug(message)
-            return True
-        except: # noqa: E722
-            return False
-
-    def run(self):
-        self._running = True
-        while(not self._stopthread):
-            if self._functor is not None:
-                self._functor()
-            else:
-                self.doWork()
-            time.sleep(1 / self.throttle)
-        self._running = False
-
-class ThreadPool:
-    '''
-    A ThreadPool for asynchronous tasks.
-    '''
-
-    def __init__(self, maxcount: int=0):
-        self.threadqueue = queue.Queue(0)
-        self.runningthreads = set()
-        self.maxcount = maxcount
-        self.noadd = False #when true, disabled the addition and starting of more threads.
-
-    def addThread(self, t: threading.Thread=None) -> None:
-        if not self.noadd:
-            self.threadqueue.put(t)
-    
-    def startAll(self) -> bool:
-        '''
-        Starts all threads.  Limit number of threads to self.maxthreads.
-        Returns true if threads were started, false otherwise.
-        '''
-        if self.threadqueue.empty():
-            return False
-        tstarted = False
-        scount = (self.maxcount - len(self.runningthreads))
-        if scount <= 0:
-            return tstarted
-        for x in range(0, scount):
-            if self._runthread():
-                tstarted = True
-            else:
-                break
-        return tstarted
-
-    def canStart(self) -> bool:
-        '''
-        returns true if there are still threads in this pool waiting to be started
-        '''
-        return not self.threadqueue.empty()
-
-    def joinAll(self) -> bool:
-        '''
-        Joins all threads that are not alive.
-        returns True if any threads were joined.
-        '''
-        toremove = [t for t in self.runningthreads if not t.is_alive()]
-        self.runningthreads.difference_update(toremove)
-        for t in toremove: t.join()
-        return (len(toremove) > 0)
-
-    def terminateAll(self) -> None:
-        '''
-        Attempts to join everything.  First joins threads that are not alive, then
-        it will blocking join all the rest.
-        '''
-        self.noadd = True
-        self.joinAll()
-        for t in self.runningthreads: t.join()
-        self.runningthreads.clear()
-
-    def _runthread(self) -> bool:
-        '''
-        Attempts to run a thread.  Returns True if a thread was started and moved to the
-        list of running threads.
-        '''
-        if len(self.runningthreads) < self.maxcount and not self.threadqueue.empty():
-            if not self.noadd:
-                t = self.threadqueue.get(block=True)
-                t.start()
-                self.runningthreads.update([t])
-                return True
-        return False
-
-class ThreadManager(Worker):
-    '''
-    A worker thread that manages the threads a user gives it.  When starting a large number of
+    Manages the threads a user gives it.  When starting a large number of
     threads, it can be helpful to limit their number if they used a 
-    shared resource.  This worker helps to mitigate resource hogging
-    by limiting the number of threads that can start, and joins them when 
-    they have completed whatever they were doing.
+    shared resource.  This manager helps to mitigate resource hogging
+    by limiting the number of threads that can run at once, overall and on
+    each device.  See scheduler.DeviceScheduler.
     '''
     def __init__(self, maxcount: int=3):
-        super(ThreadManager, self).__init__(functor=None)
-        self.toadd = queue.Queue(0)
-        self.pool = ThreadPool(maxcount)
-    
-    def addThread(self, t: threading.Thread=None) -> None:
-        self.toadd.put(t)
-
-    def doWork(self) -> None:
-        while not self.toadd.empty():
-            try:
-                self.pool.addThread(self.toadd.get(block=False, timeout=0.5))
-            except queue.Empty:
-                break
-        self.pool.startAll()
-        self.pool.joinAll()
-
-    def halt_thread(self) -> None:
-        self.pool.terminateAll()
-        super(ThreadManager, self).halt_thread()
+        super(ThreadManager, self).__init__(maxcount)
 
 class BackupThread(threading.Thread):
     class QtComObject(QObject):
@@ -238,3 +97,23 @@ class PruneBackupThread(QObject, threading.Thread):
         logger.debug(f"{PruneBackupThread.status.__qualname__}: Backup prune thread emmitting finished ")
         self.finished.emit()
 
+class VerifyThread(QObject, threading.Thread):
+    statusUpdated = pyqtSignal(ProcessStatus)
+    showError = pyqtSignal(recursivecopy.UnexpectedError)
+    finished = pyqtSignal(VerifyReport)
+
+    def __init__(self, backup: BackupProfile=None, mapping: BackupMapping=None):
+        super(VerifyThread, self).__init__()
+        self.daemon = True
+        self.backup = backup
+        self.verify = Verify(backup, mapping, {"progressupdate": self.statusUpdated.emit, 
+            "reporterror": self.showError.emit, "finished": None})
+
+    def run(self)->None:
+        logger.info("verify thread starting")
+        report = self.verify.execute()
+        logger.info("verify finished")
+        self.finished.emit(report)
+
+    def cancelExec(self)->None:
+        self.verify.abort = True
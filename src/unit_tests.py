@@ -18,7 +18,19 @@ import unittest
 
 #Test Cases:
 #from projecttests.filesystem import IterationTestCase # noqa: F401
+from projecttests.filesystem import ScanTestCase # noqa: F401
 #from projecttests.data import DataTestCase # noqa: F401
+from projecttests.data import ManifestTestCase # noqa: F401
+from projecttests.data import ProgressTestCase # noqa: F401
+from projecttests.data import CopyTestCase # noqa: F401
+from projecttests.data import CompareTestCase # noqa: F401
+from projecttests.data import VerifyTestCase # noqa: F401
+from projecttests.data import PruneTestCase # noqa: F401
+from projecttests.data import TrashTestCase # noqa: F401
+from projecttests.data import SnapshotTestCase # noqa: F401
+from projecttests.data import ChunkStoreTestCase # noqa: F401
+from projecttests.data import CompressionTestCase # noqa: F401
+from projecttests.data import ResumeTestCase # noqa: F401
 from projecttests.misc import MiscTestCase # noqa: F401
 
 if __name__ == "__main__":